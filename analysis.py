@@ -1,10 +1,17 @@
 import argparse
+import hashlib
 import json
 import numpy as np
 import re
 import os
 import csv
-import utils as utils
+from multiprocessing import Pool
+from run_store import STORE_FILE, find_runs, open_run
+from run_manifest import atomic_write_json
+import results_table
+import pareto
+import oracle
+import bargaining
 
 def calculate_avg_score(dir_path, filter_zeros=False):
     # collect all scores from both players
@@ -24,56 +31,88 @@ def calculate_avg_score(dir_path, filter_zeros=False):
         return np.mean(full_scores)
 
 
+def game_measures(table, objective):
+    """Per-game Pareto and distance measures for the rows of a results table.
+
+    Returns arrays of is_optimal, dominance_margin, frontier_distance and a
+    {solution}_distance per bargaining solution. Measures that cannot be taken
+    for these games (an objective without a Pareto check, or item types the
+    context oracle does not cover) are False or NaN.
+    """
+    num_games = len(table)
+    contexts = (table["counts"], table["p0_values"], table["p1_values"])
+    p0_scores, p1_scores = table["p0_score"], table["p1_score"]
+    measures = {
+        "is_optimal": np.zeros(num_games, dtype=bool),
+        "dominance_margin": np.full(num_games, np.nan),
+        "frontier_distance": np.full(num_games, np.nan),
+    }
+    for solution in bargaining.SOLUTIONS:
+        measures[f"{solution}_distance"] = np.full(num_games, np.nan)
+
+    # per-context pareto lookups for the whole run at once; games with other
+    # item types than the context file are checked against their frontiers
+    context_oracle = oracle.get_oracle()
+    use_oracle = results_table.table_items(table) == context_oracle.num_items
+    check = context_oracle.pareto_optimal if use_oracle else pareto.pareto_optimal
+
+    if objective in pareto.OBJECTIVES:
+        measures["is_optimal"], measures["dominance_margin"] = check(
+            *contexts, p0_scores, p1_scores, objective
+        )
+
+    # distance of the final scores from each bargaining solution
+    if objective in pareto.OBJECTIVES and use_oracle:
+        distances = context_oracle.solution_distances(
+            *contexts, p0_scores, p1_scores, objective
+        )
+        for index, solution in enumerate(bargaining.SOLUTIONS):
+            measures[f"{solution}_distance"] = distances[:, index]
+
+    # distance of each outcome from the frontier, in both players' own scores
+    # (games without a deal leave both players with nothing)
+    if use_oracle:
+        agreement_mask = table["is_valid_deal"]
+        p0_own = np.where(
+            agreement_mask, (table["p0_values"] * table["p0_allocation"]).sum(axis=1), 0
+        )
+        p1_own = np.where(
+            agreement_mask, (table["p1_values"] * table["p1_allocation"]).sum(axis=1), 0
+        )
+        measures["frontier_distance"] = context_oracle.frontier_distance(
+            *contexts, p0_own, p1_own
+        )
+
+    return measures
+
+
 def analyze(dir_path, verbose=True, objective="orig"):
+    # every statistic comes from the run's columnar results table (one row per
+    # game), which is built from the per-game results the first time it is needed
+    table = results_table.load_table(dir_path)
+
     # collect all scores from both players
-    with open(f"{dir_path}/p0_scores", "r") as p0_scores, open(
-        f"{dir_path}/p1_scores", "r"
-    ) as p1_scores:
-        p0_array = [int(line.strip()) for line in p0_scores]
-        p1_array = [int(line.strip()) for line in p1_scores]
+    p0_array = table["p0_score"]
+    p1_array = table["p1_score"]
 
-    full_scores = p0_array + p1_array
+    full_scores = np.concatenate([p0_array, p1_array])
 
     # calculate all scores
     unfiltered_mean = np.mean(full_scores)
     unfiltered_median = np.median(full_scores)
 
-    # initialize arrays to store indices of games with agreements, token counts, and message counts
-    agreement_indices = []
-    token_counts = []
-    msg_counts = []
+    # games with agreements, token counts, and message counts
+    agreement_mask = table["is_valid_deal"]
+    token_counts = table["token_count"]
+    msg_counts = table["message_count"]
 
     # track number of aborts
-    num_aborts = 0
-
-    # iterate through game indices
-    for i in range(len(p0_array)):
-        index = ("000" + str(i))[-3:]
-
-        # retrieve results JSON
-        results_filename = f"{dir_path}/results/{index}.json"
-        with open(results_filename, "r") as results_file:
-            result = json.load(results_file)
-
-        # check for valid indices
-        if result["is_valid_deal"]:
-            agreement_indices.append(i)
-
-        # append token and message counts
-        token_counts.append(result["token_count"])
-        msg_counts.append(result["message_count"])
-
-        # open text file to check for aborts
-        text_filename = f"{dir_path}/text_logs/{index}_full.txt"
-        with open(text_filename, "r") as text_file:
-            text = text_file.read()
-        if "[ABORT]" in text:
-            num_aborts += 1
+    num_aborts = int(np.count_nonzero(table["aborted"]))
 
     # calculate agreement rate
-    agreement_scores_p0 = [p0_array[i] for i in agreement_indices]
-    agreement_scores_p1 = [p1_array[i] for i in agreement_indices]
-    agreement_scores = agreement_scores_p0 + agreement_scores_p1
+    agreement_scores = np.concatenate(
+        [p0_array[agreement_mask], p1_array[agreement_mask]]
+    )
     proportion_agreement = len(agreement_scores) / len(full_scores)
 
     # gather total statistics
@@ -101,38 +140,21 @@ def analyze(dir_path, verbose=True, objective="orig"):
         print(f"rate of abort: {num_aborts / len(p0_array)}")
 
     # extract message/token counts of games ending in agreement
-    agreement_message_counts = [msg_counts[i] for i in agreement_indices]
-    agreement_token_counts = [token_counts[i] for i in agreement_indices]
+    agreement_message_counts = msg_counts[agreement_mask]
+    agreement_token_counts = token_counts[agreement_mask]
 
     # calculate the proportion of pareto-optimal results
-    num_optimal = 0
-    for filename in os.listdir(f"{dir_path}/results"):
-
-        # retrieve results JSON
-        results_filename = os.path.join(f"{dir_path}/results", filename)
-        with open(results_filename, "r") as results_file:
-            result = json.load(results_file)
-
-        # use game index to retrieve the score that we got
-        game_index = int(filename[:3])
-        p0_score, p1_score = p0_array[game_index], p1_array[game_index]
-
-        try:
-            # determine whether game reached pareto-optimality
-            is_optimal = utils.isParetoOptimal(
-                p0_score,
-                p1_score,
-                result["counts"],
-                result["p0_values"],
-                result["p1_values"],
-                objective=objective,
-            )
-            if is_optimal:
-                num_optimal += 1
-
-        except:
-            print(game_index)
-            print(result)
+    if verbose and objective not in pareto.OBJECTIVES:
+        print(f"cannot check pareto-optimality under objective {objective}")
+    measures = game_measures(table, objective)
+    num_optimal = int(np.count_nonzero(measures["is_optimal"]))
+    mean_dominance_margin = np.mean(measures["dominance_margin"])
+    mean_frontier_distance = np.mean(measures["frontier_distance"])
+
+    # mean distance of the final scores from each bargaining solution
+    solution_distances = np.stack(
+        [measures[f"{solution}_distance"] for solution in bargaining.SOLUTIONS], axis=1
+    ).mean(axis=0)
 
     # gather agreement statistics
     agreement_stats = {
@@ -142,7 +164,11 @@ def analyze(dir_path, verbose=True, objective="orig"):
         "length_in_tkns": np.mean(agreement_token_counts),
         "proportion_agreement": proportion_agreement,
         "proportion_pareto_opt": num_optimal / len(p0_array),
+        "mean_dominance_margin": mean_dominance_margin,
+        "mean_frontier_distance": mean_frontier_distance,
     }
+    for solution, distance in zip(bargaining.SOLUTIONS, solution_distances):
+        agreement_stats[f"{solution}_distance"] = distance
 
     if verbose:
         print("AGREEMENT:")
@@ -152,29 +178,25 @@ def analyze(dir_path, verbose=True, objective="orig"):
         print(f"agreement average length (msgs): {np.mean(agreement_message_counts)}")
         print(f"agreement average length (tokens): {np.mean(agreement_token_counts)}")
         print(f"proportion of pareto optimal games: {num_optimal / len(p0_array)}")
+        print(f"mean dominance margin: {mean_dominance_margin}")
+        print(f"mean frontier distance: {mean_frontier_distance}")
+        for solution in bargaining.SOLUTIONS:
+            distance = agreement_stats[f"{solution}_distance"]
+            print(f"mean distance to {solution} solution: {distance}")
 
     ############################
     # ABOVE AVERAGE GAME STATS #
     ############################
 
     # determine average score
-    cutoff = np.mean(p0_array + p1_array)
+    cutoff = np.mean(full_scores)
 
-    # collect the games indices of the games from both players that scored above average
-    p0_good_games_indices, p1_good_games_indices = [], []
-    for i in range(len(p0_array)):
-        if p0_array[i] > cutoff:
-            p0_good_games_indices.append(i)
-
-        if p1_array[i] > cutoff:
-            p1_good_games_indices.append(i)
-
-    # collect scores based on above avg indices
-    p0_above_avg_scores = [p0_array[i] for i in p0_good_games_indices]
-    p1_above_avg_scores = [p1_array[i] for i in p1_good_games_indices]
+    # collect scores of the games from both players that scored above average
+    p0_above_avg_scores = p0_array[p0_array > cutoff]
+    p1_above_avg_scores = p1_array[p1_array > cutoff]
 
     # calculate statistics
-    all_above_avg_scores = p0_above_avg_scores + p1_above_avg_scores
+    all_above_avg_scores = np.concatenate([p0_above_avg_scores, p1_above_avg_scores])
     above_avg_mean = np.mean(all_above_avg_scores)
     above_avg_median = np.median(all_above_avg_scores)
 
@@ -182,8 +204,8 @@ def analyze(dir_path, verbose=True, objective="orig"):
     proportion_above_avg = len(all_above_avg_scores) / len(full_scores)
 
     # extract msg/token lengths
-    above_avg_message_counts = [msg_counts[i] for i in agreement_indices]
-    above_avg_token_counts = [token_counts[i] for i in agreement_indices]
+    above_avg_message_counts = msg_counts[agreement_mask]
+    above_avg_token_counts = token_counts[agreement_mask]
 
     # gather above avg statistics
     above_avg_stats = {
@@ -252,26 +274,97 @@ def generate_game_contexts(dir_path):
     if not os.path.exists(f"{dir_path}/contexts"):
         os.makedirs(f"{dir_path}/contexts")
 
-    # iterate through the full text files
-    for filename in os.listdir(f"{dir_path}/text_logs"):
-        filepath = os.path.join(f"{dir_path}/text_logs", filename)
-
-        # check if it's a "full.txt",
-        if filepath.endswith("full.txt"):
+    # iterate through the full text logs
+    with open_run(dir_path) as run:
+        for index in run.indices():
             # get the first 3 lines to get the game context
-            with open(filepath, "r") as text_log:
-                context_str = "".join([next(text_log) for _ in range(3)])
+            context_str = "".join(run.text(index, "full").splitlines(True)[:3])
 
             # pass into the context parsing function, get a JSON back
             context_json = parse_game_context(context_str)
 
             # write the JSON to a file in the new folder with the correct name
-            index = filename[:3]
             with open(f"{dir_path}/contexts/{index}.json", "w") as context_file:
                 json.dump(context_json, context_file)
 
 
-def create_csv(objective, output_path):
+STATS_CACHE_FILE = "stats_cache.json"
+
+# the files whose contents analyze() depends on; every file in the results/
+# directory is fingerprinted, since a results file rewritten in place leaves the
+# directory's mtime unchanged
+FINGERPRINT_FILES = [
+    results_table.TABLE_FILE,
+    "p0_scores",
+    "p1_scores",
+    "results",
+    STORE_FILE,
+    "manifest.json",
+    "manifest.log",
+]
+
+
+def run_fingerprint(dir_path):
+    # a hash of the sizes and modification times of a run's files (and of the
+    # oracle version, since the stats are computed with it)
+    fingerprint = hashlib.sha256(f"oracle v{oracle.VERSION}".encode("utf-8"))
+    for name in FINGERPRINT_FILES:
+        path = f"{dir_path}/{name}"
+        if not os.path.exists(path):
+            fingerprint.update(f"{name} missing\n".encode())
+            continue
+        if os.path.isdir(path):
+            entries = sorted(os.scandir(path), key=lambda entry: entry.name)
+            infos = [(f"{name}/{entry.name}", entry.stat()) for entry in entries]
+        else:
+            infos = [(name, os.stat(path))]
+        for file_name, info in infos:
+            fingerprint.update(
+                f"{file_name} {info.st_size} {info.st_mtime_ns}\n".encode()
+            )
+    return fingerprint.hexdigest()
+
+
+def cached_analyze(dir_path, objective="orig"):
+    """analyze() for a run, reusing the stats cached in the run directory.
+
+    The stats of each objective are kept in stats_cache.json under the run's
+    fingerprint, so a run that has not changed since it was last analyzed is not
+    read again. Returns the stats and whether they came from the cache.
+    """
+    cache_path = f"{dir_path}/{STATS_CACHE_FILE}"
+    cache = {}
+    if os.path.exists(cache_path):
+        with open(cache_path, "r") as cache_file:
+            cache = json.load(cache_file)
+    if cache.get("fingerprint") == run_fingerprint(dir_path):
+        if objective in cache["stats"]:
+            return cache["stats"][objective], True
+    else:
+        cache = {"stats": {}}
+
+    stats = analyze(dir_path, verbose=False, objective=objective)
+    stats = {
+        group: {name: float(value) for name, value in group_stats.items()}
+        for group, group_stats in stats.items()
+    }
+
+    # the fingerprint is taken after analyzing, which may build the results table
+    cache["fingerprint"] = run_fingerprint(dir_path)
+    cache["stats"][objective] = stats
+    try:
+        atomic_write_json(cache_path, cache)
+    except OSError:
+        pass
+    return stats, False
+
+
+def analyze_run(dir_path):
+    # worker for the report: each process analyzes whole runs
+    return cached_analyze(dir_path)
+
+
+def create_csv(objective, output_path, runs=None, workers=None):
     original_iterations = [
         "data/original/gpt-4",
         "data/original/9DNgwMlN",
@@ -315,11 +408,24 @@ def create_csv(objective, output_path):
     elif objective == "human_coop":
         iterations = human_coop_iterations
 
+    # runs given by path or glob replace the iterations listed above
+    if runs is not None:
+        iterations = find_runs(runs)
+
     data = []
 
-    # iterate through all iterations and append aggregated data to the list
-    for iteration_path in iterations:
-        results = analyze(iteration_path)
+    # compile the context index and the oracle once, before the worker processes
+    # need them
+    oracle.get_oracle()
+
+    # analyze the iterations in worker processes; runs that have not changed since
+    # the last report are read from their stats caches
+    with Pool(workers) as pool:
+        analyzed = pool.map(analyze_run, iterations)
+
+    # append aggregated data to the list, in the order of the iterations
+    for iteration_path, (results, cached) in zip(iterations, analyzed):
+        print(f"{iteration_path}: {'cached' if cached else 'analyzed'}")
 
         model_id = iteration_path.split("/")[-1]
         data.append(
@@ -382,10 +488,28 @@ def main():
     # add arguments
     parser.add_argument("-p", "--path", type=str, help="model to analyze")
     parser.add_argument("-o", "--objective", type=str, help="Game objective")
+    parser.add_argument(
+        "--csv", type=str, default=None, help="Write a report of many runs to this CSV"
+    )
+    parser.add_argument(
+        "-r",
+        "--runs",
+        type=str,
+        nargs="+",
+        default=None,
+        help="Run directories for the report (globs allowed)",
+    )
+    parser.add_argument(
+        "-w", "--workers", type=int, default=None, help="Number of worker processes"
+    )
 
     # parse the command-line arguments
     args = parser.parse_args()
-    
+
+    if args.csv is not None:
+        create_csv(args.objective, args.csv, runs=args.runs, workers=args.workers)
+        return
+
     analyze(args.path, objective=args.objective)
 
 
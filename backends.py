@@ -0,0 +1,175 @@
+from dotenv import load_dotenv
+from openai import OpenAI
+import httpx
+import os
+import threading
+import token_accounting
+
+# settings for the shared OpenAI client; can be overridden by configure_client()
+# or through the environment
+client_config = {
+    "pool_size": int(os.getenv("OPENAI_POOL_SIZE", 64)),
+    "timeout": float(os.getenv("OPENAI_TIMEOUT", 60)),
+    "connect_timeout": float(os.getenv("OPENAI_CONNECT_TIMEOUT", 10)),
+    "max_retries": int(os.getenv("OPENAI_MAX_RETRIES", 2)),
+    "base_url": os.getenv("OPENAI_BASE_URL"),
+}
+
+_client = None
+_client_lock = threading.Lock()
+
+_backend_factories = {}
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+class ConnectionStats:
+    """Counts HTTP requests against new TCP connections and TLS handshakes."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.new_connections = 0
+        self.tls_handshakes = 0
+
+        # stats for the API call currently running on each thread
+        self.current = threading.local()
+
+    def start_call(self):
+        self.current.call = {"requests": 0, "new_connections": 0, "tls_handshakes": 0}
+
+    def end_call(self):
+        call = getattr(self.current, "call", None)
+        self.current.call = None
+        if call is not None:
+            call["reused_connection"] = call["new_connections"] == 0
+        return call
+
+    def trace_request(self, request):
+        # httpx event hook; attaches an httpcore trace callback to the request
+        self.record("requests")
+        request.extensions["trace"] = self.trace
+
+    def trace(self, event_name, info):
+        if event_name == "connection.connect_tcp.complete":
+            self.record("new_connections")
+        elif event_name == "connection.start_tls.complete":
+            self.record("tls_handshakes")
+
+    def record(self, counter):
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+        call = getattr(self.current, "call", None)
+        if call is not None:
+            call[counter] += 1
+
+    def summary(self):
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "new_connections": self.new_connections,
+                "tls_handshakes": self.tls_handshakes,
+                "reuse_rate": 1 - self.new_connections / max(self.requests, 1),
+            }
+
+
+connection_stats = ConnectionStats()
+
+
+def configure_client(**settings):
+    # update the client settings; the shared client is rebuilt on next use
+    global _client
+    for key in settings:
+        if key not in client_config:
+            raise Exception(f"unknown client setting: {key}")
+
+    with _client_lock:
+        client_config.update(settings)
+        if _client is not None:
+            _client.close()
+            _client = None
+
+
+def get_client():
+    # process-wide OpenAI client with a pooled, keep-alive HTTP connection
+    global _client
+    with _client_lock:
+        if _client is None:
+            load_dotenv()
+            http_client = httpx.Client(
+                limits=httpx.Limits(
+                    max_connections=client_config["pool_size"],
+                    max_keepalive_connections=client_config["pool_size"],
+                ),
+                timeout=httpx.Timeout(
+                    client_config["timeout"],
+                    connect=client_config["connect_timeout"],
+                ),
+                event_hooks={"request": [connection_stats.trace_request]},
+            )
+            _client = OpenAI(
+                api_key=os.getenv("OPENAI_API_KEY"),
+                organization=os.getenv("OPENAI_ORG_ID"),
+                base_url=client_config["base_url"],
+                max_retries=client_config["max_retries"],
+                http_client=http_client,
+            )
+        return _client
+
+
+class OpenAIBackend:
+    """Chat completions through the shared OpenAI client."""
+
+    def complete(
+        self, model, messages, temperature=1, max_tokens=200, seed=None, priority=0
+    ):
+        request = {
+            "model": model,
+            "messages": messages,
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+        }
+        if seed is not None:
+            request["seed"] = seed
+
+        connection_stats.start_call()
+        try:
+            response = get_client().chat.completions.create(**request)
+        finally:
+            connection = connection_stats.end_call()
+
+        return {
+            "content": response.choices[0].message.content,
+            "finish_reason": response.choices[0].finish_reason,
+            "usage": token_accounting.usage_from_response(response.usage),
+            "connection": connection,
+        }
+
+
+def register_backend(name, factory):
+    # factory is called with no arguments the first time the backend is requested
+    with _backends_lock:
+        _backend_factories[name] = factory
+        _backends.pop(name, None)
+
+
+def get_backend(name="openai"):
+    # backends are shared by every player in the process
+    with _backends_lock:
+        if name not in _backends:
+            if name not in _backend_factories:
+                raise Exception(f"unknown backend: {name}")
+            _backends[name] = _backend_factories[name]()
+        return _backends[name]
+
+
+def mock_backend():
+    # imported on first use, since the mock backend is only needed offline
+    from mock_backend import MockBackend
+
+    return MockBackend()
+
+
+register_backend("openai", OpenAIBackend)
+register_backend("mock", mock_backend)
@@ -0,0 +1,153 @@
+import argparse
+import time
+
+import numpy as np
+
+import pareto
+
+SOLUTIONS = ["nash", "kalai_smorodinsky", "egalitarian"]
+
+
+def best_candidates(primary, feasible, joint):
+    # index of the feasible candidate with the largest primary value in each row,
+    # ties going to the larger joint score and then to the earlier candidate
+    primary = np.where(feasible, primary, -np.inf)
+    is_best = primary == primary.max(axis=1, keepdims=True)
+    return np.where(is_best, joint, -np.inf).argmax(axis=1)
+
+
+def solve_points(p0_final, p1_final):
+    """Solution points for a batch of games, given every candidate's final scores.
+
+    The candidates are the allocations of each game plus the disagreement point
+    (no deal, where both players score 0), and only candidates that leave both
+    players at least their disagreement score are feasible. Returns the final
+    scores of the Nash, Kalai-Smorodinsky and egalitarian solutions, shape
+    (N, 3, 2), in the order of SOLUTIONS.
+    """
+    zeros = np.zeros((len(p0_final), 1), dtype=p0_final.dtype)
+    p0_final = np.concatenate([p0_final, zeros], axis=1)
+    p1_final = np.concatenate([p1_final, zeros], axis=1)
+    feasible = (p0_final >= 0) & (p1_final >= 0)
+    joint = p0_final + p1_final
+
+    # nash: the largest product of both players' gains
+    nash = best_candidates(p0_final * p1_final, feasible, joint)
+
+    # kalai-smorodinsky: the largest common share of each player's ideal gain;
+    # a player who cannot gain anything is treated as already at their ideal
+    p0_ideal = np.where(feasible, p0_final, 0).max(axis=1, keepdims=True)
+    p1_ideal = np.where(feasible, p1_final, 0).max(axis=1, keepdims=True)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        p0_share = np.where(p0_ideal > 0, p0_final / p0_ideal, 1.0)
+        p1_share = np.where(p1_ideal > 0, p1_final / p1_ideal, 1.0)
+    kalai_smorodinsky = best_candidates(
+        np.minimum(p0_share, p1_share), feasible, joint
+    )
+
+    # egalitarian: the largest score of the worse-off player
+    egalitarian = best_candidates(np.minimum(p0_final, p1_final), feasible, joint)
+
+    chosen = np.stack([nash, kalai_smorodinsky, egalitarian], axis=1)
+    return np.stack(
+        [
+            np.take_along_axis(p0_final, chosen, axis=1),
+            np.take_along_axis(p1_final, chosen, axis=1),
+        ],
+        axis=2,
+    )
+
+
+def bargaining_solutions(counts, p0_values, p1_values, chunk_size=4096):
+    """Bargaining solutions for a batch of N contexts, under every objective.
+
+    Returns the final scores of each solution, shape (N, 3, 3, 2): contexts,
+    objectives (in pareto.OBJECTIVES order), solutions (in SOLUTIONS order) and
+    players.
+    """
+    counts = np.asarray(counts, dtype=np.int32)
+    p0_values = np.asarray(p0_values, dtype=np.int32)
+    p1_values = np.asarray(p1_values, dtype=np.int32)
+
+    num_contexts = len(counts)
+    points = np.zeros(
+        (num_contexts, len(pareto.OBJECTIVES), len(SOLUTIONS), 2), dtype=np.int16
+    )
+    if num_contexts == 0:
+        return points
+
+    for group_counts, members in pareto.group_by_counts(counts):
+        grid = pareto.allocation_grid(group_counts).astype(np.int32)
+
+        for start in range(0, len(members), chunk_size):
+            batch = members[start : start + chunk_size]
+            p0_own, p1_own = pareto.own_scores(
+                grid, group_counts, p0_values[batch], p1_values[batch]
+            )
+            for code in range(len(pareto.OBJECTIVES)):
+                codes = np.full(len(batch), code)
+                p0_final, p1_final = pareto.objective_scores(p0_own, p1_own, codes)
+                points[batch, code] = solve_points(p0_final, p1_final)
+
+    return points
+
+
+def solution_distances(points, p0_scores, p1_scores, symmetric=None):
+    # euclidean distance from each game's final scores to each solution point,
+    # for points of shape (N, 3, 2); returns shape (N, 3). When both players
+    # value the items alike, the mirrored point is a solution as well (ties are
+    # broken by seat otherwise), so the nearer of the two is used
+    p0_scores = np.asarray(p0_scores, dtype=np.float64)[:, None]
+    p1_scores = np.asarray(p1_scores, dtype=np.float64)[:, None]
+    distances = np.hypot(points[:, :, 0] - p0_scores, points[:, :, 1] - p1_scores)
+    if symmetric is not None:
+        mirrored = np.hypot(points[:, :, 1] - p0_scores, points[:, :, 0] - p1_scores)
+        distances = np.where(
+            symmetric[:, None], np.minimum(distances, mirrored), distances
+        )
+    return distances
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="compute bargaining solutions for every context in bulk"
+    )
+    parser.add_argument(
+        "-p",
+        "--path",
+        type=str,
+        default=None,
+        help="Run whose games to solve (default: every unique context)",
+    )
+    args = parser.parse_args()
+
+    if args.path is not None:
+        import results_table
+
+        table = results_table.load_table(args.path)
+        counts, p0_values, p1_values = (
+            table["counts"],
+            table["p0_values"],
+            table["p1_values"],
+        )
+    else:
+        from contexts import ContextIndex
+
+        contexts = ContextIndex()
+        pairs = np.asarray(contexts.unique_pairs)
+        counts = contexts.counts[pairs]
+        p0_values, p1_values = contexts.values[pairs, 0], contexts.values[pairs, 1]
+
+    start_time = time.perf_counter()
+    points = bargaining_solutions(counts, p0_values, p1_values)
+    solve_time = time.perf_counter() - start_time
+
+    print(f"{len(points)} contexts solved in {solve_time:.3f}s")
+    for code, objective in enumerate(pareto.OBJECTIVES):
+        for index, solution in enumerate(SOLUTIONS):
+            mean_point = points[:, code, index].mean(axis=0)
+            print(f"{objective} {solution}: mean point {mean_point.round(3).tolist()}")
+
+
+if __name__ == "__main__":
+    main()
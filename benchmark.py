@@ -0,0 +1,120 @@
+import argparse
+import shutil
+import tempfile
+import time
+
+from mock_backend import LATENCY_DISTRIBUTIONS, MockBackend
+from play import simulate_trials
+
+
+def run_benchmark(
+    num_runs,
+    concurrency=1,
+    objective="self",
+    latency="none",
+    latency_mean=0.0,
+    latency_std=0.0,
+    error_rate=0.0,
+    malformed_rate=0.0,
+    seed=0,
+    output_dir=None,
+    storage="files",
+):
+    # plays num_runs games against the mock backend and measures harness throughput
+    backend = MockBackend(
+        latency=latency,
+        latency_mean=latency_mean,
+        latency_std=latency_std,
+        error_rate=error_rate,
+        malformed_rate=malformed_rate,
+        seed=seed,
+    )
+
+    keep_output = output_dir is not None
+    if not keep_output:
+        output_dir = tempfile.mkdtemp(prefix="selfplay_benchmark_")
+
+    try:
+        start_time = time.perf_counter()
+        simulate_trials(
+            "mock",
+            output_dir,
+            1,
+            objective,
+            num_runs,
+            concurrency=concurrency,
+            seed=seed,
+            backend=backend,
+            storage=storage,
+        )
+        duration = time.perf_counter() - start_time
+    finally:
+        if not keep_output:
+            shutil.rmtree(output_dir)
+
+    stats = backend.stats()
+
+    # time not spent waiting on the (simulated) API is harness overhead: logging,
+    # validation, tokenization and file creation. With concurrent games, the
+    # waits overlap and workers sit idle, so the wall time cannot be split this
+    # way and the overhead is only reported for games played one at a time
+    overhead_per_call = None
+    if concurrency == 1:
+        harness_time = duration - stats["latency_total"]
+        overhead_per_call = 1000 * harness_time / max(stats["calls"], 1)
+    return {
+        "games": num_runs,
+        "duration": duration,
+        "games_per_second": num_runs / duration,
+        "calls": stats["calls"],
+        "calls_per_game": stats["calls"] / num_runs,
+        "malformed_outputs": stats["malformed"],
+        "simulated_latency": stats["latency_total"],
+        "harness_overhead_per_call_ms": overhead_per_call,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="benchmark the self-play harness against a mock backend"
+    )
+    parser.add_argument("-n", "--num_runs", type=int, default=200, help="Games to play")
+    parser.add_argument("-c", "--concurrency", type=int, default=1)
+    parser.add_argument("-o", "--objective", type=str, default="self")
+    parser.add_argument(
+        "--latency", type=str, default="none", choices=LATENCY_DISTRIBUTIONS
+    )
+    parser.add_argument("--latency_mean", type=float, default=0.0, help="Seconds")
+    parser.add_argument("--latency_std", type=float, default=0.0, help="Seconds")
+    parser.add_argument("--error_rate", type=float, default=0.0)
+    parser.add_argument("--malformed_rate", type=float, default=0.1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "-d", "--output_dir", type=str, default=None, help="Keep logs here"
+    )
+    parser.add_argument(
+        "--storage", type=str, default="files", choices=["files", "store"]
+    )
+    args = parser.parse_args()
+
+    report = run_benchmark(
+        args.num_runs,
+        concurrency=args.concurrency,
+        objective=args.objective,
+        latency=args.latency,
+        latency_mean=args.latency_mean,
+        latency_std=args.latency_std,
+        error_rate=args.error_rate,
+        malformed_rate=args.malformed_rate,
+        seed=args.seed,
+        output_dir=args.output_dir,
+        storage=args.storage,
+    )
+
+    print("BENCHMARK:")
+    for key, value in report.items():
+        print(f"{key}: {value}")
+
+
+if __name__ == "__main__":
+    main()
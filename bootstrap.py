@@ -0,0 +1,309 @@
+import argparse
+import time
+
+import numpy as np
+
+import analysis
+import bargaining
+import results_table
+
+# per-game columns summed by every resample; each statistic of analyze() is a
+# function of these sums, so a batch of resamples is one matrix product
+SUMS = [
+    "games",
+    "agreements",
+    "aborts",
+    "messages",
+    "tokens",
+    "agreement_messages",
+    "agreement_tokens",
+    "optimal",
+    "dominance_margin",
+    "frontier_distance",
+] + [f"{solution}_distance" for solution in bargaining.SOLUTIONS]
+
+
+def game_features(table, objective, score_values):
+    """The per-game columns that the statistics of a run are built from.
+
+    Returns an (N, F) array: the SUMS columns, then a histogram of both players'
+    scores and a histogram of the scores of games with a deal, over
+    score_values (scores are small integers, so medians and above-average stats
+    can be read off the summed histograms).
+    """
+    agreement = table["is_valid_deal"]
+    measures = analysis.game_measures(table, objective)
+    columns = [
+        np.ones(len(table)),
+        agreement,
+        table["aborted"],
+        table["message_count"],
+        table["token_count"],
+        np.where(agreement, table["message_count"], 0),
+        np.where(agreement, table["token_count"], 0),
+        measures["is_optimal"],
+        measures["dominance_margin"],
+        measures["frontier_distance"],
+    ] + [measures[f"{solution}_distance"] for solution in bargaining.SOLUTIONS]
+
+    histogram = np.zeros((len(table), len(score_values)))
+    for scores in [table["p0_score"], table["p1_score"]]:
+        histogram[np.arange(len(table)), np.searchsorted(score_values, scores)] += 1
+    agreement_histogram = histogram * agreement[:, None]
+
+    return np.column_stack(columns + [histogram, agreement_histogram])
+
+
+def score_values_of(*tables):
+    # every score that occurs in some table, sorted
+    return np.unique(
+        np.concatenate(
+            [np.concatenate([table["p0_score"], table["p1_score"]]) for table in tables]
+        )
+    )
+
+
+def histogram_median(histograms, score_values):
+    # the median of each row's histogram, as np.median of the scores would give
+    totals = histograms.sum(axis=1)
+    ends = np.cumsum(histograms, axis=1)
+    medians = np.full(len(histograms), np.nan)
+    counted = totals > 0
+    if len(score_values) == 0 or not counted.any():
+        return medians
+    middle = []
+    for position in [(totals - 1) // 2, totals // 2]:
+        index = (ends <= position[:, None]).sum(axis=1)
+        middle.append(score_values[np.minimum(index, len(score_values) - 1)])
+    medians[counted] = ((middle[0] + middle[1]) / 2)[counted]
+    return medians
+
+
+def divide(numerator, denominator):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(denominator > 0, numerator / denominator, np.nan)
+
+
+def statistics(sums, score_values):
+    """The statistics of analyze() for each row of summed game features.
+
+    sums has shape (B, F), one row per resample; returns the nested dict of
+    analyze() with an array of B values per statistic.
+    """
+    column = {name: sums[:, index] for index, name in enumerate(SUMS)}
+    num_values = len(score_values)
+    histogram = sums[:, len(SUMS) : len(SUMS) + num_values]
+    agreement_histogram = sums[:, len(SUMS) + num_values :]
+    games, agreements = column["games"], column["agreements"]
+
+    num_scores = histogram.sum(axis=1)
+    mean = divide(histogram @ score_values, num_scores)
+    total_stats = {
+        "mean": mean,
+        "median": histogram_median(histogram, score_values),
+        "length_in_msgs": divide(column["messages"], games),
+        "length_in_tkns": divide(column["tokens"], games),
+        "abort_rate": divide(column["aborts"], games),
+    }
+
+    agreement_stats = {
+        "mean": divide(agreement_histogram @ score_values, 2 * agreements),
+        "median": histogram_median(agreement_histogram, score_values),
+        "length_in_msgs": divide(column["agreement_messages"], agreements),
+        "length_in_tkns": divide(column["agreement_tokens"], agreements),
+        "proportion_agreement": divide(agreements, games),
+        "proportion_pareto_opt": divide(column["optimal"], games),
+        "mean_dominance_margin": divide(column["dominance_margin"], games),
+        "mean_frontier_distance": divide(column["frontier_distance"], games),
+    }
+    for solution in bargaining.SOLUTIONS:
+        agreement_stats[f"{solution}_distance"] = divide(
+            column[f"{solution}_distance"], games
+        )
+
+    # scores above each resample's own mean
+    above_histogram = histogram * (score_values[None, :] > mean[:, None])
+    above_avg_stats = {
+        "mean": divide(above_histogram @ score_values, above_histogram.sum(axis=1)),
+        "median": histogram_median(above_histogram, score_values),
+        "length_in_msgs": agreement_stats["length_in_msgs"],
+        "length_in_tkns": agreement_stats["length_in_tkns"],
+        "proportion_above_avg": divide(above_histogram.sum(axis=1), num_scores),
+    }
+
+    return {
+        "total": total_stats,
+        "agreement": agreement_stats,
+        "above_avg": above_avg_stats,
+    }
+
+
+def resample_sums(features, num_resamples, rng, chunk_size=256):
+    # sums of the features over resamples of the rows, drawn with replacement;
+    # each chunk of resamples is a matrix of draw counts times the features
+    # (columns of measures a run does not have are NaN, and stay NaN)
+    num_units = len(features)
+    sums = np.zeros((num_resamples, features.shape[1]))
+    for start in range(0, num_resamples, chunk_size):
+        size = min(chunk_size, num_resamples - start)
+        draws = rng.integers(0, num_units, size=(size, num_units))
+        draws += np.arange(size)[:, None] * num_units
+        weights = np.bincount(draws.ravel(), minlength=size * num_units)
+        sums[start : start + size] = weights.reshape(size, num_units) @ features
+    return sums
+
+
+def intervals(estimates, resampled, confidence):
+    # percentile intervals around each point estimate, in the layout of analyze()
+    tail = (1 - confidence) / 2 * 100
+    results = {}
+    for group, group_stats in estimates.items():
+        results[group] = {}
+        for name, estimate in group_stats.items():
+            values = resampled[group][name]
+            if np.isnan(estimate) or np.isnan(values).all():
+                low = high = np.nan
+            else:
+                low, high = np.nanpercentile(values, [tail, 100 - tail])
+            results[group][name] = (float(estimate[0]), float(low), float(high))
+    return results
+
+
+def bootstrap(table, objective, num_resamples=2000, confidence=0.95, seed=0):
+    """Bootstrap confidence intervals for every statistic of analyze().
+
+    Games are resampled with replacement. Returns the layout of analyze() with
+    an (estimate, low, high) tuple per statistic.
+    """
+    score_values = score_values_of(table)
+    features = game_features(table, objective, score_values)
+    rng = np.random.default_rng(seed)
+
+    estimates = statistics(features.sum(axis=0)[None, :], score_values)
+    resampled = statistics(resample_sums(features, num_resamples, rng), score_values)
+    return intervals(estimates, resampled, confidence)
+
+
+def context_features(features, contexts, shared):
+    # features summed over each shared context's games, shape (C, F)
+    keep = np.isin(contexts, shared)
+    sums = np.zeros((len(shared), features.shape[1]))
+    np.add.at(sums, np.searchsorted(shared, contexts[keep]), features[keep])
+    return sums
+
+
+def paired_bootstrap(
+    table_a, table_b, objective, num_resamples=2000, confidence=0.95, seed=0
+):
+    """Confidence intervals for the change in every statistic from run a to run b.
+
+    Only games whose context (counts and both players' values) occurs in both
+    runs are compared. The shared contexts are resampled with replacement and
+    each resample takes all games of the drawn contexts from both runs, so
+    both runs are scored on the same contexts. Returns the layout of analyze()
+    with an (estimate, low, high) tuple per difference (b minus a), and the
+    number of shared contexts.
+    """
+    if results_table.table_items(table_a) != results_table.table_items(table_b):
+        raise Exception("runs with different item types cannot be paired")
+
+    # one id per distinct context over both runs
+    rows = [
+        np.concatenate(
+            [table["counts"], table["p0_values"], table["p1_values"]], axis=1
+        )
+        for table in [table_a, table_b]
+    ]
+    _, contexts = np.unique(np.concatenate(rows), axis=0, return_inverse=True)
+    contexts = contexts.reshape(-1)
+    contexts_a, contexts_b = contexts[: len(table_a)], contexts[len(table_a) :]
+    shared = np.intersect1d(contexts_a, contexts_b)
+    if len(shared) == 0:
+        raise Exception("the runs have no contexts in common")
+
+    score_values = score_values_of(table_a, table_b)
+    features_a = game_features(table_a, objective, score_values)
+    features_b = game_features(table_b, objective, score_values)
+    features_a = context_features(features_a, contexts_a, shared)
+    features_b = context_features(features_b, contexts_b, shared)
+
+    # the same resamples of contexts for both runs
+    both = np.concatenate([features_a, features_b], axis=1)
+    sums = resample_sums(both, num_resamples, np.random.default_rng(seed))
+    width = features_a.shape[1]
+
+    estimates = difference(
+        statistics(features_a.sum(axis=0)[None, :], score_values),
+        statistics(features_b.sum(axis=0)[None, :], score_values),
+    )
+    resampled = difference(
+        statistics(sums[:, :width], score_values),
+        statistics(sums[:, width:], score_values),
+    )
+    return intervals(estimates, resampled, confidence), len(shared)
+
+
+def difference(stats_a, stats_b):
+    return {
+        group: {
+            name: stats_b[group][name] - stats_a[group][name] for name in group_stats
+        }
+        for group, group_stats in stats_a.items()
+    }
+
+
+def print_intervals(results, confidence):
+    for group, group_stats in results.items():
+        print(f"{group.upper()}:")
+        for name, (estimate, low, high) in group_stats.items():
+            interval = f"{confidence:.0%} CI {low:.4f} to {high:.4f}"
+            print(f"{name}: {estimate:.4f} ({interval})")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="bootstrap confidence intervals for self-play run statistics"
+    )
+    parser.add_argument("-p", "--path", type=str, help="Run to analyze")
+    parser.add_argument(
+        "-c",
+        "--compare",
+        type=str,
+        default=None,
+        help="Second run, compared with the first on their shared contexts",
+    )
+    parser.add_argument(
+        "-o", "--objective", type=str, default="self", help="Game objective"
+    )
+    parser.add_argument(
+        "-n", "--num_resamples", type=int, default=2000, help="Number of resamples"
+    )
+    parser.add_argument(
+        "--confidence", type=float, default=0.95, help="Confidence level"
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Resampling seed")
+    args = parser.parse_args()
+
+    table = results_table.load_table(args.path)
+    start_time = time.perf_counter()
+    if args.compare is None:
+        results = bootstrap(
+            table, args.objective, args.num_resamples, args.confidence, args.seed
+        )
+        print(f"{len(table)} games")
+    else:
+        results, num_shared = paired_bootstrap(
+            table,
+            results_table.load_table(args.compare),
+            args.objective,
+            args.num_resamples,
+            args.confidence,
+            args.seed,
+        )
+        print(f"{num_shared} shared contexts (second run minus first)")
+    print_intervals(results, args.confidence)
+    print(f"{args.num_resamples} resamples in {time.perf_counter() - start_time:.3f}s")
+
+
+if __name__ == "__main__":
+    main()
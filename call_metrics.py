@@ -0,0 +1,202 @@
+import argparse
+import json
+import os
+import threading
+
+import numpy as np
+
+from run_store import find_runs
+
+METRICS_FILE = "metrics.jsonl"
+
+PERCENTILES = [50, 95, 99]
+
+TOKEN_FIELDS = ["prompt_tokens", "completion_tokens", "cached_tokens"]
+
+
+def call_record(
+    game,
+    player,
+    attempt,
+    model,
+    started_at,
+    elapsed,
+    response=None,
+    error=None,
+):
+    """One API call: where its time went, what it used, and how it ended.
+
+    elapsed is the time complete() took; the part spent waiting for the request
+    scheduler (queue_wait, None without one) is reported separately from the
+    request latency, which includes any retries of the request. attempt is the
+    call's validation retry index within the turn (0 for the first try).
+    """
+    response = response if response is not None else {}
+    usage = response.get("usage") or {}
+    queue_wait = response.get("queue_wait")
+    return {
+        "game": game,
+        "player": player,
+        "attempt": attempt,
+        "model": model,
+        "started_at": started_at,
+        "queue_wait": queue_wait,
+        "latency": elapsed - (queue_wait or 0),
+        "api_attempts": response.get("api_attempts"),
+        "prompt_tokens": usage.get("prompt_tokens"),
+        "completion_tokens": usage.get("completion_tokens"),
+        "cached_tokens": usage.get("cached_tokens"),
+        "finish_reason": response.get("finish_reason"),
+        "response_cached": bool(response.get("cached")),
+        "error": None if error is None else type(error).__name__,
+        "status_code": getattr(error, "status_code", None),
+    }
+
+
+class CallMetrics:
+    """Appends one line to metrics.jsonl in a run directory per API call.
+
+    Calls of failed and replayed games are kept too, so the file accounts for
+    every call a run made.
+    """
+
+    def __init__(self, dir_path):
+        self.dir_path = dir_path
+        self.path = f"{dir_path}/{METRICS_FILE}"
+        self.lock = threading.Lock()
+        self.metrics_file = None
+
+    def __getstate__(self):
+        return {"dir_path": self.dir_path}
+
+    def __setstate__(self, state):
+        self.__init__(state["dir_path"])
+
+    def record(self, call):
+        line = json.dumps(call) + "\n"
+        with self.lock:
+            if self.metrics_file is None:
+                self.metrics_file = open(self.path, "a")
+            self.metrics_file.write(line)
+            self.metrics_file.flush()
+
+    def close(self):
+        with self.lock:
+            if self.metrics_file is not None:
+                self.metrics_file.close()
+                self.metrics_file = None
+
+
+def load_calls(dir_path):
+    # the run's call records; a line torn by a crash is skipped
+    calls = []
+    path = f"{dir_path}/{METRICS_FILE}"
+    if not os.path.exists(path):
+        return calls
+    with open(path, "r") as metrics_file:
+        for line in metrics_file:
+            try:
+                calls.append(json.loads(line))
+            except ValueError:
+                continue
+    return calls
+
+
+def percentiles(values):
+    names = [f"p{q}" for q in PERCENTILES]
+    values = [value for value in values if value is not None]
+    if len(values) == 0:
+        return {name: np.nan for name in names}
+    return dict(zip(names, np.percentile(values, PERCENTILES).tolist()))
+
+
+def summarize(calls):
+    """Run-level metrics from the call records.
+
+    Latency and queue-wait percentiles are over calls that got a response;
+    tokens and calls per game are averaged over the games that made a call.
+    Tokens are those of calls the provider answered: a response-cache hit
+    carries the usage of the call it was recorded from, which is not billed
+    again.
+    """
+    answered = [call for call in calls if call["error"] is None]
+    billed = [call for call in answered if not call["response_cached"]]
+    games = {call["game"] for call in calls}
+    num_games = max(len(games), 1)
+
+    errors = {}
+    finish_reasons = {}
+    for call in calls:
+        if call["error"] is not None:
+            errors[call["error"]] = errors.get(call["error"], 0) + 1
+        else:
+            reason = call["finish_reason"]
+            finish_reasons[reason] = finish_reasons.get(reason, 0) + 1
+
+    tokens = {
+        field: sum(call[field] or 0 for call in billed) for field in TOKEN_FIELDS
+    }
+    return {
+        "calls": len(calls),
+        "games": len(games),
+        "calls_per_game": len(calls) / num_games,
+        "validation_retries": sum(call["attempt"] > 0 for call in calls),
+        "api_retries": sum((call["api_attempts"] or 1) - 1 for call in calls),
+        "response_cache_hits": sum(call["response_cached"] for call in calls),
+        "errors": errors,
+        "finish_reasons": finish_reasons,
+        "latency": percentiles(call["latency"] for call in answered),
+        "queue_wait": percentiles(call["queue_wait"] for call in answered),
+        "tokens_per_game": {
+            field: total / num_games for field, total in tokens.items()
+        },
+        "cached_share": tokens["cached_tokens"] / max(tokens["prompt_tokens"], 1),
+    }
+
+
+def print_report(dir_path, report):
+    def timing(stats):
+        # nan when no call recorded it (e.g. queue wait without a scheduler)
+        if all(np.isnan(value) for value in stats.values()):
+            return "n/a"
+        return ", ".join(f"{name} {value:.3f}s" for name, value in stats.items())
+
+    tokens = report["tokens_per_game"]
+    print(f"{dir_path}:")
+    print(
+        f"calls: {report['calls']} over {report['games']} games "
+        f"({report['calls_per_game']:.2f}/game), "
+        f"{report['validation_retries']} validation retries, "
+        f"{report['api_retries']} API retries, "
+        f"{report['response_cache_hits']} response cache hits"
+    )
+    print(f"latency: {timing(report['latency'])}")
+    print(f"queue wait: {timing(report['queue_wait'])}")
+    print(
+        f"tokens per game: {tokens['prompt_tokens']:.1f} prompt "
+        f"({report['cached_share']:.1%} cached), "
+        f"{tokens['completion_tokens']:.1f} completion"
+    )
+    print(f"finish reasons: {report['finish_reasons']}")
+    print(f"errors: {report['errors']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="report per-call latency and usage metrics of self-play runs"
+    )
+    parser.add_argument(
+        "-r", "--runs", type=str, nargs="+", help="Run directories (globs allowed)"
+    )
+    args = parser.parse_args()
+
+    for dir_path in find_runs(args.runs):
+        calls = load_calls(dir_path)
+        if len(calls) == 0:
+            print(f"{dir_path}: no call metrics recorded")
+            continue
+        print_report(dir_path, summarize(calls))
+
+
+if __name__ == "__main__":
+    main()
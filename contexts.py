@@ -0,0 +1,208 @@
+import argparse
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from run_manifest import atomic_write_json, tmp_path_for
+
+SOURCE = "data/selfplay.txt"
+VERSION = 1
+
+SAMPLING_MODES = ["pairs", "unique", "stratified"]
+
+ARRAYS = [
+    "counts",
+    "values",
+    "line_ids",
+    "line_multiplicity",
+    "context_ids",
+    "unique_pairs",
+    "multiplicity",
+    "strata",
+    "stratum_counts",
+    "stratum_offsets",
+    "stratum_members",
+]
+
+
+def index_dir(source):
+    # compiled arrays live next to the text file they were built from
+    return os.path.join(os.path.dirname(source), "contexts")
+
+
+def source_hash(source):
+    with open(source, "rb") as source_file:
+        return hashlib.sha256(source_file.read()).hexdigest()
+
+
+def compile_contexts(source=SOURCE):
+    # parses the context file (one line per player: count value pairs for each
+    # item, two lines per game) into integer arrays and dedup maps
+    table = np.loadtxt(source, dtype=np.int16, ndmin=2)
+    num_pairs = len(table) // 2
+    table = table[: 2 * num_pairs].reshape(num_pairs, 2, -1)
+
+    counts = table[:, 0, 0::2]
+    values = table[:, :, 1::2]
+
+    # distinct player views (counts plus one player's values)
+    _, line_ids, line_multiplicity = np.unique(
+        table.reshape(2 * num_pairs, -1),
+        axis=0,
+        return_inverse=True,
+        return_counts=True,
+    )
+    line_ids = line_ids.reshape(num_pairs, 2)
+
+    # a game and the same game with the seats swapped are one context, since the
+    # starting player is drawn at random anyway
+    seat_order = np.sort(line_ids, axis=1)
+    _, unique_pairs, context_ids, multiplicity = np.unique(
+        seat_order,
+        axis=0,
+        return_index=True,
+        return_inverse=True,
+        return_counts=True,
+    )
+
+    # strata are the distinct item count vectors; members are stored grouped by
+    # stratum, so a stratum's pairs are one contiguous slice
+    _, strata, stratum_counts = np.unique(
+        counts, axis=0, return_inverse=True, return_counts=True
+    )
+    stratum_offsets = np.concatenate([[0], np.cumsum(stratum_counts)])
+    stratum_members = np.argsort(strata, kind="stable")
+
+    arrays = {
+        "counts": counts.astype(np.int16),
+        "values": values.astype(np.int16),
+        "line_ids": line_ids.astype(np.int32),
+        "line_multiplicity": line_multiplicity.astype(np.int32),
+        "context_ids": context_ids.reshape(-1).astype(np.int32),
+        "unique_pairs": unique_pairs.astype(np.int32),
+        "multiplicity": multiplicity.astype(np.int32),
+        "strata": strata.reshape(-1).astype(np.int32),
+        "stratum_counts": stratum_counts.astype(np.int32),
+        "stratum_offsets": stratum_offsets.astype(np.int32),
+        "stratum_members": stratum_members.astype(np.int32),
+    }
+
+    out_dir = index_dir(source)
+    os.makedirs(out_dir, exist_ok=True)
+    for name in ARRAYS:
+        tmp_path = tmp_path_for(f"{out_dir}/{name}.npy")
+        with open(tmp_path, "wb") as array_file:
+            np.save(array_file, arrays[name])
+        os.replace(tmp_path, f"{out_dir}/{name}.npy")
+
+    # the metadata is written last, so a half-written index is never trusted
+    atomic_write_json(
+        f"{out_dir}/meta.json",
+        {
+            "version": VERSION,
+            "source": os.path.basename(source),
+            "source_sha256": source_hash(source),
+            "source_mtime": os.path.getmtime(source),
+            "num_pairs": num_pairs,
+            "num_unique": len(multiplicity),
+            "num_lines": len(line_multiplicity),
+            "num_strata": len(stratum_counts),
+        },
+    )
+
+
+def is_current(source):
+    return meta_is_current(f"{index_dir(source)}/meta.json", source, VERSION)
+
+
+def meta_is_current(meta_path, source, version):
+    # whether the files described by meta_path were compiled from source as it is
+    # now, by the given version of the compiler
+    if not os.path.exists(meta_path):
+        return False
+    with open(meta_path, "r") as meta_file:
+        meta = json.load(meta_file)
+    if meta["version"] != version:
+        return False
+
+    # the hash is only checked when the modification time has moved
+    if meta["source_mtime"] == os.path.getmtime(source):
+        return True
+    return meta["source_sha256"] == source_hash(source)
+
+
+class ContextIndex:
+    """Compiled, memory-mapped game contexts with O(1) sampling.
+
+    A pair is a game as listed in the source file (counts plus both players'
+    values). Pairs that only differ by which player sits in which seat share a
+    context id, and pairs are stratified by their item counts.
+    """
+
+    def __init__(self, source=SOURCE):
+        if not is_current(source):
+            compile_contexts(source)
+
+        self.source = source
+        directory = index_dir(source)
+        for name in ARRAYS:
+            setattr(self, name, np.load(f"{directory}/{name}.npy", mmap_mode="r"))
+
+        self.num_pairs = len(self.counts)
+        self.num_unique = len(self.multiplicity)
+        self.num_strata = len(self.stratum_counts)
+
+    def __getstate__(self):
+        return {"source": self.source}
+
+    def __setstate__(self, state):
+        self.__init__(state["source"])
+
+    def sample(self, mode="pairs", rng=None):
+        # returns a pair index; without a generator, numpy's global state is used
+        integers = rng.integers if rng is not None else np.random.randint
+
+        if mode == "pairs":
+            # uniform over pairs; the last pair is left out, as it always has
+            # been, so that seeded runs keep drawing the same games
+            return int(integers(0, self.num_pairs - 1))
+        elif mode == "unique":
+            # uniform over contexts, whatever their multiplicity in the file
+            return int(self.unique_pairs[integers(0, self.num_unique)])
+        elif mode == "stratified":
+            # uniform over item count vectors, then over the pairs that have them
+            stratum = integers(0, self.num_strata)
+            start = self.stratum_offsets[stratum]
+            member = integers(0, self.stratum_counts[stratum])
+            return int(self.stratum_members[start + member])
+        raise Exception(f"invalid sampling mode: {mode}")
+
+    def context(self, pair_index):
+        # item counts and both players' values, as lists of ints
+        return (
+            self.counts[pair_index].tolist(),
+            self.values[pair_index, 0].tolist(),
+            self.values[pair_index, 1].tolist(),
+        )
+
+    def context_id(self, pair_index):
+        return int(self.context_ids[pair_index])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="compile the game context index")
+    parser.add_argument("-s", "--source", type=str, default=SOURCE)
+    args = parser.parse_args()
+
+    compile_contexts(args.source)
+    index = ContextIndex(args.source)
+    print(
+        f"{index.num_pairs} pairs, {index.num_unique} unique contexts, "
+        f"{len(index.line_multiplicity)} distinct lines, {index.num_strata} strata"
+    )
+
+
+if __name__ == "__main__":
+    main()
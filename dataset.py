@@ -0,0 +1,291 @@
+import argparse
+import hashlib
+import json
+import os
+from collections import Counter
+from multiprocessing import Pool
+
+import numpy as np
+
+import results_table
+from run_manifest import atomic_write_json
+from run_store import find_runs, open_run
+
+FILTERS = ["above_avg", "nonzero", "all"]
+
+LEDGER_VERSION = 1
+
+
+def score_cutoff(table, filter):
+    # players must score above the cutoff for their side of a game to be kept
+    if filter == "above_avg":
+        return np.mean(np.concatenate([table["p0_score"], table["p1_score"]]))
+    elif filter == "nonzero":
+        return 0
+    elif filter == "all":
+        return -100
+    else:
+        raise Exception(f"invalid filter: {filter}")
+
+
+def select_players(table, filter="above_avg", is_comp=False):
+    """Which players' sides of each game pass the filter, in one pass.
+
+    Returns a boolean array of shape (N, 2). Under the comp objective, a valid
+    deal where both players score 0 is kept as well.
+    """
+    cutoff = score_cutoff(table, filter)
+    scores = np.stack([table["p0_score"], table["p1_score"]], axis=1)
+    selected = scores > cutoff
+    if is_comp:
+        tied = (scores == 0).all(axis=1) & table["is_valid_deal"]
+        selected |= tied[:, None]
+    return selected
+
+
+def encode_sample(game_log):
+    return json.dumps({"messages": game_log}) + "\n"
+
+
+def sample_hash(line):
+    return hashlib.sha256(line.encode("utf-8")).hexdigest()[:32]
+
+
+def row_digest(row):
+    # identifies one version of a game; a replayed game gets a new row
+    return hashlib.blake2b(row.tobytes(), digest_size=8).hexdigest()
+
+
+def ledger_path(output_path):
+    return f"{output_path}.ledger"
+
+
+def output_state(output_path):
+    if not os.path.exists(output_path):
+        return None
+    info = os.stat(output_path)
+    return [info.st_size, info.st_mtime_ns]
+
+
+def load_ledger(output_path):
+    """The build ledger of a training file, or None if it cannot be trusted.
+
+    For every (run, game, player) already considered, the ledger records the
+    version of the game and the hash of the sample taken from it (or None), as
+    well as each run's filter and cutoff and the hashes of lines in the file
+    that no run accounts for. It is only used while the file is exactly as the
+    last build left it.
+    """
+    path = ledger_path(output_path)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as ledger_file:
+        ledger = json.load(ledger_file)
+    if ledger.get("version") != LEDGER_VERSION:
+        return None
+    if ledger["output"] != output_state(output_path):
+        return None
+    return ledger
+
+
+def update_run_samples(job):
+    """Worker: the changes to one run's samples since the last build.
+
+    Logs are only read for games that are new or were replayed, and for
+    players whose side of a game passes the filter now but did not before (when
+    the above_avg cutoff moves). Writes the read samples to a part file and
+    returns the run's new ledger entry and the hashes of the samples it drops.
+    """
+    dir_path, part_path, filter, is_comp, previous = job
+    table = results_table.load_table(dir_path)
+    selected = select_players(table, filter, is_comp)
+    previous_games = {} if previous is None else dict(previous["games"])
+
+    run = None
+    games = {}
+    dropped = []
+    num_read = 0
+    with open(part_path, "w") as part_file:
+        for row, players in zip(table, selected.tolist()):
+            index = int(row["index"])
+            digest = row_digest(row)
+            old = previous_games.pop(str(index), [None, None, None])
+            entry = [digest, None, None]
+            for player, wanted in enumerate(players):
+                old_hash = old[1 + player]
+                if old[0] == digest and wanted == (old_hash is not None):
+                    entry[1 + player] = old_hash
+                    continue
+                if old_hash is not None:
+                    dropped.append(old_hash)
+                if wanted:
+                    if run is None:
+                        run = open_run(dir_path)
+                    line = encode_sample(run.log(f"{index:03d}", player))
+                    part_file.write(line)
+                    entry[1 + player] = sample_hash(line)
+                    num_read += 1
+            games[str(index)] = entry
+
+    if run is not None:
+        run.close()
+
+    # games that are no longer in the run
+    for old in previous_games.values():
+        dropped.extend(old_hash for old_hash in old[1:] if old_hash is not None)
+
+    run_ledger = {
+        "filter": filter,
+        "is_comp": is_comp,
+        "cutoff": float(score_cutoff(table, filter)),
+        "games": games,
+    }
+    return part_path, run_ledger, dropped, num_read
+
+
+def build_dataset(
+    dir_paths, output_path, filter="above_avg", is_comp=False, workers=None
+):
+    """Builds (or updates) one training file from the games of several runs.
+
+    A ledger next to the file (see load_ledger) lets a build read only the
+    games that are new since the last one, plus the samples whose inclusion
+    changed because a data-dependent cutoff moved; samples that no longer pass
+    the filter are taken out. Runs are processed in parallel, each into its own
+    part file, and merged in the order of dir_paths. Samples already in the
+    file (or repeated across runs) are skipped by content hash. New samples are
+    appended; when samples are taken out, or the file has no matching ledger,
+    it is rewritten and replaced atomically. Returns the number of samples
+    added.
+    """
+    ledger = load_ledger(output_path)
+    resync = ledger is None
+    if resync:
+        # every game is new; lines already in the file are kept as they are
+        ledger = {"version": LEDGER_VERSION, "output": None, "extra": [], "runs": {}}
+        if os.path.exists(output_path):
+            with open(output_path, "r") as output_file:
+                ledger["extra"] = [
+                    sample_hash(line) for line in output_file if line.endswith("\n")
+                ]
+    extra = set(ledger["extra"])
+
+    # the number of ledger samples with each hash; the file holds every hash
+    # with a count, and the extra lines
+    counts = Counter()
+    for run_ledger in ledger["runs"].values():
+        for entry in run_ledger["games"].values():
+            counts.update(digest for digest in entry[1:] if digest is not None)
+    present = extra | set(counts)
+
+    run_keys = [os.path.abspath(dir_path) for dir_path in dir_paths]
+    jobs = [
+        (
+            dir_path,
+            f"{output_path}.part{number}",
+            filter,
+            is_comp,
+            ledger["runs"].get(key),
+        )
+        for number, (dir_path, key) in enumerate(zip(dir_paths, run_keys))
+    ]
+    additions_path = f"{output_path}.additions"
+    tmp_path = f"{output_path}.tmp"
+
+    try:
+        # new samples, in run order
+        added = set()
+        with open(additions_path, "w") as additions_file, Pool(workers) as pool:
+            results = pool.imap(update_run_samples, jobs)
+            for dir_path, key, result in zip(dir_paths, run_keys, results):
+                part_path, run_ledger, dropped, num_read = result
+                counts.subtract(dropped)
+                with open(part_path, "r") as part_file:
+                    for line in part_file:
+                        digest = sample_hash(line)
+                        counts[digest] += 1
+                        if digest not in present and digest not in added:
+                            added.add(digest)
+                            additions_file.write(line)
+                os.remove(part_path)
+                ledger["runs"][key] = run_ledger
+                print(
+                    f"{dir_path}: {len(run_ledger['games'])} games, "
+                    f"{num_read} samples read, {len(dropped)} dropped "
+                    f"(cutoff {run_ledger['cutoff']:.4f})"
+                )
+
+        def keep(digest):
+            return digest in extra or counts[digest] > 0
+
+        removed = {digest for digest in present if not keep(digest)}
+        added = {digest for digest in added if keep(digest)}
+        if removed or resync:
+            # copy the kept lines, then the new ones, into a new file
+            written = set()
+            with open(tmp_path, "w") as tmp_file:
+                for path in [output_path, additions_path]:
+                    if not os.path.exists(path):
+                        continue
+                    with open(path, "r") as lines:
+                        for line in lines:
+                            # a line torn by a crash is left out
+                            if not line.endswith("\n"):
+                                continue
+                            digest = sample_hash(line)
+                            if keep(digest) and digest not in written:
+                                written.add(digest)
+                                tmp_file.write(line)
+                tmp_file.flush()
+                os.fsync(tmp_file.fileno())
+            os.replace(tmp_path, output_path)
+        else:
+            with open(output_path, "a") as output_file, open(
+                additions_path, "r"
+            ) as additions_file:
+                for line in additions_file:
+                    if sample_hash(line) in added:
+                        output_file.write(line)
+                output_file.flush()
+                os.fsync(output_file.fileno())
+
+        # lines that a run now accounts for are no longer extra
+        ledger["extra"] = sorted(digest for digest in extra if counts[digest] <= 0)
+        ledger["output"] = output_state(output_path)
+        atomic_write_json(ledger_path(output_path), ledger)
+    finally:
+        for path in [job[1] for job in jobs] + [additions_path, tmp_path]:
+            if os.path.exists(path):
+                os.remove(path)
+
+    print(f"{len(added)} samples added, {len(removed)} removed")
+    return len(added)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="build a fine-tuning dataset from the games of self-play runs"
+    )
+    parser.add_argument(
+        "-r", "--runs", type=str, nargs="+", help="Run directories (globs allowed)"
+    )
+    parser.add_argument("--output", type=str, help="Training file (JSONL) to build")
+    parser.add_argument(
+        "-f", "--filter", type=str, default="above_avg", choices=FILTERS, help="Filter"
+    )
+    parser.add_argument(
+        "-o", "--objective", type=str, default="self", help="Objective"
+    )
+    parser.add_argument(
+        "-w", "--workers", type=int, default=None, help="Number of worker processes"
+    )
+    args = parser.parse_args()
+
+    dir_paths = find_runs(args.runs)
+    build_dataset(
+        dir_paths, args.output, args.filter, args.objective == "comp", args.workers
+    )
+
+
+if __name__ == "__main__":
+    main()
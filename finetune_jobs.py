@@ -0,0 +1,306 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+
+import openai
+
+import backends
+from run_manifest import atomic_write_json
+
+LEDGER_PATH = "data/finetune_ledger.json"
+
+# files larger than one chunk go through the multipart uploads endpoint
+CHUNK_SIZE = 64 * 1024 * 1024
+
+HYPERPARAMETERS = {"n_epochs": 3, "batch_size": 1, "learning_rate_multiplier": 8}
+
+FINAL_STATUSES = ["succeeded", "failed", "cancelled"]
+
+
+def file_hash(path, chunk_size=CHUNK_SIZE):
+    # sha256 of a file's contents, read in chunks
+    digest = hashlib.sha256()
+    with open(path, "rb") as data_file:
+        while chunk := data_file.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_key(content_hash, base_url):
+    # uploads of the same contents to the same API
+    return json.dumps([content_hash, base_url])
+
+
+def job_entry(base_url, job_id):
+    # job ids are only unique within one API
+    return json.dumps([base_url, job_id])
+
+
+def job_key(content_hash, model, suffix, hyperparameters, base_url):
+    # jobs that would train the same model on the same data, on the same API
+    return json.dumps(
+        [content_hash, model, suffix, hyperparameters, base_url], sort_keys=True
+    )
+
+
+def is_transient(error):
+    # errors worth polling again for, after backing off
+    if isinstance(error, (openai.APIConnectionError, openai.APITimeoutError)):
+        return True
+    return isinstance(error, openai.APIStatusError) and (
+        error.status_code == 429 or error.status_code >= 500
+    )
+
+
+class JobLedger:
+    """Local record of uploaded training files and fine-tuning jobs.
+
+    Files are keyed by the sha256 of their contents and the API they were
+    uploaded to, so the same data is uploaded once per API; jobs are keyed by
+    the API and their id, and record the data, model and settings they were
+    created with, and their last known status.
+    """
+
+    def __init__(self, path=LEDGER_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.files = {}
+        self.jobs = {}
+        if os.path.exists(path):
+            with open(path, "r") as ledger_file:
+                ledger = json.load(ledger_file)
+            self.files, self.jobs = ledger["files"], ledger["jobs"]
+
+    def save(self):
+        with self.lock:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            atomic_write_json(self.path, {"files": self.files, "jobs": self.jobs})
+
+    def find_job(self, key):
+        # the newest job for the same data and settings that has not failed
+        jobs = [
+            job
+            for job in self.jobs.values()
+            if job["key"] == key and job["status"] not in ["failed", "cancelled"]
+        ]
+        return max(jobs, key=lambda job: job["created_at"], default=None)
+
+    def unfinished_jobs(self, base_url):
+        return [
+            job["id"]
+            for job in self.jobs.values()
+            if job["status"] not in FINAL_STATUSES and job.get("base_url") == base_url
+        ]
+
+
+class JobManager:
+    """Uploads training files and runs fine-tuning jobs, recorded in a ledger.
+
+    A training file whose contents were uploaded before is not uploaded again
+    (as long as the uploaded file still exists), and submitting the same data
+    with the same model and settings returns the existing job instead of
+    starting another one. Only files and jobs of the API the client talks to
+    are reused, so one ledger can be shared with e.g. a mock server.
+    """
+
+    def __init__(self, client=None, ledger=None, chunk_size=CHUNK_SIZE):
+        self.client = client if client is not None else backends.get_client()
+        self.ledger = ledger if ledger is not None else JobLedger()
+        self.chunk_size = chunk_size
+        self.base_url = str(self.client.base_url)
+
+    def uploaded_file(self, content_hash):
+        # the id of an earlier upload of the same contents, if it is still usable
+        key = file_key(content_hash, self.base_url)
+        entry = self.ledger.files.get(key)
+        if entry is None:
+            return None
+        try:
+            remote = self.client.files.retrieve(entry["file_id"])
+        except openai.NotFoundError:
+            remote = None
+        if remote is None or remote.status == "error":
+            del self.ledger.files[key]
+            return None
+        return entry["file_id"]
+
+    def upload(self, path):
+        # uploads a training file unless the same contents are already uploaded
+        content_hash = file_hash(path, self.chunk_size)
+        file_id = self.uploaded_file(content_hash)
+        if file_id is not None:
+            return file_id, content_hash, False
+
+        size = os.path.getsize(path)
+        if size > self.chunk_size:
+            file_id = self.upload_in_parts(path, size)
+        else:
+            with open(path, "rb") as data_file:
+                file_id = self.client.files.create(
+                    file=data_file, purpose="fine-tune"
+                ).id
+
+        self.ledger.files[file_key(content_hash, self.base_url)] = {
+            "file_id": file_id,
+            "base_url": self.base_url,
+            "path": path,
+            "bytes": size,
+            "uploaded_at": time.time(),
+        }
+        self.ledger.save()
+        return file_id, content_hash, True
+
+    def upload_in_parts(self, path, size):
+        # one part per chunk of the file, then the parts are joined by the API
+        upload = self.client.uploads.create(
+            bytes=size,
+            filename=os.path.basename(path),
+            mime_type="text/jsonl",
+            purpose="fine-tune",
+        )
+        part_ids = []
+        md5 = hashlib.md5()
+        with open(path, "rb") as data_file:
+            while chunk := data_file.read(self.chunk_size):
+                md5.update(chunk)
+                part = self.client.uploads.parts.create(upload.id, data=chunk)
+                part_ids.append(part.id)
+        upload = self.client.uploads.complete(
+            upload.id, part_ids=part_ids, md5=md5.hexdigest()
+        )
+        return upload.file.id
+
+    def submit(self, path, model, suffix, hyperparameters=None):
+        """Starts a fine-tuning job on a training file, or finds the one running.
+
+        Returns the ledger record of the job.
+        """
+        if hyperparameters is None:
+            hyperparameters = HYPERPARAMETERS
+        file_id, content_hash, uploaded = self.upload(path)
+        print(f"{path}: {'uploaded as' if uploaded else 'reusing'} {file_id}")
+
+        key = job_key(content_hash, model, suffix, hyperparameters, self.base_url)
+        job = self.ledger.find_job(key)
+        if job is not None:
+            print(f"reusing job {job['id']} ({job['status']})")
+            return job
+
+        response = self.client.fine_tuning.jobs.create(
+            model=model,
+            training_file=file_id,
+            hyperparameters=hyperparameters,
+            suffix=suffix,
+        )
+        job = {
+            "id": response.id,
+            "key": key,
+            "base_url": self.base_url,
+            "model": model,
+            "suffix": suffix,
+            "training_file": file_id,
+            "content_hash": content_hash,
+            "hyperparameters": hyperparameters,
+            "status": response.status,
+            "fine_tuned_model": response.fine_tuned_model,
+            "created_at": time.time(),
+            "updated_at": time.time(),
+        }
+        self.ledger.jobs[job_entry(self.base_url, job["id"])] = job
+        self.ledger.save()
+        print(f"started job {job['id']}")
+        return job
+
+    def record_status(self, job_id, response):
+        job = self.ledger.jobs[job_entry(self.base_url, job_id)]
+        changed = job["status"] != response.status
+        job["status"] = response.status
+        job["fine_tuned_model"] = response.fine_tuned_model
+        job["error"] = None if response.error is None else response.error.message
+        job["updated_at"] = time.time()
+        if changed:
+            self.ledger.save()
+            print(f"job {job_id}: {response.status}")
+        return changed
+
+    async def poll_job(self, job_id, interval, max_interval, backoff):
+        # polls one job until it finishes; the delay grows while nothing changes
+        delay = interval
+        while True:
+            try:
+                response = await asyncio.to_thread(
+                    self.client.fine_tuning.jobs.retrieve, job_id
+                )
+            except Exception as error:
+                if not is_transient(error):
+                    raise
+                changed = False
+            else:
+                changed = self.record_status(job_id, response)
+                if response.status in FINAL_STATUSES:
+                    return self.ledger.jobs[job_entry(self.base_url, job_id)]
+
+            delay = interval if changed else min(delay * backoff, max_interval)
+            await asyncio.sleep(delay * random.uniform(0.5, 1.0))
+
+    async def poll_jobs(self, job_ids, interval=10, max_interval=300, backoff=1.5):
+        return await asyncio.gather(
+            *[
+                self.poll_job(job_id, interval, max_interval, backoff)
+                for job_id in job_ids
+            ]
+        )
+
+    def wait(self, job_ids=None, interval=10, max_interval=300, backoff=1.5):
+        """Polls jobs concurrently until they finish (every unfinished job of
+        this API in the ledger by default). Returns their ledger records."""
+        if job_ids is None:
+            job_ids = self.ledger.unfinished_jobs(self.base_url)
+        return asyncio.run(self.poll_jobs(job_ids, interval, max_interval, backoff))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="upload training files and manage fine-tuning jobs"
+    )
+    parser.add_argument("-f", "--file", type=str, default=None, help="Training file")
+    parser.add_argument("-m", "--model", type=str, help="Model to train")
+    parser.add_argument("-s", "--suffix", type=str, help="Output model suffix")
+    parser.add_argument(
+        "--wait", action="store_true", help="Poll jobs until they have finished"
+    )
+    parser.add_argument(
+        "--status", action="store_true", help="Print the jobs in the ledger"
+    )
+    parser.add_argument(
+        "--ledger", type=str, default=LEDGER_PATH, help="Ledger of files and jobs"
+    )
+    parser.add_argument(
+        "--interval", type=float, default=10, help="Initial polling interval (seconds)"
+    )
+    args = parser.parse_args()
+
+    manager = JobManager(ledger=JobLedger(args.ledger))
+    job_ids = None
+    if args.file is not None:
+        job_ids = [manager.submit(args.file, args.model, args.suffix)["id"]]
+    if args.wait:
+        manager.wait(job_ids, interval=args.interval)
+    if args.status:
+        for job in manager.ledger.jobs.values():
+            model = job["fine_tuned_model"] or "-"
+            print(
+                f"{job['id']} ({job.get('base_url')}): "
+                f"{job['status']} {job['model']} -> {model}"
+            )
+
+
+if __name__ == "__main__":
+    main()
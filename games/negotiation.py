@@ -1,6 +1,8 @@
-import re
+import itertools
 import numpy as np
-from transformers import GPT2Tokenizer
+import prompt_registry
+import token_accounting
+from items import DEFAULT_SCHEMA
 
 class NegotiationGame:
     """Tracks game state for the cooperative dialog game."""
@@ -13,10 +15,19 @@ class NegotiationGame:
         p2_values=None,
         game_log_filename=None,
         objective="self",
+        rng=None,
+        schema=None,
+        prompt_layout="original",
     ):
         # env_config should have hyperparameters that are not random
         self.game_index = game_index
 
+        # item types of the game (books, hats, and balls unless given)
+        self.schema = schema if schema is not None else DEFAULT_SCHEMA
+
+        # per-game random generator; falls back to the global numpy RNG when unset
+        self.rng = rng
+
         if item_counts == None:
             self.item_counts = {"book": 1, "hat": 2, "ball": 3}
         else:
@@ -40,50 +51,29 @@ class NegotiationGame:
         self.deal_proposed = False
         self.game_over = False
 
-        # logging
+        # logging (kept in memory as well, and only in memory if no file is given)
         self.game_log_filename = game_log_filename
+        self.log_text = []
 
-        # system prompt
+        # system prompt; games with other items use the prompts that describe
+        # the items from the schema
         self.objective = objective
-        if self.objective == "self":
-            self.prompt_path = "prompts/dond.txt"
-        elif self.objective == "coop":
-            self.prompt_path = "prompts/coop_dond.txt"
-        elif self.objective == "comp":
-            self.prompt_path = "prompts/comp_dond.txt"
-        else:
-            raise Exception("invalid objective")
+        self.prompt_path = prompt_registry.prompt_path(objective, self.schema)
+        self.prompt_layout = prompt_layout
 
         # write the initial context to the game log
-        item_context = "Item counts: there are {book_cnt} books, {hat_cnt} hats, and {ball_cnt} balls.\n"
-        value_context = "Player {player_index} values: books are worth {book_val} points, hats are worth {hat_val} points, and balls are worth {ball_val} points.\n"
-
-        f = open(self.game_log_filename, "a")
-        f.write(
-            item_context.format(
-                book_cnt=self.item_counts["book"],
-                hat_cnt=self.item_counts["hat"],
-                ball_cnt=self.item_counts["ball"],
-            )
-        )
-        f.write(
-            value_context.format(
-                player_index=0,
-                book_val=self.player_values[0]["book"],
-                hat_val=self.player_values[0]["hat"],
-                ball_val=self.player_values[0]["ball"],
-            )
-        )
-        f.write(
-            value_context.format(
-                player_index=1,
-                book_val=self.player_values[1]["book"],
-                hat_val=self.player_values[1]["hat"],
-                ball_val=self.player_values[1]["ball"],
-            )
+        self.write_log(
+            f"Item counts: there are {self.schema.counts_text(self.item_counts)}.\n"
+            + f"Player 0 values: {self.schema.values_text(self.player_values[0])}.\n"
+            + f"Player 1 values: {self.schema.values_text(self.player_values[1])}.\n"
+            + "\n\n"
         )
-        f.write("\n\n")
-        f.close()
+
+    def write_log(self, text):
+        self.log_text.append(text)
+        if self.game_log_filename is not None:
+            with open(self.game_log_filename, "a") as f:
+                f.write(text)
 
     def isValidDeal(self):
         p1_cnts = self.proposals[0]
@@ -126,11 +116,12 @@ class NegotiationGame:
     def isParetoOptimal(self, p1_values, p2_values, p1_cnts, p2_cnts):
         # checks for pareto optimality of proposal given the players' values
         # iterate through all possible allocations
-        allocations = []
-        for i in range(self.item_counts["book"] + 1):
-            for j in range(self.item_counts["hat"] + 1):
-                for k in range(self.item_counts["ball"] + 1):
-                    allocations.append({"book": i, "hat": j, "ball": k})
+        allocations = [
+            dict(zip(self.item_counts.keys(), counts))
+            for counts in itertools.product(
+                *[range(count + 1) for count in self.item_counts.values()]
+            )
+        ]
 
         p1_current_utility = self.calculateScore(p1_values, p1_cnts)
         p2_current_utility = self.calculateScore(p2_values, p2_cnts)
@@ -163,16 +154,13 @@ class NegotiationGame:
         return True
 
     def parse_proposal(self, text):
-        # assume it looks like (x, y, z)
-        # use regex
-        counts = re.findall(r"\d+", text)
-
-        return {"book": int(counts[0]), "hat": int(counts[1]), "ball": int(counts[2])}
+        return self.schema.parse_proposal(text)
 
     def play_game(self, player_agents):
 
         # turn player chosen uniformly randomly
-        turn = 0 if np.random.rand() > 0.5 else 1
+        coin = self.rng.random() if self.rng is not None else np.random.rand()
+        turn = 0 if coin > 0.5 else 1
 
         player_prompts = [
             player_agents[0].messages_json,
@@ -181,65 +169,17 @@ class NegotiationGame:
         logs = [player_agents[0].messages_log, player_agents[1].messages_log]
         messages = []
 
-        # first, append the prefix message
-        with open(self.prompt_path, "r") as system_prompt_file:
-            system_text = system_prompt_file.read()
-
-        player_prompts[0].append(
-            {
-                "role": "system",
-                "content": system_text.format(
-                    book_cnt=self.item_counts["book"],
-                    hat_cnt=self.item_counts["hat"],
-                    ball_cnt=self.item_counts["ball"],
-                    book_val=self.player_values[0]["book"],
-                    hat_val=self.player_values[0]["hat"],
-                    ball_val=self.player_values[0]["ball"],
-                ),
-            }
-        )
-
-        player_prompts[1].append(
-            {
-                "role": "system",
-                "content": system_text.format(
-                    book_cnt=self.item_counts["book"],
-                    hat_cnt=self.item_counts["hat"],
-                    ball_cnt=self.item_counts["ball"],
-                    book_val=self.player_values[1]["book"],
-                    hat_val=self.player_values[1]["hat"],
-                    ball_val=self.player_values[1]["ball"],
-                ),
-            }
-        )
-
-        logs[0].append(
-            {
-                "role": "system",
-                "content": system_text.format(
-                    book_cnt=self.item_counts["book"],
-                    hat_cnt=self.item_counts["hat"],
-                    ball_cnt=self.item_counts["ball"],
-                    book_val=self.player_values[0]["book"],
-                    hat_val=self.player_values[0]["hat"],
-                    ball_val=self.player_values[0]["ball"],
-                ),
-            }
-        )
+        # first, append the prefix message; the template is read once per process
+        template = prompt_registry.get_registry().template(self.prompt_path)
 
-        logs[1].append(
-            {
-                "role": "system",
-                "content": system_text.format(
-                    book_cnt=self.item_counts["book"],
-                    hat_cnt=self.item_counts["hat"],
-                    ball_cnt=self.item_counts["ball"],
-                    book_val=self.player_values[1]["book"],
-                    hat_val=self.player_values[1]["hat"],
-                    ball_val=self.player_values[1]["ball"],
-                ),
-            }
-        )
+        # each player's system prompt, filled in with their own values
+        for player in range(2):
+            system_prompt = template.render(
+                self.schema.prompt_fields(self.item_counts, self.player_values[player]),
+                self.prompt_layout,
+            )
+            player_prompts[player].append({"role": "system", "content": system_prompt})
+            logs[player].append({"role": "system", "content": system_prompt})
 
         while not self.game_over:
             # assign turn player and other player
@@ -252,8 +192,7 @@ class NegotiationGame:
 
             # append to files
 
-            with open(self.game_log_filename, "a") as full_log:
-                full_log.write("Player " + str(turn) + ": " + response_text + "\n")
+            self.write_log("Player " + str(turn) + ": " + response_text + "\n")
 
             # check for abort message
             if response_text.strip() == "[ABORT]":
@@ -297,9 +236,10 @@ class NegotiationGame:
 
         self.calculateFinalScores()
 
-        with open(self.game_log_filename, "a") as full_log:
-            full_log.write(f"Player 0 FINAL SCORE: {self.final_scores[0]} \n")
-            full_log.write(f"Player 1 FINAL SCORE: {self.final_scores[1]} \n")
+        self.write_log(
+            f"Player 0 FINAL SCORE: {self.final_scores[0]} \n"
+            + f"Player 1 FINAL SCORE: {self.final_scores[1]} \n"
+        )
 
         print("Player 1 FINAL SCORE:", self.final_scores[0])
         print("Player 2 FINAL SCORE:", self.final_scores[1])
@@ -307,12 +247,12 @@ class NegotiationGame:
         print()
 
         # track token and message counts
-        token_cnt = 0
-        tokenizer = GPT2Tokenizer.from_pretrained("gpt2")
+        token_cnt = token_accounting.total_tokens(messages)
 
-        for message in messages:
-            tokens = tokenizer.encode(message)
-            token_cnt += len(tokens)
+        # provider-reported usage across every API call made by both players
+        usage = None
+        for agent in player_agents:
+            usage = token_accounting.add_usage(usage, getattr(agent, "usage", None))
 
         game_outcome = {
             "p0_score": self.final_scores[0],
@@ -322,6 +262,8 @@ class NegotiationGame:
             "is_valid_deal": self.isValidDeal(),
             "msg_cnt": len(messages),
             "token_cnt": token_cnt,
+            "usage": usage,
+            "aborted": any("[ABORT]" in message for message in messages),
         }
 
         return game_outcome
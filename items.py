@@ -0,0 +1,178 @@
+import re
+
+DEFAULT_ITEMS = ["book", "hat", "ball"]
+
+NUMBER_WORDS = [
+    "zero",
+    "one",
+    "two",
+    "three",
+    "four",
+    "five",
+    "six",
+    "seven",
+    "eight",
+    "nine",
+    "ten",
+]
+
+# placeholder letters for the item counts in the proposal format of the prompts
+FORMAT_LETTERS = "xyzabcdefghijklmnopqrstuvw"
+
+
+def join_list(parts, conjunction="and"):
+    # "a", "a and b", "a, b, and c"
+    if len(parts) <= 2:
+        return f" {conjunction} ".join(parts)
+    return ", ".join(parts[:-1]) + f", {conjunction} " + parts[-1]
+
+
+class ItemSchema:
+    """The item types of a negotiation game, in the order proposals list them.
+
+    Items are named in the singular; the plural (name + "s" unless given) is
+    used in logs, prompts and proposals. Counts, values and allocations are
+    dicts keyed by item name, in schema order.
+    """
+
+    def __init__(self, names=DEFAULT_ITEMS, plurals=None):
+        if len(names) == 0 or len(set(names)) != len(names):
+            raise Exception(f"invalid item names: {names}")
+        if plurals is None:
+            plurals = [f"{name}s" for name in names]
+        self.names = list(names)
+        self.plurals = list(plurals)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, ItemSchema)
+            and self.names == other.names
+            and self.plurals == other.plurals
+        )
+
+    def is_default(self):
+        return self == DEFAULT_SCHEMA
+
+    def to_dict(self, vector):
+        return {name: int(value) for name, value in zip(self.names, vector)}
+
+    def to_vector(self, items):
+        return [items[name] for name in self.names]
+
+    def counts_text(self, counts):
+        # "1 books, 2 hats, and 3 balls"
+        return join_list(
+            [
+                f"{counts[name]} {plural}"
+                for name, plural in zip(self.names, self.plurals)
+            ]
+        )
+
+    def values_text(self, values, unit=" points"):
+        # "books are worth 1 points, hats are worth 3 points, and balls are ..."
+        return join_list(
+            [
+                f"{plural} are worth {values[name]}{unit}"
+                for name, plural in zip(self.names, self.plurals)
+            ]
+        )
+
+    def example_text(self, counts):
+        # "1 book, 2 hats, and 0 balls", with singular names for single items
+        return join_list(
+            [
+                f"{count} {name if count == 1 else plural}"
+                for count, name, plural in zip(counts, self.names, self.plurals)
+            ]
+        )
+
+    def proposal_text(self, counts):
+        # "1 books, 2 hats, 0 balls", as a proposal lists them
+        return ", ".join(
+            f"{count} {plural}" for count, plural in zip(counts, self.plurals)
+        )
+
+    def prompt_fields(self, counts, values):
+        # format fields for the system prompts: "{name}_cnt" and "{name}_val" for
+        # each item (as the three-item prompts use them), and whole phrases for
+        # the prompts that work with any schema
+        fields = {}
+        for name in self.names:
+            fields[f"{name}_cnt"] = counts[name]
+            fields[f"{name}_val"] = values[name]
+
+        # worked examples: one proposal, a complementary one, and their total
+        own = [[1, 2, 0][i % 3] for i in range(len(self))]
+        partner = [[2, 0, 1][i % 3] for i in range(len(self))]
+        total = [a + b for a, b in zip(own, partner)]
+        letters = list(FORMAT_LETTERS[: len(self)])
+
+        fields.update(
+            {
+                "items": join_list(self.plurals),
+                "item_counts": self.counts_text(counts),
+                "item_values": self.values_text(values, unit=""),
+                "proposal_format": self.proposal_text(letters),
+                "proposal_letters": join_list(letters),
+                "example_wanted": self.example_text(own),
+                "example_proposal": self.proposal_text(own),
+                "example_total": self.example_text(total),
+                "example_partner": self.proposal_text(partner),
+            }
+        )
+        return fields
+
+    def parse_proposal(self, text):
+        # assume it looks like (x, y, z)
+        counts = re.findall(r"\d+", text)
+        return {name: int(count) for name, count in zip(self.names, counts)}
+
+    def check_proposal(self, proposal, item_counts):
+        # returns (is_valid, error message) for the text after [propose]
+
+        # assert that we refer to all of the items and in the correct order
+        indices = [proposal.find(name) for name in self.names]
+        if not (indices[0] > -1 and indices == sorted(set(indices))):
+            return (
+                False,
+                "Item counts must be sequenced in the following order: "
+                + join_list(self.plurals, conjunction="and then")
+                + ".",
+            )
+
+        # get the quantities as integers (not strings)
+        quantities = [int(x) for x in re.findall(r"\d+", proposal)]
+
+        # make sure we have one integer per item in our proposal message
+        if len(quantities) != len(self):
+            number = (
+                NUMBER_WORDS[len(self)] if len(self) < len(NUMBER_WORDS) else len(self)
+            )
+            return (
+                False,
+                f"There should only be counts for {number} items in your proposal: "
+                + join_list(self.plurals)
+                + ".",
+            )
+
+        # make sure the quantities are within valid range, given the game item counts
+        if not all(
+            0 <= quantity <= item_counts[name]
+            for quantity, name in zip(quantities, self.names)
+        ):
+            return (
+                False,
+                "Item counts suggested are invalid based on game context; some of your proposal's item counts are greater than total items available.",
+            )
+        return True, ""
+
+
+DEFAULT_SCHEMA = ItemSchema()
+
+
+def schema_from_items(items):
+    # a schema for a list of item names, or for the keys of a counts dict
+    return ItemSchema(list(items))
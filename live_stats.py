@@ -0,0 +1,327 @@
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+import analysis
+import bargaining
+import results_table
+from run_manifest import COMPLETE, FAILED, RunManifest, atomic_write_json
+from run_store import STORE_FILE
+
+STATE_FILE = "live_stats.json"
+STATE_VERSION = 1
+
+# running sums kept for every game; the score histograms hold the count of each
+# score, which is an exact sketch for medians and above-average stats since
+# scores are small integers
+SUMS = [
+    "num_games",
+    "message_sum",
+    "token_sum",
+    "num_aborts",
+    "num_agreements",
+    "agreement_message_sum",
+    "agreement_token_sum",
+    "num_optimal",
+    "dominance_margin_sum",
+    "frontier_distance_sum",
+]
+
+
+def empty_stats():
+    stats = {name: 0 for name in SUMS}
+    stats["solution_distance_sums"] = [0.0] * len(bargaining.SOLUTIONS)
+    stats["score_histogram"] = {}
+    stats["agreement_histogram"] = {}
+    return stats
+
+
+def empty_state(objective):
+    return {
+        "version": STATE_VERSION,
+        "objective": objective,
+        "table": None,
+        "rows": 0,
+        "positions": {},
+        "stats": empty_stats(),
+    }
+
+
+def load_state(dir_path, objective):
+    # the saved state, or a fresh one if it is missing or was kept for another
+    # objective
+    path = f"{dir_path}/{STATE_FILE}"
+    if os.path.exists(path):
+        with open(path, "r") as state_file:
+            state = json.load(state_file)
+        if state.get("version") == STATE_VERSION and state["objective"] == objective:
+            return state
+    return empty_state(objective)
+
+
+def add_to_histogram(histogram, scores, sign):
+    values, counts = np.unique(scores, return_counts=True)
+    for value, count in zip(values.tolist(), counts.tolist()):
+        key = str(value)
+        histogram[key] = histogram.get(key, 0) + sign * count
+        if histogram[key] == 0:
+            del histogram[key]
+
+
+def fold_rows(stats, rows, objective, sign=1):
+    # adds (or, with sign=-1, removes) the contribution of some table rows
+    if len(rows) == 0:
+        return
+    p0_scores, p1_scores = rows["p0_score"], rows["p1_score"]
+    agreement = rows["is_valid_deal"]
+
+    stats["num_games"] += sign * len(rows)
+    stats["message_sum"] += sign * int(rows["message_count"].sum())
+    stats["token_sum"] += sign * int(rows["token_count"].sum())
+    stats["num_aborts"] += sign * int(np.count_nonzero(rows["aborted"]))
+    add_to_histogram(
+        stats["score_histogram"], np.concatenate([p0_scores, p1_scores]), sign
+    )
+
+    stats["num_agreements"] += sign * int(np.count_nonzero(agreement))
+    agreement_messages = rows["message_count"][agreement]
+    stats["agreement_message_sum"] += sign * int(agreement_messages.sum())
+    stats["agreement_token_sum"] += sign * int(rows["token_count"][agreement].sum())
+    add_to_histogram(
+        stats["agreement_histogram"],
+        np.concatenate([p0_scores[agreement], p1_scores[agreement]]),
+        sign,
+    )
+
+    # the same pareto and distance measures as analyze(), on these rows only
+    measures = analysis.game_measures(rows, objective)
+    stats["num_optimal"] += sign * int(np.count_nonzero(measures["is_optimal"]))
+    stats["dominance_margin_sum"] += sign * float(measures["dominance_margin"].sum())
+    stats["frontier_distance_sum"] += sign * float(
+        measures["frontier_distance"].sum()
+    )
+    stats["solution_distance_sums"] = [
+        total + sign * float(measures[f"{solution}_distance"].sum())
+        for total, solution in zip(
+            stats["solution_distance_sums"], bargaining.SOLUTIONS
+        )
+    ]
+
+
+def table_identity(path):
+    # a table that was rebuilt is a new file, so everything is folded in again
+    info = os.stat(path)
+    return [info.st_ino, results_table.read_header(path)]
+
+
+def update(dir_path, objective="self"):
+    """Folds the games finished since the last update into the run's state.
+
+    Only rows appended to results.bin since the last call are read. A replayed
+    game's new row replaces its old one, whose contribution is taken back out.
+    The state is saved to live_stats.json in the run directory and returned.
+    """
+    state = load_state(dir_path, objective)
+    path = f"{dir_path}/{results_table.TABLE_FILE}"
+    if not os.path.exists(path) or results_table.read_header(path) is None:
+        # a run in progress writes (or rebuilds) its own table as games finish;
+        # finished runs from before the table existed get one now
+        started = os.path.exists(f"{dir_path}/p0_scores") or os.path.exists(
+            f"{dir_path}/{STORE_FILE}"
+        )
+        running = RunManifest.exists(dir_path) and not run_finished(dir_path)
+        if running or not started:
+            return state
+        results_table.load_table(dir_path)
+        if not os.path.exists(path):
+            return state
+
+    identity = table_identity(path)
+    if state["table"] != identity:
+        state = empty_state(objective)
+        state["table"] = identity
+
+    # rows are fixed width, so the full rows so far can be mapped without a copy;
+    # a row torn by a crash is left out until it is rewritten
+    dtype = results_table.table_dtype(identity[1])
+    num_rows = (os.path.getsize(path) - results_table.HEADER_SIZE) // dtype.itemsize
+    if num_rows > state["rows"]:
+        rows = np.memmap(
+            path,
+            dtype=dtype,
+            mode="r",
+            offset=results_table.HEADER_SIZE,
+            shape=(num_rows,),
+        )
+        new = np.arange(state["rows"], num_rows)
+
+        # the last row of each game wins, as in results_table.latest_rows
+        _, last = np.unique(rows["index"][new][::-1], return_index=True)
+        new = new[::-1][last]
+        indices = [str(index) for index in rows["index"][new].tolist()]
+
+        positions = state["positions"]
+        replaced = [positions[index] for index in indices if index in positions]
+        fold_rows(state["stats"], rows[replaced], objective, sign=-1)
+        fold_rows(state["stats"], rows[new], objective)
+
+        positions.update(zip(indices, new.tolist()))
+        state["rows"] = num_rows
+        del rows
+
+    atomic_write_json(f"{dir_path}/{STATE_FILE}", state)
+    return state
+
+
+def histogram_scores(histogram):
+    # sorted scores and their counts
+    scores = sorted(int(score) for score in histogram)
+    return np.array(scores), np.array([histogram[str(score)] for score in scores])
+
+
+def histogram_median(scores, counts):
+    # the median of the scores a histogram counts, as np.median would give it
+    total = counts.sum()
+    if total == 0:
+        return np.nan
+    ends = np.cumsum(counts)
+    lower = scores[np.searchsorted(ends, (total - 1) // 2, side="right")]
+    upper = scores[np.searchsorted(ends, total // 2, side="right")]
+    return (lower + upper) / 2
+
+
+def histogram_mean(scores, counts):
+    return np.sum(scores * counts) / counts.sum() if counts.sum() else np.nan
+
+
+def ratio(numerator, denominator):
+    return numerator / denominator if denominator else np.nan
+
+
+def summarize(state):
+    # the statistics of analyze(), from the running state
+    stats = state["stats"]
+    num_games = stats["num_games"]
+    scores, counts = histogram_scores(stats["score_histogram"])
+    agreement_scores, agreement_counts = histogram_scores(stats["agreement_histogram"])
+    num_agreements = stats["num_agreements"]
+
+    total_stats = {
+        "mean": histogram_mean(scores, counts),
+        "median": histogram_median(scores, counts),
+        "length_in_msgs": ratio(stats["message_sum"], num_games),
+        "length_in_tkns": ratio(stats["token_sum"], num_games),
+        "abort_rate": ratio(stats["num_aborts"], num_games),
+    }
+
+    agreement_stats = {
+        "mean": histogram_mean(agreement_scores, agreement_counts),
+        "median": histogram_median(agreement_scores, agreement_counts),
+        "length_in_msgs": ratio(stats["agreement_message_sum"], num_agreements),
+        "length_in_tkns": ratio(stats["agreement_token_sum"], num_agreements),
+        "proportion_agreement": ratio(num_agreements, num_games),
+        "proportion_pareto_opt": ratio(stats["num_optimal"], num_games),
+        "mean_dominance_margin": ratio(stats["dominance_margin_sum"], num_games),
+        "mean_frontier_distance": ratio(stats["frontier_distance_sum"], num_games),
+    }
+    for solution, distance in zip(
+        bargaining.SOLUTIONS, stats["solution_distance_sums"]
+    ):
+        agreement_stats[f"{solution}_distance"] = ratio(distance, num_games)
+
+    # above-average scores, from the part of the histogram above the mean
+    above = scores > total_stats["mean"]
+    above_avg_stats = {
+        "mean": histogram_mean(scores[above], counts[above]),
+        "median": histogram_median(scores[above], counts[above]),
+        "length_in_msgs": agreement_stats["length_in_msgs"],
+        "length_in_tkns": agreement_stats["length_in_tkns"],
+        "proportion_above_avg": ratio(counts[above].sum(), counts.sum()),
+    }
+
+    return {
+        "total": total_stats,
+        "agreement": agreement_stats,
+        "above_avg": above_avg_stats,
+    }
+
+
+def print_summary(results, num_games):
+    total, agreement = results["total"], results["agreement"]
+    print(
+        f"games: {num_games}"
+        f" | mean: {total['mean']:.3f}"
+        f" | median: {total['median']}"
+        f" | agreement: {agreement['proportion_agreement']:.3f}"
+        f" | abort: {total['abort_rate']:.3f}"
+        f" | pareto: {agreement['proportion_pareto_opt']:.3f}"
+        f" | margin: {agreement['mean_dominance_margin']:.3f}"
+        f" | msgs: {total['length_in_msgs']:.2f}"
+        f" | tokens: {total['length_in_tkns']:.1f}",
+        flush=True,
+    )
+
+
+def run_finished(dir_path):
+    # every game in the manifest has completed or failed
+    if not RunManifest.exists(dir_path):
+        return False
+    manifest = RunManifest.load(dir_path)
+    return all(
+        game["status"] in [COMPLETE, FAILED] for game in manifest.games.values()
+    )
+
+
+def watch(dir_path, objective, interval):
+    # prints the stats whenever games finish, until the run is done
+    num_games = None
+    while True:
+        finished = run_finished(dir_path)
+        state = update(dir_path, objective)
+        if state["stats"]["num_games"] != num_games:
+            num_games = state["stats"]["num_games"]
+            print_summary(summarize(state), num_games)
+        if finished:
+            return
+        time.sleep(interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="incrementally updated statistics for a self-play run"
+    )
+    parser.add_argument("-p", "--path", type=str, help="Run directory")
+    parser.add_argument(
+        "-o", "--objective", type=str, default="self", help="Game objective"
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="Keep printing stats as games finish, until the run is done",
+    )
+    parser.add_argument(
+        "--interval", type=float, default=5.0, help="Seconds between updates"
+    )
+    args = parser.parse_args()
+
+    if args.watch:
+        try:
+            watch(args.path, args.objective, args.interval)
+        except KeyboardInterrupt:
+            pass
+        return
+
+    state = update(args.path, args.objective)
+    results = summarize(state)
+    print_summary(results, state["stats"]["num_games"])
+    for group, group_stats in results.items():
+        print(f"{group.upper()}:")
+        for name, value in group_stats.items():
+            print(f"{name}: {value}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+CACHE_MODES = ["record", "replay", "passthrough"]
+
+
+class CacheMiss(Exception):
+    """Raised in replay mode when a request has no recorded response."""
+
+
+def request_key(model, messages, temperature, max_tokens, seed):
+    # the cache key covers everything that determines the API response
+    request = {
+        "model": model,
+        "messages": messages,
+        "temperature": temperature,
+        "max_tokens": max_tokens,
+        "seed": seed,
+    }
+    encoded = json.dumps(request, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """On-disk response store with size-bounded LRU eviction (SQLite)."""
+
+    def __init__(self, path, max_bytes=1 << 30):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.connection = None
+        self.lock = threading.Lock()
+        self.total_bytes = 0
+
+    def __getstate__(self):
+        # the connection is reopened lazily in each process
+        return {"path": self.path, "max_bytes": self.max_bytes}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"], state["max_bytes"])
+
+    def connect(self):
+        if self.connection is None:
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.connection = sqlite3.connect(
+                self.path, timeout=30, check_same_thread=False
+            )
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, response TEXT, size INTEGER, last_used REAL)"
+            )
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS responses_last_used ON responses(last_used)"
+            )
+            self.connection.commit()
+            self.total_bytes = self.connection.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()[0]
+        return self.connection
+
+    def get(self, key):
+        with self.lock:
+            connection = self.connect()
+            row = connection.execute(
+                "SELECT response FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+
+            # mark as recently used
+            connection.execute(
+                "UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key)
+            )
+            connection.commit()
+            return json.loads(row[0])
+
+    def put(self, key, response):
+        encoded = json.dumps(response)
+        with self.lock:
+            connection = self.connect()
+            previous = connection.execute(
+                "SELECT size FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            connection.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                (key, encoded, len(encoded), time.time()),
+            )
+            self.total_bytes += len(encoded) - (previous[0] if previous else 0)
+
+            if self.total_bytes > self.max_bytes:
+                self.evict(connection)
+            connection.commit()
+
+    def evict(self, connection):
+        # drop least recently used responses until the store fits its budget
+        # (other processes may share the file, so the total is recomputed first)
+        self.total_bytes = connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()[0]
+
+        rows = connection.execute(
+            "SELECT key, size FROM responses ORDER BY last_used ASC"
+        )
+        evicted = []
+        for key, size in rows:
+            if self.total_bytes <= self.max_bytes:
+                break
+            evicted.append((key,))
+            self.total_bytes -= size
+
+        connection.executemany("DELETE FROM responses WHERE key = ?", evicted)
+
+    def stats(self):
+        with self.lock:
+            connection = self.connect()
+            num_entries = connection.execute(
+                "SELECT COUNT(*) FROM responses"
+            ).fetchone()[0]
+            return {"entries": num_entries, "bytes": self.total_bytes}
+
+
+class CachedBackend:
+    """Wraps a backend with record, replay-only or passthrough response caching."""
+
+    def __init__(self, backend, cache, mode="record"):
+        if mode not in CACHE_MODES:
+            raise Exception(f"invalid cache mode: {mode}")
+        self.backend = backend
+        self.cache = cache
+        self.mode = mode
+
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __getstate__(self):
+        return {"backend": self.backend, "cache": self.cache, "mode": self.mode}
+
+    def __setstate__(self, state):
+        self.__init__(state["backend"], state["cache"], state["mode"])
+
+    def complete(
+        self, model, messages, temperature=1, max_tokens=200, seed=None, priority=0
+    ):
+        if self.mode == "passthrough":
+            return self.backend.complete(
+                model, messages, temperature, max_tokens, seed, priority
+            )
+
+        # without a seed, every game that sends the same messages would be given
+        # the same sampled reply, so recording needs one (or greedy decoding)
+        if self.mode == "record" and seed is None and temperature != 0:
+            raise Exception("recording sampled responses requires a seed")
+
+        key = request_key(model, messages, temperature, max_tokens, seed)
+        response = self.cache.get(key)
+        with self.lock:
+            if response is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        if response is not None:
+            response["cached"] = True
+            return response
+
+        if self.mode == "replay":
+            raise CacheMiss(f"no recorded response for request {key}")
+
+        response = self.backend.complete(
+            model, messages, temperature, max_tokens, seed, priority
+        )
+        self.cache.put(
+            key,
+            {
+                "content": response["content"],
+                "finish_reason": response.get("finish_reason"),
+                "usage": response.get("usage"),
+            },
+        )
+        return response
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, **self.cache.stats()}
@@ -0,0 +1,224 @@
+import hashlib
+import json
+import re
+import threading
+import time
+
+import numpy as np
+
+LATENCY_DISTRIBUTIONS = ["none", "fixed", "uniform", "lognormal"]
+
+# outputs that each fail one of LLMPlayer.is_valid_output's checks
+MALFORMED_OUTPUTS = [
+    "I think we should split the items evenly.",
+    "[message] How about this? [propose] (1 books, 1 hats, 1 balls)",
+    "[propose] (1 hats, 1 books, 1 balls)",
+    "[propose] (1 books, 1 hats)",
+    "[propose] (99 books, 99 hats, 99 balls)",
+]
+
+MOCK_MESSAGES = [
+    "I'd like the books, would you be happy with the hats?",
+    "How about we split everything as evenly as we can?",
+    "That works for me if I can keep the balls.",
+    "Let's divide the items so that we both score well.",
+]
+
+# simulated provider prompt caching: a prompt of at least CACHE_MIN_TOKENS reuses
+# the longest prefix seen in an earlier request, in whole blocks of
+# CACHE_BLOCK_TOKENS (tokens are estimated as CHARS_PER_TOKEN characters)
+CACHE_MIN_TOKENS = 1024
+CACHE_BLOCK_TOKENS = 128
+CHARS_PER_TOKEN = 4
+CACHE_MAX_BLOCKS = 1_000_000
+
+
+class MockAPIError(Exception):
+    """Simulated API failure, shaped like the OpenAI errors (status_code)."""
+
+    def __init__(self, message, status_code=500):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class MockBackend:
+    """Local stand-in for the chat API that plays syntactically valid turns.
+
+    Responses are a deterministic function of the request (and the backend
+    seed), so mock runs are reproducible and can be recorded and replayed.
+    """
+
+    def __init__(
+        self,
+        latency="none",
+        latency_mean=0.0,
+        latency_std=0.0,
+        error_rate=0.0,
+        rate_limit_share=0.5,
+        malformed_rate=0.0,
+        agreement_rate=0.8,
+        messages_before_propose=2,
+        seed=0,
+        prompt_cache=True,
+    ):
+        if latency not in LATENCY_DISTRIBUTIONS:
+            raise Exception(f"invalid latency distribution: {latency}")
+        self.latency = latency
+        self.latency_mean = latency_mean
+        self.latency_std = latency_std
+        self.error_rate = error_rate
+        self.rate_limit_share = rate_limit_share
+        self.malformed_rate = malformed_rate
+        self.agreement_rate = agreement_rate
+        self.messages_before_propose = messages_before_propose
+        self.seed = seed
+        self.prompt_cache = set() if prompt_cache else None
+
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.errors = 0
+        self.malformed = 0
+        self.latency_total = 0.0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def request_rng(self, model, messages, seed):
+        encoded = json.dumps([self.seed, model, messages, seed], sort_keys=True)
+        digest = hashlib.sha256(encoded.encode("utf-8")).digest()
+        return np.random.default_rng(int.from_bytes(digest[:8], "little"))
+
+    def cached_prompt_tokens(self, prompt_text):
+        # the prompt tokens a provider's prefix cache would serve for this request
+        if self.prompt_cache is None:
+            return 0
+        block_size = CACHE_BLOCK_TOKENS * CHARS_PER_TOKEN
+        digest = hashlib.sha256()
+        blocks = []
+        for start in range(0, len(prompt_text) - block_size + 1, block_size):
+            digest.update(prompt_text[start : start + block_size].encode("utf-8"))
+            blocks.append(digest.digest()[:8])
+
+        with self.lock:
+            num_cached = 0
+            while num_cached < len(blocks) and blocks[num_cached] in self.prompt_cache:
+                num_cached += 1
+            if len(self.prompt_cache) > CACHE_MAX_BLOCKS:
+                self.prompt_cache.clear()
+            self.prompt_cache.update(blocks)
+
+        cached_tokens = num_cached * CACHE_BLOCK_TOKENS
+        return cached_tokens if cached_tokens >= CACHE_MIN_TOKENS else 0
+
+    def sample_latency(self, rng):
+        if self.latency == "fixed":
+            return self.latency_mean
+        elif self.latency == "uniform":
+            return rng.uniform(0, 2 * self.latency_mean)
+        elif self.latency == "lognormal" and self.latency_mean > 0:
+            # lognormal with the requested mean and standard deviation
+            sigma2 = np.log(1 + (self.latency_std / self.latency_mean) ** 2)
+            mu = np.log(self.latency_mean) - sigma2 / 2
+            return rng.lognormal(mu, np.sqrt(sigma2))
+        return 0.0
+
+    def complete(
+        self, model, messages, temperature=1, max_tokens=200, seed=None, priority=0
+    ):
+        # turns are drawn per request, while errors are drawn per call, so that a
+        # retried request does not fail the same way again
+        with self.lock:
+            self.calls += 1
+            call_number = self.calls
+        rng = self.request_rng(model, messages, seed)
+        error_rng = np.random.default_rng([self.seed, call_number])
+
+        delay = self.sample_latency(rng)
+        time.sleep(delay)
+        with self.lock:
+            self.latency_total += delay
+
+        if error_rng.random() < self.error_rate:
+            with self.lock:
+                self.errors += 1
+            if error_rng.random() < self.rate_limit_share:
+                raise MockAPIError("mock rate limit exceeded", status_code=429)
+            raise MockAPIError("mock server error", status_code=500)
+
+        if rng.random() < self.malformed_rate:
+            with self.lock:
+                self.malformed += 1
+            content = MALFORMED_OUTPUTS[rng.integers(len(MALFORMED_OUTPUTS))]
+        else:
+            content = self.valid_turn(messages, rng)
+
+        prompt_text = "".join(message["content"] for message in messages)
+        prompt_tokens = len(prompt_text) // CHARS_PER_TOKEN
+        completion_tokens = len(content) // CHARS_PER_TOKEN
+        cached_tokens = self.cached_prompt_tokens(prompt_text)
+        with self.lock:
+            self.prompt_tokens += prompt_tokens
+            self.cached_tokens += cached_tokens
+        return {
+            "content": content + " [END]",
+            "finish_reason": "stop",
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+                "cached_tokens": cached_tokens,
+            },
+        }
+
+    def valid_turn(self, messages, rng):
+        # item types and counts come from the rendered system prompt
+        match = re.search(r"divide (.+?) between yourself", messages[0]["content"])
+        items = re.findall(r"(\d+) (\w+)", match.group(1)) if match else []
+        if len(items) == 0:
+            items = [("1", "books"), ("1", "hats"), ("1", "balls")]
+        counts = [int(count) for count, _ in items]
+        plurals = [plural for _, plural in items]
+
+        # turns taken so far, including attempts that failed validation
+        num_turns = sum(message["role"] == "assistant" for message in messages)
+        partner_proposed = any(
+            message["role"] == "user" and message["content"].startswith("[propose]")
+            for message in messages
+        )
+
+        if not partner_proposed and (
+            num_turns < self.messages_before_propose or len(messages) == 1
+        ):
+            return "[message] " + MOCK_MESSAGES[rng.integers(len(MOCK_MESSAGES))]
+
+        # the first proposer takes the lower half of each item; the responder takes
+        # the complement, unless it misreads the deal
+        if not partner_proposed:
+            allocation = [count // 2 for count in counts]
+        elif rng.random() < self.agreement_rate:
+            allocation = [count - count // 2 for count in counts]
+        else:
+            allocation = [int(rng.integers(0, count + 1)) for count in counts]
+
+        return "[propose] ({})".format(
+            ", ".join(f"{count} {plural}" for count, plural in zip(allocation, plurals))
+        )
+
+    def stats(self):
+        with self.lock:
+            return {
+                "calls": self.calls,
+                "errors": self.errors,
+                "malformed": self.malformed,
+                "latency_total": self.latency_total,
+                "prompt_tokens": self.prompt_tokens,
+                "cached_tokens": self.cached_tokens,
+            }
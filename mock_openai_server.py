@@ -0,0 +1,289 @@
+import argparse
+import json
+import re
+import threading
+import time
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# a job moves through these one step per status poll
+JOB_STATUSES = ["validating_files", "queued", "running", "succeeded"]
+FINAL_STATUSES = ["succeeded", "failed", "cancelled"]
+
+
+def parse_multipart(content_type, body):
+    # form fields of a multipart/form-data body: name -> (filename, bytes)
+    message = BytesParser().parsebytes(
+        b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body
+    )
+    fields = {}
+    for part in message.get_payload():
+        name = part.get_param("name", header="content-disposition")
+        filename = part.get_param("filename", header="content-disposition")
+        fields[name] = (filename, part.get_payload(decode=True))
+    return fields
+
+
+class MockOpenAIState:
+    """Files, uploads and fine-tuning jobs held by the mock server."""
+
+    def __init__(self, job_polls=1, fail_suffix=None):
+        self.lock = threading.Lock()
+        self.job_polls = job_polls
+        self.fail_suffix = fail_suffix
+        self.files = {}
+        self.contents = {}
+        self.uploads = {}
+        self.parts = {}
+        self.jobs = {}
+        self.stats = {
+            "file_uploads": 0,
+            "upload_parts": 0,
+            "jobs_created": 0,
+            "job_polls": 0,
+            "bytes_received": 0,
+        }
+        self.next_id = 0
+
+    def new_id(self, prefix):
+        self.next_id += 1
+        return f"{prefix}-mock{self.next_id:06d}"
+
+    def add_file(self, filename, purpose, content):
+        file_id = self.new_id("file")
+        self.files[file_id] = {
+            "id": file_id,
+            "object": "file",
+            "bytes": len(content),
+            "created_at": int(time.time()),
+            "filename": filename,
+            "purpose": purpose,
+            "status": "processed",
+        }
+        self.contents[file_id] = content
+        return self.files[file_id]
+
+    def advance_job(self, job):
+        # every job_polls retrievals move a job one status further
+        job["_polls"] += 1
+        if job["status"] in FINAL_STATUSES or job["_polls"] % self.job_polls:
+            return
+        job["status"] = JOB_STATUSES[JOB_STATUSES.index(job["status"]) + 1]
+        failing = self.fail_suffix is not None
+        if failing and job["user_provided_suffix"] == self.fail_suffix:
+            job["status"] = "failed"
+            job["error"] = {"code": "mock_failure", "message": "mock failure"}
+        if job["status"] in FINAL_STATUSES:
+            job["finished_at"] = int(time.time())
+        if job["status"] == "succeeded":
+            model, suffix = job["model"], job["user_provided_suffix"]
+            job["fine_tuned_model"] = f"ft:{model}:mock:{suffix}:{job['id'][-6:]}"
+            job["trained_tokens"] = len(self.contents[job["training_file"]]) // 4
+
+
+def public(job):
+    return {key: value for key, value in job.items() if not key.startswith("_")}
+
+
+class MockOpenAIHandler(BaseHTTPRequestHandler):
+    """Handles the files, uploads and fine-tuning endpoints of the API."""
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def not_found(self):
+        self.send_json(
+            {"error": {"message": f"no route for {self.path}", "type": "not_found"}},
+            status=404,
+        )
+
+    def read_body(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.server.state.stats["bytes_received"] += len(body)
+        return body
+
+    def do_GET(self):
+        state = self.server.state
+        path = self.path.split("?")[0]
+        with state.lock:
+            if path == "/v1/files":
+                self.send_json({"object": "list", "data": list(state.files.values())})
+            elif match := re.fullmatch(r"/v1/files/([\w-]+)", path):
+                if match.group(1) not in state.files:
+                    return self.not_found()
+                self.send_json(state.files[match.group(1)])
+            elif path == "/v1/fine_tuning/jobs":
+                jobs = [public(job) for job in state.jobs.values()]
+                self.send_json({"object": "list", "data": jobs, "has_more": False})
+            elif match := re.fullmatch(r"/v1/fine_tuning/jobs/([\w-]+)", path):
+                job = state.jobs.get(match.group(1))
+                if job is None:
+                    return self.not_found()
+                state.stats["job_polls"] += 1
+                state.advance_job(job)
+                self.send_json(public(job))
+            else:
+                self.not_found()
+
+    def do_POST(self):
+        state = self.server.state
+        path = self.path.split("?")[0]
+        body = self.read_body()
+        content_type = self.headers.get("Content-Type", "")
+        if content_type.startswith("multipart/form-data"):
+            fields = parse_multipart(content_type, body)
+        else:
+            fields = json.loads(body or b"{}")
+
+        with state.lock:
+            if path == "/v1/files":
+                filename, content = fields["file"]
+                purpose = fields["purpose"][1].decode()
+                state.stats["file_uploads"] += 1
+                self.send_json(state.add_file(filename, purpose, content))
+
+            elif path == "/v1/uploads":
+                upload_id = state.new_id("upload")
+                state.uploads[upload_id] = {
+                    "id": upload_id,
+                    "object": "upload",
+                    "bytes": fields["bytes"],
+                    "created_at": int(time.time()),
+                    "expires_at": int(time.time()) + 3600,
+                    "filename": fields["filename"],
+                    "purpose": fields["purpose"],
+                    "status": "pending",
+                    "file": None,
+                }
+                self.send_json(state.uploads[upload_id])
+
+            elif match := re.fullmatch(r"/v1/uploads/([\w-]+)/parts", path):
+                upload_id = match.group(1)
+                if upload_id not in state.uploads:
+                    return self.not_found()
+                part_id = state.new_id("part")
+                state.parts[part_id] = (upload_id, fields["data"][1])
+                state.stats["upload_parts"] += 1
+                self.send_json(
+                    {
+                        "id": part_id,
+                        "object": "upload.part",
+                        "created_at": int(time.time()),
+                        "upload_id": upload_id,
+                    }
+                )
+
+            elif match := re.fullmatch(r"/v1/uploads/([\w-]+)/complete", path):
+                upload = state.uploads.get(match.group(1))
+                if upload is None:
+                    return self.not_found()
+                content = b"".join(state.parts[part][1] for part in fields["part_ids"])
+                if len(content) != upload["bytes"]:
+                    return self.send_json(
+                        {"error": {"message": "size mismatch", "type": "invalid"}},
+                        status=400,
+                    )
+                state.stats["file_uploads"] += 1
+                upload["file"] = state.add_file(
+                    upload["filename"], upload["purpose"], content
+                )
+                upload["status"] = "completed"
+                self.send_json(upload)
+
+            elif path == "/v1/fine_tuning/jobs":
+                if fields["training_file"] not in state.files:
+                    return self.not_found()
+                job_id = state.new_id("ftjob")
+                state.jobs[job_id] = {
+                    "id": job_id,
+                    "object": "fine_tuning.job",
+                    "created_at": int(time.time()),
+                    "error": None,
+                    "fine_tuned_model": None,
+                    "finished_at": None,
+                    "hyperparameters": fields.get("hyperparameters", {}),
+                    "model": fields["model"],
+                    "organization_id": "org-mock",
+                    "result_files": [],
+                    "seed": 0,
+                    "status": JOB_STATUSES[0],
+                    "trained_tokens": None,
+                    "training_file": fields["training_file"],
+                    "validation_file": None,
+                    "user_provided_suffix": fields.get("suffix"),
+                    "_polls": 0,
+                }
+                state.stats["jobs_created"] += 1
+                self.send_json(public(state.jobs[job_id]))
+
+            elif match := re.fullmatch(r"/v1/fine_tuning/jobs/([\w-]+)/cancel", path):
+                job = state.jobs.get(match.group(1))
+                if job is None:
+                    return self.not_found()
+                if job["status"] not in FINAL_STATUSES:
+                    job["status"] = "cancelled"
+                self.send_json(public(job))
+
+            else:
+                self.not_found()
+
+
+class MockOpenAIServer(ThreadingHTTPServer):
+    """Local stand-in for the OpenAI files, uploads and fine-tuning endpoints.
+
+    Point the shared client at it with OPENAI_BASE_URL (or
+    backends.configure_client(base_url=server.url)). Jobs advance one status
+    per job_polls retrievals and succeed, unless their suffix is fail_suffix.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, port=0, job_polls=1, fail_suffix=None):
+        super().__init__(("127.0.0.1", port), MockOpenAIHandler)
+        self.state = MockOpenAIState(job_polls, fail_suffix)
+        self.url = f"http://127.0.0.1:{self.server_address[1]}/v1"
+
+    def start(self):
+        # serve from a background thread, e.g. inside a test or benchmark
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="serve a local stand-in for the OpenAI fine-tuning endpoints"
+    )
+    parser.add_argument("--port", type=int, default=8089, help="Port to listen on")
+    parser.add_argument(
+        "--job_polls",
+        type=int,
+        default=1,
+        help="Status polls before a job moves to its next status",
+    )
+    parser.add_argument(
+        "--fail_suffix",
+        type=str,
+        default=None,
+        help="Jobs with this model suffix fail instead of succeeding",
+    )
+    args = parser.parse_args()
+
+    server = MockOpenAIServer(args.port, args.job_polls, args.fail_suffix)
+    print(f"serving on {server.url} (set OPENAI_BASE_URL to use it)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,480 @@
+import argparse
+import os
+import threading
+import time
+
+import numpy as np
+
+import bargaining
+import pareto
+from contexts import SOURCE, ContextIndex, meta_is_current, source_hash
+from run_manifest import atomic_write_json, tmp_path_for
+
+VERSION = 2
+
+ARRAYS = [
+    "keys",
+    "key_rows",
+    "key_swapped",
+    "counts",
+    "values",
+    "max_sum",
+    "optima",
+    "frontier_offsets",
+    "frontier_allocations",
+    "frontier_scores",
+    "margins",
+    "distances",
+    "solutions",
+]
+
+# oracles are shared by everything in a process that asks for the same source
+_oracles = {}
+_oracles_lock = threading.Lock()
+
+
+def oracle_dir(source):
+    return os.path.join(os.path.dirname(source), "oracle")
+
+
+def context_keys(counts, p0_values, p1_values, key_base):
+    # packs each context (counts, then player 0's values, then player 1's) into a
+    # single integer; contexts with a digit outside the base get -1
+    digits = np.concatenate([counts, p0_values, p1_values], axis=1).astype(np.int64)
+    keys = digits @ key_base ** np.arange(digits.shape[1], dtype=np.int64)[::-1]
+    in_range = ((digits >= 0) & (digits < key_base)).all(axis=1)
+    return np.where(in_range, keys, -1)
+
+
+def solve_contexts(counts, p0_values, p1_values, score_max, chunk_size=256):
+    """Frontiers, ceilings and score-grid lookups for a batch of contexts.
+
+    Own scores are what each player's values are worth of the items they get.
+    margins[u, x, y] is the largest joint gain of any allocation that dominates
+    own scores (x, y), and distances[u, x, y] the smallest joint gain needed to
+    reach a frontier allocation that does; both are 0 for Pareto-optimal scores.
+    The bargaining solutions are as in bargaining.bargaining_solutions.
+    """
+    counts = np.asarray(counts, dtype=np.int32)
+    p0_values = np.asarray(p0_values, dtype=np.int32)
+    p1_values = np.asarray(p1_values, dtype=np.int32)
+
+    num_contexts = len(counts)
+    scores = np.arange(score_max + 1)
+    x, y = scores[:, None], scores[None, :]
+
+    max_sum = np.zeros(num_contexts, dtype=np.int16)
+    optima = np.zeros((num_contexts, len(pareto.OBJECTIVES), 2), dtype=np.int16)
+    margins = np.zeros((num_contexts, score_max + 1, score_max + 1), dtype=np.int16)
+    distances = np.zeros_like(margins)
+    frontiers = [None] * num_contexts
+
+    for group_counts, members in pareto.group_by_counts(counts):
+        grid = pareto.allocation_grid(group_counts).astype(np.int32)
+
+        for start in range(0, len(members), chunk_size):
+            batch = members[start : start + chunk_size]
+            p0_own, p1_own = pareto.own_scores(
+                grid, group_counts, p0_values[batch], p1_values[batch]
+            )
+            joint = p0_own + p1_own
+            if max(p0_own.max(), p1_own.max()) > score_max:
+                raise Exception(f"own scores above the score grid ({score_max})")
+
+            max_sum[batch] = joint.max(axis=1)
+            for code in range(len(pareto.OBJECTIVES)):
+                codes = np.full(len(batch), code)
+                p0_final, p1_final = pareto.objective_scores(p0_own, p1_own, codes)
+                optima[batch, code, 0] = p0_final.max(axis=1)
+                optima[batch, code, 1] = p1_final.max(axis=1)
+
+            # an allocation is on the frontier if no other allocation dominates it
+            dominated = (
+                (p0_own[:, None, :] >= p0_own[:, :, None])
+                & (p1_own[:, None, :] >= p1_own[:, :, None])
+                & (joint[:, None, :] > joint[:, :, None])
+            ).any(axis=2)
+            on_frontier = ~dominated
+
+            # (contexts, allocations, x, y) dominance over the whole score grid
+            gains = joint[:, :, None, None] - x - y
+            dominates = (
+                (p0_own[:, :, None, None] >= x)
+                & (p1_own[:, :, None, None] >= y)
+                & (gains > 0)
+            )
+            margins[batch] = np.where(dominates, gains, 0).max(axis=1)
+            reach = dominates & on_frontier[:, :, None, None]
+            nearest = np.where(reach, gains, np.iinfo(np.int32).max).min(axis=1)
+            distances[batch] = np.where(reach.any(axis=1), nearest, 0)
+
+            for member, frontier, own0, own1 in zip(
+                batch, on_frontier, p0_own, p1_own
+            ):
+                frontiers[member] = (
+                    grid[frontier],
+                    np.stack([own0[frontier], own1[frontier]], axis=1),
+                )
+
+    sizes = [len(allocations) for allocations, _ in frontiers]
+    empty = np.zeros((0, counts.shape[1]), dtype=np.int32)
+    return {
+        "max_sum": max_sum,
+        "optima": optima,
+        "frontier_offsets": np.concatenate([[0], np.cumsum(sizes)]).astype(np.int32),
+        "frontier_allocations": np.concatenate(
+            [empty] + [allocations for allocations, _ in frontiers]
+        ).astype(np.int16),
+        "frontier_scores": np.concatenate(
+            [np.zeros((0, 2), dtype=np.int32)] + [scores for _, scores in frontiers]
+        ).astype(np.int16),
+        "margins": margins,
+        "distances": distances,
+        "solutions": bargaining.bargaining_solutions(counts, p0_values, p1_values),
+    }
+
+
+def key_arrays(counts, values, key_base):
+    # lookup keys for both seat orders of every context, sorted for searchsorted;
+    # a context with equal values in both seats keeps its unswapped key
+    rows = np.arange(len(counts), dtype=np.int32)
+    keys = np.concatenate(
+        [
+            context_keys(counts, values[:, 0], values[:, 1], key_base),
+            context_keys(counts, values[:, 1], values[:, 0], key_base),
+        ]
+    )
+    keys, first = np.unique(keys, return_index=True)
+    return {
+        "keys": keys,
+        "key_rows": np.concatenate([rows, rows])[first],
+        "key_swapped": (first >= len(counts)),
+    }
+
+
+def compile_oracle(source=SOURCE):
+    # solves every unique context of the source file (in context id order, so a
+    # game's context_id is also its row) and saves the arrays for memory-mapping
+    contexts = ContextIndex(source)
+    pairs = np.asarray(contexts.unique_pairs)
+    counts = np.asarray(contexts.counts[pairs], dtype=np.int16)
+    values = np.asarray(contexts.values[pairs], dtype=np.int16)
+
+    key_base = int(max(counts.max(), values.max())) + 1
+    score_max = int((values * counts[:, None]).sum(axis=2).max())
+
+    arrays = {"counts": counts, "values": values}
+    arrays.update(key_arrays(counts, values, key_base))
+    arrays.update(solve_contexts(counts, values[:, 0], values[:, 1], score_max))
+
+    out_dir = oracle_dir(source)
+    os.makedirs(out_dir, exist_ok=True)
+    for name in ARRAYS:
+        tmp_path = tmp_path_for(f"{out_dir}/{name}.npy")
+        with open(tmp_path, "wb") as array_file:
+            np.save(array_file, arrays[name])
+        os.replace(tmp_path, f"{out_dir}/{name}.npy")
+
+    # the metadata is written last, so a half-written oracle is never trusted
+    atomic_write_json(
+        f"{out_dir}/meta.json",
+        {
+            "version": VERSION,
+            "source": os.path.basename(source),
+            "source_sha256": source_hash(source),
+            "source_mtime": os.path.getmtime(source),
+            "num_contexts": len(counts),
+            "key_base": key_base,
+            "score_max": score_max,
+        },
+    )
+
+
+def is_current(source):
+    return meta_is_current(f"{oracle_dir(source)}/meta.json", source, VERSION)
+
+
+def get_oracle(source=SOURCE):
+    with _oracles_lock:
+        if source not in _oracles:
+            _oracles[source] = Oracle(source)
+        return _oracles[source]
+
+
+class Oracle:
+    """Per-context Pareto frontiers, ceilings and score lookups.
+
+    Rows are the unique contexts of a context file, stored in one seat order;
+    a game is matched to its row in either seat order. Contexts that are not in
+    the file are solved the first time they are looked up and kept in memory.
+    """
+
+    def __init__(self, source=SOURCE):
+        if not is_current(source):
+            compile_oracle(source)
+
+        self.source = source
+        directory = oracle_dir(source)
+        for name in ARRAYS:
+            setattr(self, name, np.load(f"{directory}/{name}.npy", mmap_mode="r"))
+
+        self.key_base = int(max(self.counts.max(), self.values.max())) + 1
+        self.score_max = self.margins.shape[1] - 1
+        self.num_items = self.counts.shape[1]
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        return {"source": self.source}
+
+    def __setstate__(self, state):
+        self.__init__(state["source"])
+
+    def find(self, counts, p0_values, p1_values):
+        # (rows, swapped) for a batch of games; rows are -1 where not found
+        keys = context_keys(
+            np.asarray(counts),
+            np.asarray(p0_values),
+            np.asarray(p1_values),
+            self.key_base,
+        )
+        positions = np.searchsorted(self.keys, keys)
+        positions = np.minimum(positions, len(self.keys) - 1)
+        found = (self.keys[positions] == keys) & (keys >= 0)
+        rows = np.where(found, self.key_rows[positions], -1)
+        swapped = found & self.key_swapped[positions]
+        return rows, swapped
+
+    def extend(self, counts, values):
+        # solves contexts the table does not cover and appends them as new rows
+        self.grow_grid(int((values * counts[:, None]).sum(axis=2).max()))
+        solved = solve_contexts(counts, values[:, 0], values[:, 1], self.score_max)
+        solved["counts"], solved["values"] = counts, values
+        offsets = solved.pop("frontier_offsets")
+
+        num_rows = len(self.counts)
+        for name, array in solved.items():
+            setattr(self, name, np.concatenate([getattr(self, name), array]))
+        self.frontier_offsets = np.concatenate(
+            [self.frontier_offsets, self.frontier_offsets[-1] + offsets[1:]]
+        )
+
+        self.key_base = max(
+            self.key_base, int(max(self.counts.max(), self.values.max())) + 1
+        )
+        keys = key_arrays(self.counts, self.values, self.key_base)
+        self.keys = keys["keys"]
+        self.key_rows = keys["key_rows"]
+        self.key_swapped = keys["key_swapped"]
+        return num_rows
+
+    def grow_grid(self, score_max):
+        # widens the score grid for contexts worth more than the compiled ones;
+        # no allocation of an existing context reaches the new scores, so nothing
+        # dominates them and their margins and distances are 0
+        if score_max <= self.score_max:
+            return
+        extra = score_max - self.score_max
+        padding = ((0, 0), (0, extra), (0, extra))
+        self.margins = np.pad(self.margins, padding)
+        self.distances = np.pad(self.distances, padding)
+        self.score_max = score_max
+
+    def rows(self, counts, p0_values, p1_values):
+        """Oracle rows and seat orders for a batch of games, solving new contexts."""
+        counts = np.asarray(counts, dtype=np.int16).reshape(-1, self.counts.shape[1])
+        p0_values = np.asarray(p0_values, dtype=np.int16).reshape(counts.shape)
+        p1_values = np.asarray(p1_values, dtype=np.int16).reshape(counts.shape)
+
+        rows, swapped = self.find(counts, p0_values, p1_values)
+        if (rows < 0).any():
+            with self.lock:
+                rows, swapped = self.find(counts, p0_values, p1_values)
+                missing = rows < 0
+                if missing.any():
+                    games = np.concatenate(
+                        [counts[missing], p0_values[missing], p1_values[missing]],
+                        axis=1,
+                    )
+                    games = np.unique(games, axis=0)
+                    games = games.reshape(len(games), 3, -1)
+                    self.extend(games[:, 0], games[:, 1:])
+                    rows, swapped = self.find(counts, p0_values, p1_values)
+        return rows, swapped
+
+    def best_joint(self, counts, p0_values, p1_values):
+        # the largest sum of both players' own scores any allocation reaches
+        rows, _ = self.rows(counts, p0_values, p1_values)
+        return np.asarray(self.max_sum[rows])
+
+    def best_scores(self, counts, p0_values, p1_values, objective):
+        # each player's best final score under the objective, shape (N, 2)
+        rows, swapped = self.rows(counts, p0_values, p1_values)
+        codes = pareto.objective_codes(objective, len(rows))
+        best = np.asarray(self.optima[rows, codes])
+        return np.where(swapped[:, None], best[:, ::-1], best)
+
+    def score_lookup(self, table, rows, swapped, p0_own, p1_own):
+        # reads a (row, x, y) table at the games' own scores in their seat order
+        x = np.where(swapped, p1_own, p0_own)
+        y = np.where(swapped, p0_own, p1_own)
+        return np.asarray(table[rows, x, y])
+
+    def in_grid(self, *scores):
+        return np.logical_and.reduce(
+            [(score >= 0) & (score <= self.score_max) for score in scores]
+        )
+
+    def frontier_distance(self, counts, p0_values, p1_values, p0_own, p1_own):
+        """Smallest joint gain in own scores needed to reach the Pareto frontier."""
+        rows, swapped = self.rows(counts, p0_values, p1_values)
+        p0_own, p1_own = np.asarray(p0_own), np.asarray(p1_own)
+        if not self.in_grid(p0_own, p1_own).all():
+            raise Exception(f"own scores outside the score grid (0-{self.score_max})")
+        return self.score_lookup(self.distances, rows, swapped, p0_own, p1_own)
+
+    def pareto_optimal(
+        self, counts, p0_values, p1_values, p0_scores, p1_scores, objective
+    ):
+        """Same flags and margins as pareto.pareto_optimal, from table lookups.
+
+        Games the tables cannot answer exactly (scores off the grid, or final
+        scores that no allocation could produce) are checked the batched way.
+        """
+        counts = np.asarray(counts)
+        p0_values = np.asarray(p0_values)
+        p1_values = np.asarray(p1_values)
+        p0_scores = np.asarray(p0_scores)
+        p1_scores = np.asarray(p1_scores)
+        codes = pareto.objective_codes(objective, len(counts))
+
+        rows, swapped = self.rows(counts, p0_values, p1_values)
+        margins = np.zeros(len(counts), dtype=np.result_type(p0_scores, np.int32))
+
+        # self: final scores are own scores, so the margin table answers directly
+        own = (codes == 0) & self.in_grid(p0_scores, p1_scores)
+        margins[own] = self.score_lookup(
+            self.margins, rows[own], swapped[own], p0_scores[own], p1_scores[own]
+        )
+
+        # coop: both players score the joint score, so only max_sum matters
+        coop = codes == 1
+        best = 2 * self.max_sum[rows[coop]].astype(np.int64)
+        joint = p0_scores[coop] + p1_scores[coop]
+        dominated = (best // 2 >= np.maximum(p0_scores[coop], p1_scores[coop])) & (
+            best > joint
+        )
+        margins[coop] = np.where(dominated, best - joint, 0)
+
+        # comp: the game is zero-sum, so no allocation improves on another
+        comp = (codes == 2) & (p0_scores + p1_scores == 0)
+
+        fallback = ~(own | coop | comp)
+        if fallback.any():
+            _, margins[fallback] = pareto.pareto_optimal(
+                counts[fallback],
+                p0_values[fallback],
+                p1_values[fallback],
+                p0_scores[fallback],
+                p1_scores[fallback],
+                codes_to_objectives(codes[fallback]),
+            )
+        return margins == 0, margins
+
+    def solution_distances(
+        self, counts, p0_values, p1_values, p0_scores, p1_scores, objective
+    ):
+        """Distance from each game's final scores to each bargaining solution.
+
+        Returns shape (N, 3), with solutions in bargaining.SOLUTIONS order.
+        """
+        rows, swapped = self.rows(counts, p0_values, p1_values)
+        codes = pareto.objective_codes(objective, len(rows))
+        points = np.asarray(self.solutions[rows, codes])
+        points = np.where(swapped[:, None, None], points[:, :, ::-1], points)
+        symmetric = (np.asarray(p0_values) == np.asarray(p1_values)).all(axis=1)
+        return bargaining.solution_distances(points, p0_scores, p1_scores, symmetric)
+
+    def frontier(self, counts, p0_values, p1_values):
+        """Frontier allocations of one game as (player 0 items, own scores) pairs."""
+        rows, swapped = self.rows([counts], [p0_values], [p1_values])
+        row, swapped = rows[0], bool(swapped[0])
+        start, end = self.frontier_offsets[row], self.frontier_offsets[row + 1]
+        allocations = np.asarray(self.frontier_allocations[start:end])
+        scores = np.asarray(self.frontier_scores[start:end])
+        if swapped:
+            allocations = np.asarray(counts) - allocations
+            scores = scores[:, ::-1]
+        return [
+            (allocation.tolist(), score.tolist())
+            for allocation, score in zip(allocations, scores)
+        ]
+
+
+def codes_to_objectives(codes):
+    return [pareto.OBJECTIVES[code] for code in codes]
+
+
+def verify(oracle, num_games, seed=0):
+    # compares lookups with the batched check on synthetic games, under every
+    # objective, and reports how long each took
+    counts, p0_values, p1_values, p0_own, p1_own = pareto.synthetic_games(
+        num_games, seed
+    )
+    report = {"games": num_games, "contexts": len(oracle.counts)}
+    for objective in pareto.OBJECTIVES:
+        codes = np.full(num_games, pareto.OBJECTIVES.index(objective))
+        p0_scores, p1_scores = pareto.objective_scores(
+            p0_own[:, None], p1_own[:, None], codes
+        )
+        games = (counts, p0_values, p1_values, p0_scores[:, 0], p1_scores[:, 0])
+
+        start_time = time.perf_counter()
+        expected = pareto.pareto_optimal(*games, objective)
+        batch_time = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        found = oracle.pareto_optimal(*games, objective)
+        lookup_time = time.perf_counter() - start_time
+
+        agrees = all(np.array_equal(a, b) for a, b in zip(expected, found))
+        report[f"{objective}_agrees"] = agrees
+        report[f"{objective}_speedup"] = batch_time / lookup_time
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="build and check the per-context pareto oracle"
+    )
+    parser.add_argument("-s", "--source", type=str, default=SOURCE)
+    parser.add_argument(
+        "--rebuild", action="store_true", help="Rebuild even if the oracle is current"
+    )
+    parser.add_argument(
+        "--verify",
+        type=int,
+        default=0,
+        help="Number of synthetic games to check against pareto.pareto_optimal",
+    )
+    args = parser.parse_args()
+
+    start_time = time.perf_counter()
+    if args.rebuild:
+        compile_oracle(args.source)
+    oracle = Oracle(args.source)
+    load_time = time.perf_counter() - start_time
+
+    frontier_sizes = np.diff(oracle.frontier_offsets)
+    print(
+        f"{len(oracle.counts)} contexts, scores 0-{oracle.score_max}, "
+        f"mean frontier size {frontier_sizes.mean():.2f}, "
+        f"mean max joint score {oracle.max_sum.mean():.3f} ({load_time:.2f}s)"
+    )
+
+    if args.verify > 0:
+        for key, value in verify(oracle, args.verify).items():
+            print(f"{key}: {value}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,398 @@
+import argparse
+import time
+
+import numpy as np
+
+OBJECTIVES = ["self", "coop", "comp"]
+
+# final scores as in NegotiationGame.calculateFinalScores, as weights on
+# (player 0's own score, player 1's own score) for each player and objective
+OBJECTIVE_WEIGHTS = np.array(
+    [
+        [[1, 0], [0, 1]],
+        [[1, 1], [1, 1]],
+        [[1, -1], [-1, 1]],
+    ],
+    dtype=np.int32,
+)
+
+
+def objective_codes(objective, num_games):
+    # one objective for every game, or one per game
+    if isinstance(objective, str):
+        names, codes = [objective], np.zeros(num_games, dtype=np.intp)
+    else:
+        names, codes = np.unique(np.asarray(objective), return_inverse=True)
+    for name in names:
+        if name not in OBJECTIVES:
+            raise Exception(f"invalid objective: {name}")
+    return np.array([OBJECTIVES.index(name) for name in names])[codes.reshape(-1)]
+
+
+def allocation_grid(max_counts):
+    # every split that gives player 0 up to max_counts[k] of item k, shape (G, K)
+    ranges = [np.arange(count + 1) for count in max_counts]
+    grid = np.meshgrid(*ranges, indexing="ij")
+    return np.stack(grid, axis=-1).reshape(-1, len(max_counts))
+
+
+def objective_scores(p0_own, p1_own, codes):
+    # both players' final scores given their own scores, shape (N, G)
+    weights = OBJECTIVE_WEIGHTS[codes][:, :, :, None]
+    p0_scores = weights[:, 0, 0] * p0_own + weights[:, 0, 1] * p1_own
+    p1_scores = weights[:, 1, 0] * p0_own + weights[:, 1, 1] * p1_own
+    return p0_scores, p1_scores
+
+
+def own_scores(grid, counts, p0_values, p1_values):
+    # each player's own score for every allocation in the grid, shape (N, G);
+    # player 1 gets whatever player 0 does not
+    p0_own = p0_values @ grid.T
+    p1_own = (p1_values @ counts)[:, None] - p1_values @ grid.T
+    return p0_own, p1_own
+
+
+def group_by_counts(counts):
+    # games grouped by item counts (there are only a few distinct count vectors),
+    # as (counts, member indices) pairs, so each group shares an allocation grid
+    base = int(counts.max()) + 1
+    if counts.shape[1] * np.log2(base) < 62:
+        keys = counts.astype(np.int64) @ base ** np.arange(
+            counts.shape[1], dtype=np.int64
+        )
+        _, first, groups = np.unique(keys, return_index=True, return_inverse=True)
+    else:
+        _, first, groups = np.unique(
+            counts, axis=0, return_index=True, return_inverse=True
+        )
+    groups = groups.reshape(-1)
+    order = np.argsort(groups, kind="stable")
+    bounds = np.searchsorted(groups[order], np.arange(len(first) + 1))
+    for group, index in enumerate(first):
+        yield counts[index], order[bounds[group] : bounds[group + 1]]
+
+
+def skyline(points, valid):
+    """The points that no other point in the same row dominates, for a batch.
+
+    points has shape (N, M, 2) (own-score pairs) and valid marks the points
+    that count. Returns the non-dominated points of each row, each once,
+    packed to the front of shape (N, F, 2), and the new valid mask.
+    """
+    lowest = np.iinfo(np.int64).min
+    p0 = np.where(valid, points[:, :, 0], lowest)
+    p1 = np.where(valid, points[:, :, 1], lowest)
+
+    # by player 0's score, then player 1's, both descending; a point is kept if
+    # it beats player 1's score of every point before it
+    order = np.lexsort((-p1, -p0), axis=1)
+    p0 = np.take_along_axis(p0, order, axis=1)
+    p1 = np.take_along_axis(p1, order, axis=1)
+    keep = np.take_along_axis(valid, order, axis=1)
+    keep[:, 1:] &= p1[:, 1:] > np.maximum.accumulate(p1, axis=1)[:, :-1]
+
+    # move the kept points to the front, in order
+    size = max(int(keep.sum(axis=1).max()), 1)
+    front = np.argsort(~keep, axis=1, kind="stable")[:, :size]
+    packed = np.stack(
+        [np.take_along_axis(p0, front, axis=1), np.take_along_axis(p1, front, axis=1)],
+        axis=2,
+    )
+    return packed, np.take_along_axis(keep, front, axis=1)
+
+
+def score_frontiers(counts, p0_values, p1_values):
+    """Pareto frontiers of both players' own scores for a batch of N games.
+
+    A frontier is built one item type at a time: every frontier point of the
+    first k items is a frontier point of the first k - 1 items plus some split
+    of item k, so only non-dominated pairs are carried forward. The work grows
+    with the size of the frontiers (at most one point per score) rather than
+    with the allocation grid, which is exponential in the number of item types.
+    Returns the frontiers padded to shape (N, F, 2) and their valid mask.
+    """
+    counts = np.asarray(counts, dtype=np.int64)
+    p0_values = np.asarray(p0_values, dtype=np.int64)
+    p1_values = np.asarray(p1_values, dtype=np.int64)
+
+    frontiers = np.zeros((len(counts), 1, 2), dtype=np.int64)
+    valid = np.ones((len(counts), 1), dtype=bool)
+    for item in range(counts.shape[1]):
+        count = counts[:, item, None]
+        taken = np.arange(int(count.max(initial=0)) + 1)
+        splits = np.stack(
+            [
+                taken * p0_values[:, item, None],
+                (count - taken) * p1_values[:, item, None],
+            ],
+            axis=2,
+        )
+        points = frontiers[:, :, None, :] + splits[:, None, :, :]
+        points_valid = valid[:, :, None] & (taken <= count)[:, None, :]
+        frontiers, valid = skyline(
+            points.reshape(len(counts), -1, 2), points_valid.reshape(len(counts), -1)
+        )
+    return frontiers, valid
+
+
+def score_frontier(counts, p0_values, p1_values):
+    # the frontier of one game, shape (F, 2), sorted by player 0's score
+    frontiers, valid = score_frontiers([counts], [p0_values], [p1_values])
+    return frontiers[0][valid[0]][::-1]
+
+
+def score_differences(counts, p0_values, p1_values):
+    # every value of player 0's own score minus player 1's that some allocation
+    # of one game reaches, sorted; built item by item like the frontier
+    differences = np.zeros(1, dtype=np.int64)
+    for count, p0_value, p1_value in zip(counts, p0_values, p1_values):
+        taken = np.arange(int(count) + 1)
+        splits = taken * p0_value - (count - taken) * p1_value
+        differences = np.unique(differences[:, None] + splits[None, :])
+    return differences
+
+
+def frontier_margins(counts, p0_values, p1_values, p0_scores, p1_scores, codes):
+    """Dominance margins for a batch of N games, from their frontiers.
+
+    The same margins as pareto_optimal without enumerating allocations. Under
+    self, only frontier allocations can have the largest joint gain; under
+    coop, both players score the joint score; and under comp, every allocation
+    gives the players opposite scores, so only scores that no allocation gives
+    can be dominated.
+    """
+    counts = np.asarray(counts, dtype=np.int64)
+    p0_values = np.asarray(p0_values, dtype=np.int64)
+    p1_values = np.asarray(p1_values, dtype=np.int64)
+    p0_scores = np.asarray(p0_scores, dtype=np.int64)
+    p1_scores = np.asarray(p1_scores, dtype=np.int64)
+    codes = np.asarray(codes)
+
+    frontiers, valid = score_frontiers(counts, p0_values, p1_values)
+    joint = frontiers.sum(axis=2)
+    margins = np.zeros(len(counts), dtype=np.int64)
+
+    gains = joint - (p0_scores + p1_scores)[:, None]
+    dominates = (
+        valid
+        & (frontiers[:, :, 0] >= p0_scores[:, None])
+        & (frontiers[:, :, 1] >= p1_scores[:, None])
+        & (gains > 0)
+    )
+    self_margins = np.where(dominates, gains, 0).max(axis=1)
+    margins[codes == 0] = self_margins[codes == 0]
+
+    best = 2 * np.where(valid, joint, 0).max(axis=1)
+    coop_dominated = (best // 2 >= np.maximum(p0_scores, p1_scores)) & (
+        best > p0_scores + p1_scores
+    )
+    coop_margins = np.where(coop_dominated, best - p0_scores - p1_scores, 0)
+    margins[codes == 1] = coop_margins[codes == 1]
+
+    # a comp allocation dominates if its difference lies in [p0_score, -p1_score],
+    # which takes scores that add up to less than zero
+    for game in np.flatnonzero((codes == 2) & (p0_scores + p1_scores < 0)):
+        differences = score_differences(counts[game], p0_values[game], p1_values[game])
+        lowest = np.searchsorted(differences, p0_scores[game])
+        if lowest < len(differences) and differences[lowest] <= -p1_scores[game]:
+            margins[game] = -(p0_scores[game] + p1_scores[game])
+
+    return margins
+
+
+def max_joint_scores(counts, p0_values, p1_values, chunk_size=1024):
+    # the largest sum of both players' own scores in each game, from its frontier
+    best = np.zeros(len(counts), dtype=np.int64)
+    for start in range(0, len(counts), chunk_size):
+        batch = slice(start, start + chunk_size)
+        frontiers, valid = score_frontiers(
+            counts[batch], p0_values[batch], p1_values[batch]
+        )
+        best[batch] = np.where(valid, frontiers.sum(axis=2), 0).max(axis=1)
+    return best
+
+
+def pareto_optimal(
+    counts,
+    p0_values,
+    p1_values,
+    p0_scores,
+    p1_scores,
+    objective,
+    chunk_size=4096,
+    max_grid=4096,
+):
+    """Pareto flags and dominance margins for a batch of N games with K items.
+
+    counts and values have shape (N, K) and the scores shape (N,). A game is
+    Pareto-optimal if no allocation gives both players at least their score and
+    one of them more, as in utils.isParetoOptimal. The dominance margin is the
+    largest joint gain (the sum of both players' gains) of any such allocation,
+    and 0 for optimal games. Games with more than max_grid allocations are
+    checked against their frontiers (see score_frontiers) instead.
+    """
+    counts = np.asarray(counts, dtype=np.int32)
+    p0_values = np.asarray(p0_values, dtype=np.int32)
+    p1_values = np.asarray(p1_values, dtype=np.int32)
+    p0_scores = np.asarray(p0_scores)
+    p1_scores = np.asarray(p1_scores)
+    codes = objective_codes(objective, len(counts))
+
+    num_games = len(counts)
+    is_optimal = np.ones(num_games, dtype=bool)
+    margins = np.zeros(num_games, dtype=np.result_type(p0_scores, np.int32))
+    if num_games == 0:
+        return is_optimal, margins
+
+    # games with too many allocations to enumerate are checked against their
+    # frontiers, in batches
+    large = np.flatnonzero(np.prod(counts + 1.0, axis=1) > max_grid)
+    for start in range(0, len(large), chunk_size // 4):
+        batch = large[start : start + chunk_size // 4]
+        margins[batch] = frontier_margins(
+            counts[batch],
+            p0_values[batch],
+            p1_values[batch],
+            p0_scores[batch],
+            p1_scores[batch],
+            codes[batch],
+        )
+        is_optimal[batch] = margins[batch] == 0
+
+    small = np.setdiff1d(np.arange(num_games), large)
+    if len(small) == 0:
+        return is_optimal, margins
+
+    for group_counts, members in group_by_counts(counts[small]):
+        members = small[members]
+        grid = allocation_grid(group_counts).astype(np.int32)
+
+        for start in range(0, len(members), chunk_size):
+            batch = members[start : start + chunk_size]
+            p0_own, p1_own = own_scores(
+                grid, group_counts, p0_values[batch], p1_values[batch]
+            )
+            p0_new, p1_new = objective_scores(p0_own, p1_own, codes[batch])
+            p0_gain = p0_new - p0_scores[batch, None]
+            p1_gain = p1_new - p1_scores[batch, None]
+
+            dominates = (p0_gain >= 0) & (p1_gain >= 0) & (p0_gain + p1_gain > 0)
+            is_optimal[batch] = ~dominates.any(axis=1)
+            margins[batch] = np.where(dominates, p0_gain + p1_gain, 0).max(axis=1)
+
+    return is_optimal, margins
+
+
+def synthetic_games(num_games, seed=0):
+    # games drawn from the context index, each ending in a random complementary
+    # split scored under the self objective
+    from contexts import ContextIndex
+
+    contexts = ContextIndex()
+    rng = np.random.default_rng(seed)
+    pairs = rng.integers(0, contexts.num_pairs, num_games)
+    counts = np.asarray(contexts.counts[pairs], dtype=np.int64)
+    p0_values = np.asarray(contexts.values[pairs, 0], dtype=np.int64)
+    p1_values = np.asarray(contexts.values[pairs, 1], dtype=np.int64)
+
+    allocations = np.floor(rng.random(counts.shape) * (counts + 1)).astype(np.int64)
+    p0_scores = (p0_values * allocations).sum(axis=1)
+    p1_scores = (p1_values * (counts - allocations)).sum(axis=1)
+    return counts, p0_values, p1_values, p0_scores, p1_scores
+
+
+def random_games(num_games, num_items, max_count, seed=0):
+    # games with num_items item types, up to max_count of each and values up to
+    # 10, each ending in a random complementary split scored under self
+    rng = np.random.default_rng(seed)
+    counts = rng.integers(1, max_count + 1, (num_games, num_items))
+    p0_values = rng.integers(0, 11, (num_games, num_items))
+    p1_values = rng.integers(0, 11, (num_games, num_items))
+
+    allocations = np.floor(rng.random(counts.shape) * (counts + 1)).astype(np.int64)
+    p0_scores = (p0_values * allocations).sum(axis=1)
+    p1_scores = (p1_values * (counts - allocations)).sum(axis=1)
+    return counts, p0_values, p1_values, p0_scores, p1_scores
+
+
+def benchmark(num_games, loop_sample, seed=0, num_items=None, max_count=4):
+    # compares the batched check with the per-game utils.isParetoOptimal; the
+    # per-game loop is timed on a sample of the games and scaled up. games come
+    # from the context file, or are random games with num_items item types
+    import utils
+    from items import ItemSchema
+    from results_table import item_dict
+
+    if num_items is None:
+        games = synthetic_games(num_games, seed)
+    else:
+        games = random_games(num_games, num_items, max_count, seed)
+    names = ItemSchema([f"item{k}" for k in range(games[0].shape[1])]).names
+
+    start_time = time.perf_counter()
+    is_optimal, margins = pareto_optimal(*games, objective="self")
+    batch_time = time.perf_counter() - start_time
+
+    loop_sample = min(loop_sample, num_games)
+    counts, p0_values, p1_values, p0_scores, p1_scores = games
+    start_time = time.perf_counter()
+    loop_flags = [
+        utils.isParetoOptimal(
+            int(p0_scores[i]),
+            int(p1_scores[i]),
+            item_dict(counts[i], names),
+            item_dict(p0_values[i], names),
+            item_dict(p1_values[i], names),
+            objective="self",
+        )
+        for i in range(loop_sample)
+    ]
+    loop_time = (time.perf_counter() - start_time) * num_games / loop_sample
+
+    return {
+        "games": num_games,
+        "items": len(names),
+        "max_grid_size": int(np.prod(counts + 1.0, axis=1).max()),
+        "batch_seconds": batch_time,
+        "loop_seconds_estimated": loop_time,
+        "speedup": loop_time / batch_time,
+        "agrees_with_loop": bool(np.array_equal(loop_flags, is_optimal[:loop_sample])),
+        "proportion_optimal": float(is_optimal.mean()),
+        "mean_dominance_margin": float(margins.mean()),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="benchmark batched pareto-optimality on synthetic games"
+    )
+    parser.add_argument("-n", "--num_games", type=int, default=100000)
+    parser.add_argument(
+        "--loop_sample",
+        type=int,
+        default=2000,
+        help="Games checked one at a time to time the per-game loop",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--num_items",
+        type=int,
+        default=None,
+        help="Benchmark random games with this many item types instead",
+    )
+    parser.add_argument(
+        "--max_count", type=int, default=4, help="Most items of a type in random games"
+    )
+    args = parser.parse_args()
+
+    report = benchmark(
+        args.num_games, args.loop_sample, args.seed, args.num_items, args.max_count
+    )
+
+    print("PARETO BENCHMARK:")
+    for key, value in report.items():
+        print(f"{key}: {value}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,365 @@
+import argparse
+import copy
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import analysis
+import backends
+import dataset
+import finetune_jobs
+import live_stats
+import results_table
+from contexts import SOURCE
+from items import DEFAULT_ITEMS
+from mock_openai_server import MockOpenAIServer
+from run_manifest import COMPLETE, RunManifest, atomic_write_json
+
+STATE_FILE = "pipeline.json"
+
+# fine-tuning ledgers, kept under the pipeline root; a mock API gets its own
+LEDGER_FILE = "finetune_ledger.json"
+MOCK_LEDGER_FILE = "finetune_ledger_mock.json"
+
+PLAY_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "play.py")
+
+DEFAULTS = {
+    "base_model": "gpt-3.5-turbo",
+    "iterations": 1,
+    "play": {
+        "objective": "self",
+        "temperature": 1.0,
+        "num_runs": 100,
+        "seed": 0,
+        "sampling": "pairs",
+        "storage": "files",
+        "items": DEFAULT_ITEMS,
+        "contexts": SOURCE,
+        "prompt_layout": "original",
+        "backend": "openai",
+        "concurrency": 8,
+        "attempts": 2,
+        "extra_args": [],
+    },
+    "dataset": {"filter": "above_avg", "cumulative": False, "workers": None},
+    "finetune": {
+        "suffix": "iter{iteration:02d}",
+        "hyperparameters": finetune_jobs.HYPERPARAMETERS,
+    },
+    "overrides": {},
+}
+
+# play settings that change how a run is played, but not its games
+UNFINGERPRINTED = ["concurrency", "attempts", "extra_args"]
+
+
+def fingerprint(stage, inputs):
+    # identifies a stage's output by everything it is computed from
+    data = json.dumps([stage, inputs], sort_keys=True)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()[:16]
+
+
+def merge(base, changes):
+    # base with the keys of changes replaced, recursing into sections
+    merged = copy.deepcopy(base)
+    for key, value in changes.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+def play_complete(run_dir):
+    if not RunManifest.exists(run_dir):
+        return False
+    manifest = RunManifest.load(run_dir)
+    return manifest.count(COMPLETE) == len(manifest.games)
+
+
+def has_rows(run_dir):
+    # a run's table exists once its first game has finished
+    path = f"{run_dir}/{results_table.TABLE_FILE}"
+    return os.path.exists(path) and results_table.read_header(path) is not None
+
+
+def play_command(model, run_dir, settings):
+    command = [
+        sys.executable,
+        PLAY_SCRIPT,
+        "-m",
+        model,
+        "-o",
+        settings["objective"],
+        "-t",
+        str(settings["temperature"]),
+        "-n",
+        str(settings["num_runs"]),
+        "-d",
+        run_dir,
+        "-c",
+        str(settings["concurrency"]),
+        "--backend",
+        settings["backend"],
+        "--sampling",
+        settings["sampling"],
+        "--storage",
+        settings["storage"],
+        "--contexts",
+        settings["contexts"],
+        "--prompt_layout",
+        settings["prompt_layout"],
+        "--items",
+        *settings["items"],
+    ]
+    if settings["seed"] is not None:
+        command += ["--seed", str(settings["seed"])]
+    if RunManifest.exists(run_dir):
+        command.append("--resume")
+    return command + list(settings["extra_args"])
+
+
+class PipelineState:
+    """Outputs of the finished stages of a pipeline, kept in pipeline.json.
+
+    Stages are keyed by the fingerprint of their inputs, so a stage whose
+    inputs have not changed is not run again, and changing a setting only
+    reruns the stages that depend on it.
+    """
+
+    def __init__(self, root):
+        self.path = f"{root}/{STATE_FILE}"
+        self.stages = {}
+        if os.path.exists(self.path):
+            with open(self.path, "r") as state_file:
+                self.stages = json.load(state_file)["stages"]
+
+    def output(self, stage, key):
+        record = self.stages.get(f"{stage}-{key}")
+        return None if record is None else record["output"]
+
+    def record(self, stage, key, output):
+        self.stages[f"{stage}-{key}"] = {"output": output, "finished_at": time.time()}
+        atomic_write_json(self.path, {"stages": self.stages})
+
+
+class Pipeline:
+    """Iterated self-play: play, build a training set, fine-tune, repeat.
+
+    Each iteration plays a run with the current model (in a play.py process),
+    builds a training file from it (or from every run so far, with
+    cumulative), and fine-tunes the model the next iteration plays with. While
+    a run is being played, its finished games are folded into live stats and
+    the training file every interval seconds, so both are nearly done when
+    play ends; the run is then analyzed while the fine-tuning job runs. After
+    the last fine-tuning round, the final model plays an evaluation run.
+
+    Stage outputs are named by the fingerprint of their inputs. An interrupted
+    pipeline picks up where it stopped when run again: finished stages are
+    skipped, a run is resumed, the training file is updated incrementally, and
+    a fine-tuning job that is still going is polled instead of restarted.
+    """
+
+    def __init__(self, config, interval=30, poll_interval=10, mock_api=False):
+        self.config = merge(DEFAULTS, config)
+        self.root = self.config["root"]
+        self.interval = interval
+        self.poll_interval = poll_interval
+        self.mock_api = mock_api
+        os.makedirs(self.root, exist_ok=True)
+        self.state = PipelineState(self.root)
+        self.jobs = None
+        self.play_keys = []
+        self.run_dirs = []
+
+    def settings(self, iteration):
+        return merge(self.config, self.config["overrides"].get(str(iteration), {}))
+
+    def run(self):
+        model = self.config["base_model"]
+        summaries = []
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            for iteration in range(self.config["iterations"] + 1):
+                final = iteration == self.config["iterations"]
+                model, summary = self.run_iteration(iteration, model, final, executor)
+                summaries.append(summary)
+
+        for iteration, (played_model, num_games, stats) in enumerate(summaries):
+            print(f"iteration {iteration} ({played_model}):")
+            live_stats.print_summary(stats, num_games)
+        return model
+
+    def run_iteration(self, iteration, model, final, executor):
+        # returns the model the next iteration plays with, and this run's stats
+        settings = self.settings(iteration)
+        play_settings = settings["play"]
+        objective = play_settings["objective"]
+
+        play_inputs = {
+            name: value
+            for name, value in play_settings.items()
+            if name not in UNFINGERPRINTED
+        }
+        play_key = fingerprint("play", {"model": model, **play_inputs})
+        run_dir = f"{self.root}/iter{iteration:02d}-{play_key}"
+        self.play_keys.append(play_key)
+        self.run_dirs.append(run_dir)
+
+        # the runs the training file is built from
+        dataset_settings = settings["dataset"]
+        if dataset_settings["cumulative"]:
+            dataset_runs, dataset_keys = list(self.run_dirs), list(self.play_keys)
+        else:
+            dataset_runs, dataset_keys = [run_dir], [play_key]
+        dataset_key = fingerprint(
+            "dataset",
+            {
+                "runs": dataset_keys,
+                "filter": dataset_settings["filter"],
+                "objective": objective,
+            },
+        )
+        dataset_path = f"{self.root}/train-{dataset_key}.jsonl"
+        build = None if final else (dataset_runs, dataset_path, dataset_settings)
+
+        print(f"iteration {iteration}: playing {model} into {run_dir}")
+        self.play(model, run_dir, play_key, play_settings, build)
+
+        if not final and self.state.output("dataset", dataset_key) is None:
+            self.build(objective, *build)
+            self.state.record("dataset", dataset_key, dataset_path)
+
+        # the run is analyzed while the next model trains
+        stats = executor.submit(analysis.cached_analyze, run_dir, objective)
+        next_model = model
+        if not final:
+            next_model = self.finetune(
+                iteration, model, dataset_path, dataset_key, settings["finetune"]
+            )
+        return next_model, (model, play_settings["num_runs"], stats.result()[0])
+
+    def play(self, model, run_dir, play_key, settings, build):
+        if self.state.output("play", play_key) is not None:
+            print(f"{run_dir}: already played")
+            return
+
+        for attempt in range(settings["attempts"]):
+            process = subprocess.Popen(play_command(model, run_dir, settings))
+            try:
+                num_games = None
+                while True:
+                    try:
+                        process.wait(timeout=self.interval)
+                        break
+                    except subprocess.TimeoutExpired:
+                        pass
+                    num_games = self.stream(run_dir, settings, build, num_games)
+            finally:
+                if process.poll() is None:
+                    process.terminate()
+                    process.wait()
+            self.stream(run_dir, settings, build, num_games)
+            if play_complete(run_dir):
+                self.state.record("play", play_key, run_dir)
+                return
+            print(f"{run_dir}: play attempt {attempt + 1} left games unfinished")
+        raise Exception(f"{run_dir} has unfinished games; run the pipeline again")
+
+    def stream(self, run_dir, settings, build, num_games):
+        # folds the games finished so far into the live stats and training file
+        if not has_rows(run_dir):
+            return num_games
+        state = live_stats.update(run_dir, settings["objective"])
+        if state["stats"]["num_games"] != num_games:
+            num_games = state["stats"]["num_games"]
+            live_stats.print_summary(live_stats.summarize(state), num_games)
+            if build is not None:
+                self.build(settings["objective"], *build)
+        return num_games
+
+    def build(self, objective, dir_paths, output_path, settings):
+        dataset.build_dataset(
+            dir_paths,
+            output_path,
+            settings["filter"],
+            objective == "comp",
+            settings["workers"],
+        )
+
+    def finetune(self, iteration, model, dataset_path, dataset_key, settings):
+        suffix = settings["suffix"].format(iteration=iteration)
+        inputs = {
+            "dataset": dataset_key,
+            "model": model,
+            "suffix": suffix,
+            "hyperparameters": settings["hyperparameters"],
+        }
+        # models fine-tuned by the mock API are never used for real runs
+        if self.mock_api:
+            inputs["mock_api"] = True
+        key = fingerprint("finetune", inputs)
+        fine_tuned_model = self.state.output("finetune", key)
+        if fine_tuned_model is not None:
+            print(f"{dataset_path}: already fine-tuned as {fine_tuned_model}")
+            return fine_tuned_model
+
+        if os.path.getsize(dataset_path) == 0:
+            raise Exception(f"{dataset_path} has no samples to train on")
+        if self.jobs is None:
+            ledger_file = MOCK_LEDGER_FILE if self.mock_api else LEDGER_FILE
+            ledger = finetune_jobs.JobLedger(f"{self.root}/{ledger_file}")
+            self.jobs = finetune_jobs.JobManager(ledger=ledger)
+        job = self.jobs.submit(
+            dataset_path, model, suffix, settings["hyperparameters"]
+        )
+        job = self.jobs.wait([job["id"]], interval=self.poll_interval)[0]
+        if job["status"] != "succeeded":
+            raise Exception(
+                f"fine-tuning job {job['id']} {job['status']}: {job.get('error')}"
+            )
+        self.state.record("finetune", key, job["fine_tuned_model"])
+        return job["fine_tuned_model"]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="run iterated self-play: play, build a training set, fine-tune"
+    )
+    parser.add_argument("-c", "--config", type=str, help="Pipeline config (JSON)")
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=30,
+        help="Seconds between live updates while a run is played",
+    )
+    parser.add_argument(
+        "--poll", type=float, default=10, help="Initial fine-tuning polling interval"
+    )
+    parser.add_argument(
+        "--mock_api",
+        action="store_true",
+        help="Fine-tune against a local stand-in for the API (see mock_openai_server)",
+    )
+    args = parser.parse_args()
+
+    with open(args.config, "r") as config_file:
+        config = json.load(config_file)
+
+    if args.mock_api:
+        server = MockOpenAIServer(job_polls=2).start()
+        os.environ["OPENAI_BASE_URL"] = server.url
+        os.environ.setdefault("OPENAI_API_KEY", "mock")
+        backends.configure_client(base_url=server.url)
+
+    start_time = time.time()
+    model = Pipeline(config, args.interval, args.poll, args.mock_api).run()
+    print(f"final model: {model}")
+    print(f"The pipeline took {time.time() - start_time} seconds to complete.")
+
+
+if __name__ == "__main__":
+    main()
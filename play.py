@@ -1,51 +1,519 @@
 import time
 import json
 import argparse
+import asyncio
+import glob
+import multiprocessing
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from players import ClosedSourceChatPlayer
+from call_metrics import CallMetrics, METRICS_FILE
+from llm_cache import CachedBackend, ResponseCache, CACHE_MODES
+from scheduler import RequestScheduler, ScheduledBackend
+from run_manifest import RunManifest, COMPLETE, FAILED, RUNNING
+from run_store import RunStore, StoreReader, game_record, TEXT_LOGS
+from results_table import ResultsTable, TABLE_FILE, merge_tables
+from contexts import ContextIndex, SAMPLING_MODES, SOURCE
+from items import DEFAULT_ITEMS, ItemSchema
+import backends
+import prompt_registry
 from games.negotiation import NegotiationGame
 
 import numpy as np
 import os
 
 def simulate_trials(
-    model_id, output_dir, temperature, objective="self", num_runs=1, selfplay=True
+    model_id,
+    output_dir,
+    temperature,
+    objective="self",
+    num_runs=1,
+    selfplay=True,
+    concurrency=1,
+    seed=None,
+    shards=1,
+    shard_id=None,
+    backend=None,
+    resume=False,
+    storage="files",
+    sampling="pairs",
+    items=DEFAULT_ITEMS,
+    context_source=SOURCE,
+    prompt_layout="original",
 ):
     # this function simulates num_runs trials of the game
 
-    # sample from possible game contexts
-    with open("data/selfplay.txt", "r") as file:
-        # read lines into a list, stripping the newline character from each line
-        lines = [line.strip() for line in file]
+    # sample from possible game contexts (compiled from data/selfplay.txt unless
+    # another context file is given), which must list one count and value pair
+    # for each item type
+    contexts = ContextIndex(context_source)
+    schema = ItemSchema(items)
+    if contexts.counts.shape[1] != len(schema):
+        raise Exception(
+            f"{context_source} has {contexts.counts.shape[1]} item types, "
+            f"but {len(schema)} items were given"
+        )
 
-    random_indices = np.random.randint(0, 4085, size=num_runs)
+    # a sharded run plays every shards-th game into its own slice directory
+    if shard_id is not None:
+        if seed is None:
+            raise Exception("sharded runs require a run seed")
+        write_shard_info(output_dir, num_runs, shards, shard_id, seed)
+        output_dir = shard_dir(output_dir, shard_id)
+        game_numbers = list(range(shard_id, num_runs, shards))
+    else:
+        game_numbers = list(range(num_runs))
 
-    p0_outcomes = []
-    p1_outcomes = []
+    # create log directories if starting a completely new run; a run store keeps
+    # every game in a single file instead
+    if storage == "store":
+        os.makedirs(output_dir, exist_ok=True)
+        store = RunStore(output_dir)
+    else:
+        store = None
 
-    # create log directories if starting a completely new run
-    if not os.path.exists(f"{output_dir}/json_logs"):
+    if storage == "files" and not os.path.exists(f"{output_dir}/json_logs"):
         os.makedirs(f"{output_dir}/json_logs")
 
-    if not os.path.exists(f"{output_dir}/text_logs"):
+    if storage == "files" and not os.path.exists(f"{output_dir}/text_logs"):
         os.makedirs(f"{output_dir}/text_logs")
 
-    if not os.path.exists(f"{output_dir}/results"):
+    if storage == "files" and not os.path.exists(f"{output_dir}/results"):
         os.makedirs(f"{output_dir}/results")
 
-    if objective == "self":
-        prompt_path = "prompts/dond.txt"
-    elif objective == "coop":
-        prompt_path = "prompts/coop_dond.txt"
+    # the manifest records every game's context and seed up front, and its status
+    # as the run progresses, so an interrupted run can be resumed
+    config = {
+        "model": model_id,
+        "objective": objective,
+        "temperature": temperature,
+        "num_runs": num_runs,
+        "seed": seed,
+        "storage": storage,
+        "sampling": sampling,
+        "items": list(items),
+        "contexts": context_source,
+        "prompt_layout": prompt_layout,
+    }
+    if RunManifest.exists(output_dir):
+        if not resume:
+            raise Exception(f"{output_dir} already has a run; use --resume")
+        manifest = RunManifest.load(output_dir)
+        manifest.config.setdefault("storage", "files")
+        manifest.config.setdefault("sampling", "pairs")
+        manifest.config.setdefault("items", list(DEFAULT_ITEMS))
+        manifest.config.setdefault("contexts", SOURCE)
+        manifest.config.setdefault("prompt_layout", "original")
+        if manifest.config != config:
+            raise Exception(f"run settings do not match {manifest.path}")
+    else:
+        manifest = RunManifest(output_dir, config)
+        for i in game_numbers:
+            # with a run seed, each game draws its context and turn order from its
+            # own generator, so a game is reproducible in whichever process plays it
+            if seed is not None:
+                context_index = contexts.sample(sampling, game_rng(seed, i))
+                manifest.add_game(game_index(i), context_index, game_seed(seed, i))
+            else:
+                manifest.add_game(game_index(i), contexts.sample(sampling), None)
+        manifest.save()
+
+    # skip games that already finished; partial and failed games are replayed
+    trials = []
+    for i in game_numbers:
+        game = manifest.games[game_index(i)]
+        if game["status"] == COMPLETE:
+            continue
+        rng = None
+        if seed is not None:
+            rng = trial_rng(seed, i, contexts, sampling)
+        trials.append((i, game["context_index"], rng, game["seed"]))
+
+    if resume:
+        num_complete = len(game_numbers) - len(trials)
+        print(f"resuming: {num_complete} games complete, {len(trials)} to play")
+
+    # prompt templates are loaded once, before any game is played
+    prompt_path = prompt_registry.prompt_path(objective, schema)
+    prompt_registry.get_registry().template(prompt_path)
+
+    trial_args = {
+        "model_name": model_id,
+        "output_dir": output_dir,
+        "temperature": temperature,
+        "objective": objective,
+        "prompt_path": prompt_path,
+        "selfplay": selfplay,
+        "backend": backend,
+        "store": store,
+        "table": ResultsTable(output_dir),
+        "schema": schema,
+        "prompt_layout": prompt_layout,
+        "metrics": CallMetrics(output_dir),
+    }
+
+    # stored runs have no score files; readers take the scores from the records
+    if store is None:
+        score_writer = ScoreWriter(output_dir, manifest, game_numbers)
+    else:
+        score_writer = None
+
+    # play the games one after another, or keep several games in flight at once
+    if concurrency > 1:
+        if not selfplay:
+            raise Exception("concurrent games are only supported for selfplay")
+        outcomes = asyncio.run(
+            run_trials_async(
+                contexts, trials, manifest, score_writer, trial_args, concurrency
+            )
+        )
+    else:
+        outcomes = [
+            run_trial(trial, contexts, manifest, score_writer, trial_args)
+            for trial in trials
+        ]
+    outcomes = [outcome for outcome in outcomes if outcome is not None]
+    if store is not None:
+        store.close()
+    trial_args["metrics"].close()
+
+    # fold the status log back into manifest.json
+    manifest.save()
+
+    p0_outcomes = [outcome["p0_score"] for outcome in outcomes]
+    p1_outcomes = [outcome["p1_score"] for outcome in outcomes]
+
+    # evaluate player outcomes
+    print("p0 mean:", np.mean(p0_outcomes))
+    print("p1 mean:", np.mean(p1_outcomes))
+    print("connections:", backends.connection_stats.summary())
+    if hasattr(backend, "stats"):
+        print("backend:", backend.stats())
+
+    num_failed = manifest.count(FAILED)
+    if num_failed > 0:
+        print(f"{num_failed} games failed; rerun with --resume to retry them")
+
+
+async def run_trials_async(
+    contexts, trials, manifest, score_writer, trial_args, concurrency
+):
+    # play_game blocks on the API, so each game runs in its own worker thread;
+    # the semaphore caps the number of games in flight
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=concurrency))
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_one(trial):
+        async with semaphore:
+            return await asyncio.to_thread(
+                run_trial, trial, contexts, manifest, score_writer, trial_args
+            )
+
+    return await asyncio.gather(*[run_one(trial) for trial in trials])
+
+
+def run_trial(trial, contexts, manifest, score_writer, trial_args):
+    # plays one game and records its status; a failed game does not stop the run
+    i, context_index, rng, api_seed = trial
+    index = game_index(i)
+
+    # drop anything left behind by an earlier, interrupted attempt (a store only
+    # gets a game's record once it has finished)
+    if trial_args["store"] is None:
+        clear_game_files(trial_args["output_dir"], index)
+    manifest.set_status(index, RUNNING)
+
+    try:
+        game_outcome = play_trial(
+            i, contexts, context_index, rng=rng, api_seed=api_seed, **trial_args
+        )
+    except Exception as error:
+        manifest.set_status(index, FAILED, error=repr(error))
+        print(f"game {index} failed: {error!r}")
+        return None
+
+    manifest.set_status(index, COMPLETE)
+    if score_writer is not None:
+        score_writer.update()
+    return game_outcome
+
+
+class ScoreWriter:
+    """Keeps p0_scores/p1_scores in game order as games complete.
+
+    The score files are read positionally, so a game's scores are only appended
+    once every game before it in the run has completed.
+    """
+
+    def __init__(self, output_dir, manifest, game_numbers):
+        self.output_dir = output_dir
+        self.manifest = manifest
+        self.game_numbers = game_numbers
+        self.position = 0
+        self.lock = threading.Lock()
+
+        # rebuild the files from the completed games, which drops any lines an
+        # interrupted run appended for games that did not finish
+        for score_file in ["p0_scores", "p1_scores"]:
+            if os.path.exists(f"{output_dir}/{score_file}"):
+                os.remove(f"{output_dir}/{score_file}")
+        self.update()
+
+    def update(self):
+        with self.lock:
+            summaries = []
+            while self.position < len(self.game_numbers):
+                index = game_index(self.game_numbers[self.position])
+                if self.manifest.status(index) != COMPLETE:
+                    break
+                with open(f"{self.output_dir}/results/{index}.json", "r") as f:
+                    summaries.append(json.load(f))
+                self.position += 1
+            write_scores(self.output_dir, summaries)
+
+
+def clear_game_files(output_dir, index):
+    for path in [
+        f"{output_dir}/text_logs/{index}_full.txt",
+        f"{output_dir}/text_logs/{index}_p0.txt",
+        f"{output_dir}/text_logs/{index}_p1.txt",
+        f"{output_dir}/json_logs/{index}_p0.json",
+        f"{output_dir}/json_logs/{index}_p1.json",
+        f"{output_dir}/results/{index}.json",
+    ]:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def game_index(i):
+    # zero-padded game number used in log file names
+    return f"{i:03d}"
+
+
+def game_rng(seed, i):
+    # per-game generator derived from the run seed and the game number
+    return np.random.default_rng([seed, i])
+
+
+def trial_rng(seed, i, contexts, sampling):
+    # the game's generator, advanced past the draw of its context
+    rng = game_rng(seed, i)
+    contexts.sample(sampling, rng)
+    return rng
+
+
+def game_seed(seed, i):
+    # per-game API sampling seed, independent of the game's generator stream
+    return int(np.random.SeedSequence([seed, i]).generate_state(1)[0])
+
+
+def shard_dir(output_dir, shard_id):
+    return f"{output_dir}/shards/{shard_id:03d}"
+
+
+def write_shard_info(output_dir, num_runs, shards, shard_id, seed):
+    # record the split so that the merge step can check that every game was played
+    os.makedirs(shard_dir(output_dir, shard_id), exist_ok=True)
+    with open(f"{shard_dir(output_dir, shard_id)}/shard.json", "w") as shard_file:
+        shard_info = {
+            "num_runs": num_runs,
+            "shards": shards,
+            "shard_id": shard_id,
+            "seed": seed,
+        }
+        json.dump(shard_info, shard_file)
+
+
+def run_shards(
+    model_id,
+    output_dir,
+    temperature,
+    objective,
+    num_runs,
+    concurrency,
+    seed,
+    shards,
+    backend=None,
+    resume=False,
+    storage="files",
+    sampling="pairs",
+    items=DEFAULT_ITEMS,
+    context_source=SOURCE,
+    prompt_layout="original",
+):
+    # compile the context index once, before the shard processes need it
+    ContextIndex(context_source)
+
+    # run every shard in its own local process, then merge the slices
+    shard_args = [
+        (
+            model_id,
+            output_dir,
+            temperature,
+            objective,
+            num_runs,
+            True,
+            concurrency,
+            seed,
+            shards,
+            shard_id,
+            backend,
+            resume,
+            storage,
+            sampling,
+            items,
+            context_source,
+            prompt_layout,
+        )
+        for shard_id in range(shards)
+    ]
+    with multiprocessing.Pool(shards) as pool:
+        pool.starmap(simulate_trials, shard_args)
+
+    merge_shards(output_dir)
+
+
+def merge_shards(output_dir):
+    # combine the shard slices into a single run directory laid out exactly like
+    # a single-process run with the same seed
+    shard_paths = sorted(glob.glob(f"{output_dir}/shards/*/shard.json"))
+    if len(shard_paths) == 0:
+        raise Exception(f"no shards found in {output_dir}/shards")
+
+    shard_infos = []
+    for shard_path in shard_paths:
+        with open(shard_path, "r") as shard_file:
+            shard_infos.append(json.load(shard_file))
+
+    num_runs = shard_infos[0]["num_runs"]
+    shards = shard_infos[0]["shards"]
+    seed = shard_infos[0]["seed"]
+    for info in shard_infos:
+        if (info["num_runs"], info["shards"], info["seed"]) != (num_runs, shards, seed):
+            raise Exception(f"shards in {output_dir} come from different runs")
+
+    shard_manifests = [
+        RunManifest.load(shard_dir(output_dir, info["shard_id"]))
+        for info in shard_infos
+    ]
+    merged_manifest = RunManifest(output_dir, shard_manifests[0].config)
+    for shard_manifest in shard_manifests:
+        merged_manifest.games.update(shard_manifest.games)
+
+    for i in range(num_runs):
+        index = game_index(i)
+        if merged_manifest.games.get(index, {}).get("status") != COMPLETE:
+            raise Exception(f"game {index} is not complete in shard {i % shards}")
+
+    if merged_manifest.config.get("storage", "files") == "store":
+        merge_shard_stores(output_dir, num_runs, shards)
     else:
-        prompt_path = "prompts/comp_dond.txt"
+        merge_shard_files(output_dir, num_runs, shards)
+    merge_tables(
+        [shard_dir(output_dir, shard_id) for shard_id in range(shards)],
+        f"{output_dir}/{TABLE_FILE}",
+    )
+    merge_metrics(output_dir, shards)
 
-    model_name = model_id
+    merged_manifest.games = dict(
+        sorted(merged_manifest.games.items(), key=lambda item: int(item[0]))
+    )
+    merged_manifest.save()
+
+    print(f"merged {num_runs} games from {len(shard_infos)} shards into {output_dir}")
+
+
+def merge_metrics(output_dir, shards):
+    # the shards' call metrics, one shard after another
+    with open(f"{output_dir}/{METRICS_FILE}", "w") as metrics_file:
+        for shard_id in range(shards):
+            path = f"{shard_dir(output_dir, shard_id)}/{METRICS_FILE}"
+            if os.path.exists(path):
+                with open(path, "r") as shard_metrics:
+                    shutil.copyfileobj(shard_metrics, metrics_file)
+
+
+def merge_shard_stores(output_dir, num_runs, shards):
+    # records are copied verbatim, in game order, into a fresh store
+    for path in [f"{output_dir}/games.jsonl", f"{output_dir}/games.idx"]:
+        if os.path.exists(path):
+            os.remove(path)
+
+    readers = [
+        StoreReader(shard_dir(output_dir, shard_id)) for shard_id in range(shards)
+    ]
+    store = RunStore(output_dir)
+    try:
+        for i in range(num_runs):
+            store.append_raw(game_index(i), readers[i % shards].raw(game_index(i)))
+    finally:
+        store.close()
+        for reader in readers:
+            reader.close()
+
+
+def merge_shard_files(output_dir, num_runs, shards):
+    for subdir in ["json_logs", "text_logs", "results"]:
+        os.makedirs(f"{output_dir}/{subdir}", exist_ok=True)
+
+    game_outcomes = []
+    for i in range(num_runs):
+        index = game_index(i)
+        source_dir = shard_dir(output_dir, i % shards)
+
+        for suffix in ["_full.txt", "_p0.txt", "_p1.txt"]:
+            shutil.copy(
+                f"{source_dir}/text_logs/{index}{suffix}",
+                f"{output_dir}/text_logs/{index}{suffix}",
+            )
+        for suffix in ["_p0.json", "_p1.json"]:
+            shutil.copy(
+                f"{source_dir}/json_logs/{index}{suffix}",
+                f"{output_dir}/json_logs/{index}{suffix}",
+            )
+        shutil.copy(
+            f"{source_dir}/results/{index}.json", f"{output_dir}/results/{index}.json"
+        )
 
-    for i in range(0, num_runs):
-        # initialize log files for trial i
-        index = ("000" + str(i))[-3:]
+        with open(f"{output_dir}/results/{index}.json", "r") as results_file:
+            game_outcomes.append(json.load(results_file))
+
+    # the score files are rebuilt in game order from the results
+    for score_file in ["p0_scores", "p1_scores"]:
+        if os.path.exists(f"{output_dir}/{score_file}"):
+            os.remove(f"{output_dir}/{score_file}")
+    write_scores(output_dir, game_outcomes)
+
+
+def play_trial(
+    i,
+    contexts,
+    context_index,
+    model_name,
+    output_dir,
+    temperature,
+    objective,
+    prompt_path,
+    selfplay=True,
+    rng=None,
+    backend=None,
+    api_seed=None,
+    store=None,
+    table=None,
+    schema=None,
+    prompt_layout="original",
+    metrics=None,
+):
+    # initialize log files for trial i
+    index = game_index(i)
 
+    if store is not None:
+        # logs are only kept in memory and stored with the game's record
+        game_filename = p0_filename = p1_filename = None
+    else:
         # full log
         game_filename = f"{output_dir}/text_logs/" + index + "_full.txt"
         open(game_filename, "x")
@@ -59,78 +527,113 @@ def simulate_trials(
         open(f"{output_dir}/json_logs/{index}_p0.json", "x")
         open(f"{output_dir}/json_logs/{index}_p1.json", "x")
 
-        # configure the game with randomly chosen item counts and values
-        cnts, p1_vals = parse_context(lines[random_indices[i] * 2])
-        _, p2_vals = parse_context(lines[random_indices[i] * 2 + 1])
-
-        keys = ["book", "hat", "ball"]
-
-        # initialize the game with the chosen configurations
-        game = NegotiationGame(
-            game_index=index,
-            item_counts={keys[i]: cnts[i] for i in range(3)},
-            p1_values={keys[i]: p1_vals[i] for i in range(3)},
-            p2_values={keys[i]: p2_vals[i] for i in range(3)},
-            game_log_filename=game_filename,
-            objective=objective,
+    # configure the game with randomly chosen item counts and values
+    cnts, p1_vals, p2_vals = contexts.context(context_index)
+
+    schema = schema if schema is not None else ItemSchema()
+
+    # initialize the game with the chosen configurations
+    game = NegotiationGame(
+        game_index=index,
+        item_counts=schema.to_dict(cnts),
+        p1_values=schema.to_dict(p1_vals),
+        p2_values=schema.to_dict(p2_vals),
+        game_log_filename=game_filename,
+        objective=objective,
+        rng=rng,
+        schema=schema,
+        prompt_layout=prompt_layout,
+    )
+    print(game_filename or f"game {index}")
+
+    # initialize the players, depending on whether we are doing selfplay or have a human in the loop
+    if selfplay:
+        print("item counts: ", game.item_counts)
+        players = [
+            ClosedSourceChatPlayer(
+                game,
+                game.player_values[0],
+                log_filename=p0_filename,
+                temperature=temperature,
+                model=model_name,
+                prompt_path=prompt_path,
+                backend=backend,
+                seed=api_seed,
+                priority=i,
+                metrics=metrics,
+                player_index=0,
+            ),
+            ClosedSourceChatPlayer(
+                game,
+                game.player_values[1],
+                log_filename=p1_filename,
+                temperature=temperature,
+                model=model_name,
+                prompt_path=prompt_path,
+                backend=backend,
+                seed=api_seed,
+                priority=i,
+                metrics=metrics,
+                player_index=1,
+            ),
+        ]
+    else:
+        players = [
+            ClosedSourceChatPlayer(
+                game,
+                game.player_values[1],
+                log_filename=p1_filename,
+                selfplay=True,
+                model=model_name,
+                prompt_path=prompt_path,
+            ),
+            ClosedSourceChatPlayer(
+                game,
+                game.player_values[1],
+                log_filename=p1_filename,
+                selfplay=True,
+                model="gpt-3.5-turbo",
+                prompt_path=prompt_path,
+            ),
+        ]
+
+        # if human is playing, we need to tell them the item counts and their values for each item
+        print("Your values: ", game.player_values[0])
+        print("Item counts: ", game.item_counts)
+
+    # play the game
+    game_outcome = game.play_game(players)
+
+    # log the game context
+    summary = {
+        "counts": game.item_counts,
+        "p0_values": game.player_values[0],
+        "p1_values": game.player_values[1],
+        "p0_allocation": game.proposals[0],
+        "p1_allocation": game.proposals[1],
+        "p0_score": game_outcome["p0_score"],
+        "p1_score": game_outcome["p1_score"],
+        "message_count": game_outcome["msg_cnt"],
+        "token_count": game_outcome["token_cnt"],
+        "usage": game_outcome["usage"],
+        "is_valid_deal": game_outcome["is_valid_deal"],
+        "aborted": game_outcome["aborted"],
+        "context_index": int(context_index),
+        "context_id": contexts.context_id(context_index),
+    }
+
+    if store is not None:
+        text_logs = [game.log_text, players[0].log_text, players[1].log_text]
+        store.append(
+            game_record(
+                index,
+                summary,
+                game_outcome["p0_log"],
+                game_outcome["p1_log"],
+                {name: "".join(log) for name, log in zip(TEXT_LOGS, text_logs)},
+            )
         )
-        print(game_filename)
-
-        # initialize the players, depending on whether we are doing selfplay or have a human in the loop
-        if selfplay:
-            print("item counts: ", game.item_counts)
-            players = [
-                ClosedSourceChatPlayer(
-                    game,
-                    game.player_values[0],
-                    log_filename=p0_filename,
-                    temperature=temperature,
-                    model=model_name,
-                    prompt_path=prompt_path,
-                ),
-                ClosedSourceChatPlayer(
-                    game,
-                    game.player_values[1],
-                    log_filename=p1_filename,
-                    temperature=temperature,
-                    model=model_name,
-                    prompt_path=prompt_path,
-                ),
-            ]
-        else:
-            players = [
-                ClosedSourceChatPlayer(
-                    game,
-                    game.player_values[1],
-                    log_filename=p1_filename,
-                    selfplay=True,
-                    model=model_name,
-                    prompt_path=prompt_path,
-                ),
-                ClosedSourceChatPlayer(
-                    game,
-                    game.player_values[1],
-                    log_filename=p1_filename,
-                    selfplay=True,
-                    model="gpt-3.5-turbo",
-                    prompt_path=prompt_path,
-                ),
-            ]
-
-            # if human is playing, we need to tell them the item counts and their values for each item
-            print("Your values: ", game.player_values[0])
-            print("Item counts: ", game.item_counts)
-
-        # play the game
-        game_outcome = game.play_game(players)
-
-        # write scores to score files
-        with open(f"{output_dir}/p0_scores", "a") as p0_scores, open(
-            f"{output_dir}/p1_scores", "a"
-        ) as p1_scores:
-            p0_scores.write(f"{game_outcome['p0_score']} \n")
-            p1_scores.write(f"{game_outcome['p1_score']} \n")
-
+    else:
         # write logs to JSON log files
         with open(f"{output_dir}/json_logs/{index}_p0.json", "w") as p0_log_file, open(
             f"{output_dir}/json_logs/{index}_p1.json", "w"
@@ -138,37 +641,24 @@ def simulate_trials(
             json.dump(game_outcome["p0_log"], p0_log_file)
             json.dump(game_outcome["p1_log"], p1_log_file)
 
-        # log the game context
-        summary = {
-            "counts": game.item_counts,
-            "p0_values": game.player_values[0],
-            "p1_values": game.player_values[1],
-            "p0_allocation": game.proposals[0],
-            "p1_allocation": game.proposals[1],
-            "p0_score": game_outcome["p0_score"],
-            "p1_score": game_outcome["p1_score"],
-            "message_count": game_outcome["msg_cnt"],
-            "token_count": game_outcome["token_cnt"],
-            "is_valid_deal": game_outcome["is_valid_deal"],
-        }
         with open(f"{output_dir}/results/{index}.json", "w") as summary_log:
             json.dump(summary, summary_log)
 
-        # append to the list of simulated player outcomes
-        p0_outcomes.append(game_outcome["p0_score"])
-        p1_outcomes.append(game_outcome["p1_score"])
+    # the results table row goes last, once the game's full record exists
+    if table is not None:
+        table.append(index, summary)
 
-    # evaluate player outcomes
-    print("p0 mean:", np.mean(p0_outcomes))
-    print("p1 mean:", np.mean(p1_outcomes))
+    return game_outcome
 
 
-def parse_context(ctx):
-    # ctx is the string
-    ctx = ctx.split()
-    cnts = [int(n) for n in ctx[0::2]]
-    vals = [int(v) for v in ctx[1::2]]
-    return cnts, vals
+def write_scores(output_dir, game_outcomes):
+    # append scores to the score files, one line per game
+    with open(f"{output_dir}/p0_scores", "a") as p0_scores, open(
+        f"{output_dir}/p1_scores", "a"
+    ) as p1_scores:
+        for game_outcome in game_outcomes:
+            p0_scores.write(f"{game_outcome['p0_score']} \n")
+            p1_scores.write(f"{game_outcome['p1_score']} \n")
 
 
 def main():
@@ -184,6 +674,108 @@ def main():
     parser.add_argument("-t", "--temp", type=float, help="Temperature")
     parser.add_argument("-n", "--num_runs", type=int, help="Number of self-play games")
     parser.add_argument("-d", "--output_dir", type=str, help="Output directory")
+    parser.add_argument(
+        "-c",
+        "--concurrency",
+        type=int,
+        default=1,
+        help="Number of games played concurrently",
+    )
+    parser.add_argument(
+        "--pool_size", type=int, default=None, help="Max pooled API connections"
+    )
+    parser.add_argument(
+        "--timeout", type=float, default=None, help="API request timeout (seconds)"
+    )
+    parser.add_argument(
+        "--backend",
+        type=str,
+        default="openai",
+        choices=["openai", "mock"],
+        help="Chat backend (mock plays offline)",
+    )
+    parser.add_argument(
+        "--rpm", type=float, default=None, help="Request budget per minute"
+    )
+    parser.add_argument("--tpm", type=float, default=None, help="Token budget per minute")
+    parser.add_argument(
+        "--max_in_flight",
+        type=int,
+        default=256,
+        help="Upper bound on the adaptive number of requests in flight",
+    )
+    parser.add_argument(
+        "--target_latency",
+        type=float,
+        default=None,
+        help="Request latency (seconds) above which concurrency is reduced",
+    )
+    parser.add_argument(
+        "--cache_path", type=str, default=None, help="Response cache file"
+    )
+    parser.add_argument(
+        "--cache_mode",
+        type=str,
+        default="record",
+        choices=CACHE_MODES,
+        help="Response cache mode (record needs --seed when --temp is above 0)",
+    )
+    parser.add_argument(
+        "--cache_max_mb", type=float, default=1024, help="Response cache size limit"
+    )
+    parser.add_argument("--seed", type=int, default=None, help="Run seed")
+    parser.add_argument(
+        "--shards", type=int, default=1, help="Number of shards to split the run into"
+    )
+    parser.add_argument(
+        "--shard_id",
+        type=int,
+        default=None,
+        help="Play only this shard (all shards are played locally if unset)",
+    )
+    parser.add_argument(
+        "--merge", action="store_true", help="Merge finished shards and exit"
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue an interrupted run, skipping completed games",
+    )
+    parser.add_argument(
+        "--sampling",
+        type=str,
+        default="pairs",
+        choices=SAMPLING_MODES,
+        help="Draw contexts uniformly over pairs, unique contexts, or count strata",
+    )
+    parser.add_argument(
+        "--storage",
+        type=str,
+        default="files",
+        choices=["files", "store"],
+        help="Per-game log files, or a single append-only run store",
+    )
+    parser.add_argument(
+        "--items",
+        type=str,
+        nargs="+",
+        default=DEFAULT_ITEMS,
+        help="Item types, in the order the context file lists them",
+    )
+    parser.add_argument(
+        "--contexts",
+        type=str,
+        default=SOURCE,
+        help="Context file (one line of count value pairs per player)",
+    )
+
+    parser.add_argument(
+        "--prompt_layout",
+        type=str,
+        default="original",
+        choices=prompt_registry.LAYOUTS,
+        help="System prompt layout (prefix puts per-game context last)",
+    )
 
     # parse the command-line arguments
     args = parser.parse_args()
@@ -193,10 +785,85 @@ def main():
     output_dir = args.output_dir
     temperature = args.temp
     num_runs=args.num_runs
+    concurrency = args.concurrency
+
+    if args.merge:
+        merge_shards(output_dir)
+        return
+
+    # size the shared connection pool for the number of games in flight
+    pool_size = max(concurrency, backends.client_config["pool_size"])
+    backends.configure_client(
+        pool_size=args.pool_size or pool_size,
+        timeout=args.timeout or backends.client_config["timeout"],
+    )
+
+    backend = backends.get_backend(args.backend)
+
+    # schedule requests against the provider's rate limits; the budgets are split
+    # evenly across shards, and retries are left to the scheduler
+    if args.rpm is not None or args.tpm is not None:
+        backends.configure_client(max_retries=0)
+        scheduler = RequestScheduler(
+            requests_per_minute=args.rpm / args.shards if args.rpm else None,
+            tokens_per_minute=args.tpm / args.shards if args.tpm else None,
+            initial_concurrency=min(8, args.max_in_flight),
+            max_concurrency=args.max_in_flight,
+            target_latency=args.target_latency,
+        )
+        backend = ScheduledBackend(backend, scheduler)
+
+    if args.cache_path is not None:
+        # each game's API seed keeps the recorded replies of games apart; without
+        # one, games with the same context would all get the first game's replies
+        recording = args.cache_mode == "record" and args.temp != 0
+        if recording and args.seed is None:
+            raise Exception("--cache_mode record with --temp above 0 requires --seed")
+        cache = ResponseCache(args.cache_path, int(args.cache_max_mb * 2**20))
+        backend = CachedBackend(backend, cache, args.cache_mode)
 
     # duration calculation
     start_time = time.time()
-    simulate_trials(model_id, output_dir, temperature, objective, num_runs, selfplay=True)
+    if args.shards > 1 and args.shard_id is None:
+        if args.seed is None:
+            raise Exception("sharded runs require a run seed")
+        run_shards(
+            model_id,
+            output_dir,
+            temperature,
+            objective,
+            num_runs,
+            concurrency,
+            args.seed,
+            args.shards,
+            backend,
+            args.resume,
+            args.storage,
+            args.sampling,
+            args.items,
+            args.contexts,
+            args.prompt_layout,
+        )
+    else:
+        simulate_trials(
+            model_id,
+            output_dir,
+            temperature,
+            objective,
+            num_runs,
+            selfplay=True,
+            concurrency=concurrency,
+            seed=args.seed,
+            shards=args.shards,
+            shard_id=args.shard_id,
+            backend=backend,
+            resume=args.resume,
+            storage=args.storage,
+            sampling=args.sampling,
+            items=args.items,
+            context_source=args.contexts,
+            prompt_layout=args.prompt_layout,
+        )
     end_time = time.time()
 
     duration = end_time - start_time 
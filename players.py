@@ -1,7 +1,8 @@
-from dotenv import load_dotenv
-from openai import OpenAI
-import os
-import re
+import time
+
+import backends
+import call_metrics
+import token_accounting
 
 class HumanPlayer():
 
@@ -33,21 +34,22 @@ class LLMPlayer():
         self.messages_json = []
         self.messages_log = []
 
-        # logging
+        # provider-reported token usage, summed over every API call
+        self.usage = None
+
+        # logging (kept in memory as well, and only in memory if no file is given)
         self.player_log_filename = log_filename
+        self.log_text = []
 
         # write initial context to log
-        value_context = "Books are worth {book_val} points, hats are worth {hat_val} points, and balls are worth {ball_val} points.\n"
-        f = open(self.player_log_filename, "a")
-        f.write(
-            value_context.format(
-                book_val=vals["book"],
-                hat_val=vals["hat"],
-                ball_val=vals["ball"],
-            )
-        )
-        f.write("\n\n")
-        f.close()
+        value_context = game.schema.values_text(vals)
+        self.write_log(value_context[0].upper() + value_context[1:] + ".\n\n\n")
+
+    def write_log(self, text):
+        self.log_text.append(text)
+        if self.player_log_filename is not None:
+            with open(self.player_log_filename, "a") as f:
+                f.write(text)
 
     def respond(self):
         # generate player output
@@ -75,9 +77,7 @@ class LLMPlayer():
             )
 
             # write the error message to the log
-            f = open(self.player_log_filename, "a")
-            f.write("Error: " + error_msg + "\n")
-            f.close()
+            self.write_log("Error: " + error_msg + "\n")
 
             # check for whether we abort or not
             err_cnt += 1
@@ -85,7 +85,7 @@ class LLMPlayer():
                 return "[ABORT]"
 
             # regenerate a response
-            response_text = self.generate_response()
+            response_text = self.generate_response(attempt=err_cnt)
             is_valid_output, error_msg = self.is_valid_output(response_text)
 
         if not self.selfplay:
@@ -134,39 +134,8 @@ class LLMPlayer():
 
         proposal = msg.split("[propose]")[-1].strip()
 
-        # assert that we refer to all of the items and in the correct order
-        book_idx = proposal.find("book")
-        hat_idx = proposal.find("hat")
-        ball_idx = proposal.find("ball")
-
-        # check that we found all indices and they are in the correct order
-        if not (-1 < book_idx < hat_idx < ball_idx):
-            return (
-                False,
-                "Item counts must be sequenced in the following order: books, hats, and then balls.",
-            )
-
-        # get the quantities as integers (not strings)
-        quantities = [int(x) for x in re.findall(r"\d+", proposal)]
-
-        # make sure we have only three integers in our proposal message
-        if len(quantities) != 3:
-            return (
-                False,
-                "There should only be counts for three items in your proposal: books, hats, and balls.",
-            )
-
-        # make sure the three quantities are within valid range, given the game item counts
-        if not (
-            0 <= quantities[0] <= self.game.item_counts["book"]
-            and 0 <= quantities[1] <= self.game.item_counts["hat"]
-            and 0 <= quantities[2] <= self.game.item_counts["ball"]
-        ):
-            return (
-                False,
-                "Item counts suggested are invalid based on game context; some of your proposal's item counts are greater than total items available.",
-            )
-        return True, ""
+        # the items must all be there, in the schema's order and within the counts
+        return self.game.schema.check_proposal(proposal, self.game.item_counts)
 
     def is_valid_output(self, response_text):
         is_valid, error_msg = True, ""
@@ -193,31 +162,55 @@ class ClosedSourceChatPlayer(LLMPlayer):
         selfplay=True,
         model="gpt-3.5-turbo-0125",
         prompt_path="prompts/dond.txt",
+        backend=None,
+        seed=None,
+        priority=0,
+        metrics=None,
+        player_index=None,
     ):
         super().__init__(game, vals, log_filename, temperature, selfplay, prompt_path)
         self.model = model
 
-    def generate_response(self):
-        load_dotenv()
-        client = OpenAI(
-            api_key=os.getenv("OPENAI_API_KEY"),
-            organization=os.getenv("OPENAI_ORG_ID"),
-        )
+        # sampling seed sent with every request (None leaves it unset)
+        self.seed = seed
+
+        # scheduling priority of this player's requests (lower is served first)
+        self.priority = priority
+
+        # completions go through a shared backend (the pooled OpenAI client by default)
+        self.backend = backend if backend is not None else backends.get_backend()
+
+        # per-call latency and usage records of the run (None records nothing)
+        self.metrics = metrics
+        self.player_index = player_index
+
+    def generate_response(self, attempt=0):
+        # generate output using API (attempt is the validation retry index)
+        started_at = time.time()
+        start_time = time.monotonic()
+        try:
+            response = self.backend.complete(
+                model=self.model,
+                messages=self.messages_json,
+                temperature=self.temperature,
+                max_tokens=200,
+                seed=self.seed,
+                priority=self.priority,
+            )
+        except Exception as error:
+            self.record_call(attempt, started_at, start_time, error=error)
+            raise
+        self.record_call(attempt, started_at, start_time, response=response)
 
-        # generate output using API
-        response = client.chat.completions.create(
-            model=self.model,
-            messages=self.messages_json,
-            temperature=self.temperature,
-            max_tokens=200,
-        )
+        # a response-cache hit replays the recorded usage, which was not billed
+        # again, so only the provider's answers are counted
+        if not response.get("cached"):
+            self.usage = token_accounting.add_usage(self.usage, response.get("usage"))
 
-        full_output = response.choices[0].message.content.strip()
+        full_output = response["content"].strip()
 
         # append full output to the log
-        f = open(self.player_log_filename, "a")
-        f.write(full_output + "\n")
-        f.close()
+        self.write_log(full_output + "\n")
 
         # truncate if any [END]'s were generated
         if "[END]" in full_output:
@@ -233,3 +226,18 @@ class ClosedSourceChatPlayer(LLMPlayer):
 
         return response_text
 
+    def record_call(self, attempt, started_at, start_time, response=None, error=None):
+        if self.metrics is None:
+            return
+        call = call_metrics.call_record(
+            getattr(self.game, "game_index", None),
+            self.player_index,
+            attempt,
+            self.model,
+            started_at,
+            time.monotonic() - start_time,
+            response,
+            error,
+        )
+        self.metrics.record(call)
+
@@ -0,0 +1,131 @@
+import glob
+import os
+import string
+import threading
+
+PROMPT_DIR = "prompts"
+
+# system prompt file of each objective
+OBJECTIVE_PROMPTS = {
+    "self": "dond.txt",
+    "coop": "coop_dond.txt",
+    "comp": "comp_dond.txt",
+}
+
+# "original" renders a prompt file as written; "prefix" moves the lines that hold
+# a game's item counts and values to the end, so every game's prompt starts with
+# the same static instructions and a provider's prompt cache can reuse them
+LAYOUTS = ["original", "prefix"]
+
+# fields filled in per game (the rest depend only on the item types)
+GAME_FIELDS = ["item_counts", "item_values"]
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def prompt_path(objective, schema=None, prompt_dir=PROMPT_DIR):
+    # games with other items use the prompts that describe the items from the
+    # schema
+    if objective not in OBJECTIVE_PROMPTS:
+        raise Exception("invalid objective")
+    if schema is not None and not schema.is_default():
+        prompt_dir = f"{prompt_dir}/items"
+    return f"{prompt_dir}/{OBJECTIVE_PROMPTS[objective]}"
+
+
+def is_game_field(name):
+    return name in GAME_FIELDS or name.endswith(("_cnt", "_val"))
+
+
+def template_fields(text):
+    return {name for _, name, _, _ in string.Formatter().parse(text) if name}
+
+
+def prefix_layout(text):
+    """The template with its per-game lines after all of its static lines.
+
+    Lines keep their text and relative order, so the rendered prompt says the
+    same things; only where the game's context appears changes.
+    """
+    static, context = [], []
+    for line in text.split("\n"):
+        per_game = any(is_game_field(name) for name in template_fields(line))
+        (context if per_game else static).append(line)
+    if len(context) == 0:
+        return text
+    return "\n".join(static).rstrip("\n") + "\n\n" + "\n".join(context)
+
+
+class PromptTemplate:
+    """A prompt file, read and parsed once.
+
+    The names of the fields the template uses are found when it is loaded, so
+    a malformed template fails at startup rather than in the middle of a run.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.mtime_ns = os.stat(path).st_mtime_ns
+        with open(path, "r") as prompt_file:
+            self.text = prompt_file.read()
+        self.fields = template_fields(self.text)
+        self.layouts = {"original": self.text, "prefix": prefix_layout(self.text)}
+
+    def render(self, fields, layout="original"):
+        missing = self.fields - fields.keys()
+        if missing:
+            raise Exception(f"{self.path} needs fields {sorted(missing)}")
+        if layout not in self.layouts:
+            raise Exception(f"invalid prompt layout: {layout}")
+        return self.layouts[layout].format_map(fields)
+
+
+class PromptRegistry:
+    """The prompt templates under a directory, loaded when it is created.
+
+    With reload, a template whose file was modified since it was loaded is
+    read again before it is rendered, so a long-running server picks up edited
+    prompts. Templates outside the directory are loaded on first use.
+    """
+
+    def __init__(self, prompt_dir=PROMPT_DIR, reload=False):
+        self.prompt_dir = prompt_dir
+        self.reload = reload
+        self.lock = threading.Lock()
+        self.templates = {}
+        pattern = os.path.join(prompt_dir, "**", "*.txt")
+        for path in sorted(glob.glob(pattern, recursive=True)):
+            self.templates[os.path.normpath(path)] = PromptTemplate(path)
+
+    def template(self, path):
+        key = os.path.normpath(path)
+        template = self.templates.get(key)
+        if template is not None and not self.reload:
+            return template
+        with self.lock:
+            template = self.templates.get(key)
+            if template is None or os.stat(path).st_mtime_ns != template.mtime_ns:
+                template = PromptTemplate(path)
+                self.templates[key] = template
+            return template
+
+    def render(self, path, fields, layout="original"):
+        return self.template(path).render(fields, layout)
+
+
+def configure(prompt_dir=PROMPT_DIR, reload=False):
+    # replaces the shared registry, e.g. to turn on reloading in the web server
+    global _registry
+    with _registry_lock:
+        _registry = PromptRegistry(prompt_dir, reload)
+    return _registry
+
+
+def get_registry():
+    # the shared registry, loaded on first use
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = PromptRegistry()
+        return _registry
@@ -0,0 +1,235 @@
+import argparse
+import glob
+import os
+import threading
+
+import numpy as np
+
+from items import DEFAULT_ITEMS
+from run_manifest import tmp_path_for
+from run_store import STORE_FILE, open_run
+
+TABLE_FILE = "results.bin"
+
+# the header doubles as a format version (and records the number of item types);
+# a table written with another layout is rebuilt from the run instead of being
+# misread
+HEADER_PREFIX = b"selfplay results table v3 items="
+HEADER_SIZE = 64
+
+ITEMS = DEFAULT_ITEMS
+
+
+def table_header(num_items):
+    return (HEADER_PREFIX + f"{num_items}\n".encode()).ljust(HEADER_SIZE, b" ")
+
+
+def table_dtype(num_items):
+    # one fixed-size row per finished game; allocations are -1 where no proposal
+    # was made, and context_id is -1 for games played before contexts were indexed
+    return np.dtype(
+        [
+            ("index", "<i4"),
+            ("context_id", "<i4"),
+            ("counts", "<i2", (num_items,)),
+            ("p0_values", "<i2", (num_items,)),
+            ("p1_values", "<i2", (num_items,)),
+            ("p0_allocation", "<i2", (num_items,)),
+            ("p1_allocation", "<i2", (num_items,)),
+            ("p0_score", "<i4"),
+            ("p1_score", "<i4"),
+            ("message_count", "<i4"),
+            ("token_count", "<i4"),
+            ("is_valid_deal", "?"),
+            ("aborted", "?"),
+        ]
+    )
+
+
+DTYPE = table_dtype(len(ITEMS))
+HEADER = table_header(len(ITEMS))
+
+
+def table_items(table):
+    return table.dtype["counts"].shape[0]
+
+
+def item_vector(items, names):
+    if items is None:
+        return [-1] * len(names)
+    return [items[name] for name in names]
+
+
+def result_row(index, result, aborted=None):
+    # packs a results summary into a table row; items are in the order of the
+    # game's counts
+    names = list(result["counts"])
+    row = np.zeros(1, dtype=table_dtype(len(names)))
+    row["index"] = int(index)
+    row["context_id"] = result.get("context_id", -1)
+    row["counts"] = item_vector(result["counts"], names)
+    row["p0_values"] = item_vector(result["p0_values"], names)
+    row["p1_values"] = item_vector(result["p1_values"], names)
+    row["p0_allocation"] = item_vector(result["p0_allocation"], names)
+    row["p1_allocation"] = item_vector(result["p1_allocation"], names)
+    row["p0_score"] = result["p0_score"]
+    row["p1_score"] = result["p1_score"]
+    row["message_count"] = result["message_count"]
+    row["token_count"] = result["token_count"]
+    row["is_valid_deal"] = result["is_valid_deal"]
+    row["aborted"] = result.get("aborted", False) if aborted is None else aborted
+    return row
+
+
+def item_dict(vector, names=ITEMS):
+    # the inverse of item_vector, for code that works on per-game dicts
+    return {name: int(value) for name, value in zip(names, vector)}
+
+
+class ResultsTable:
+    """Appends a fixed-width row to results.bin as each game finishes."""
+
+    def __init__(self, dir_path):
+        self.dir_path = dir_path
+        self.path = f"{dir_path}/{TABLE_FILE}"
+        self.lock = threading.Lock()
+        self.checked = False
+        self.num_items = None
+
+    def __getstate__(self):
+        return {"dir_path": self.dir_path}
+
+    def __setstate__(self, state):
+        self.__init__(state["dir_path"])
+
+    def check_layout(self):
+        # a resumed run may have a table from an older layout; rebuild it before
+        # appending rows in the current one
+        if os.path.exists(self.path) and read_table(self.path) is None:
+            write_table(self.path, build_table(self.dir_path))
+        if os.path.exists(self.path):
+            self.num_items = read_header(self.path)
+        self.checked = True
+
+    def append(self, index, result):
+        row = result_row(index, result)
+        with self.lock:
+            if not self.checked:
+                self.check_layout()
+            with open(self.path, "ab") as table_file:
+                if table_file.tell() == 0:
+                    self.num_items = table_items(row)
+                    table_file.write(table_header(self.num_items))
+                else:
+                    if self.num_items != table_items(row):
+                        raise Exception(
+                            f"{self.path} has {self.num_items} item types, "
+                            f"but game {index} has {table_items(row)}"
+                        )
+                    # drop a row torn by a crash so later rows stay aligned
+                    torn = (table_file.tell() - HEADER_SIZE) % row.dtype.itemsize
+                    if torn:
+                        table_file.truncate(table_file.tell() - torn)
+                table_file.write(row.tobytes())
+
+
+def read_header(path):
+    # the number of item types in a table, or None for another layout
+    with open(path, "rb") as table_file:
+        header = table_file.read(HEADER_SIZE)
+    if not header.startswith(HEADER_PREFIX):
+        return None
+    num_items = header[len(HEADER_PREFIX) :].strip()
+    if not num_items.isdigit() or header != table_header(int(num_items)):
+        return None
+    return int(num_items)
+
+
+def read_table(path):
+    # returns None if the file is missing or was written in a different layout
+    if not os.path.exists(path):
+        return None
+    num_items = read_header(path)
+    if num_items is None:
+        return None
+    dtype = table_dtype(num_items)
+    num_rows = (os.path.getsize(path) - HEADER_SIZE) // dtype.itemsize
+    table = np.fromfile(path, dtype=dtype, count=num_rows, offset=HEADER_SIZE)
+    return latest_rows(table)
+
+
+def latest_rows(table):
+    # a replayed game has several rows; keep the last one and sort by game index
+    _, last = np.unique(table["index"][::-1], return_index=True)
+    return table[::-1][last]
+
+
+def write_table(path, table):
+    tmp_path = tmp_path_for(path)
+    with open(tmp_path, "wb") as table_file:
+        table_file.write(table_header(table_items(table)))
+        table_file.write(table.tobytes())
+    os.replace(tmp_path, path)
+
+
+def build_table(dir_path):
+    # backfills the table of a run from its per-game results and logs
+    rows = []
+    with open_run(dir_path) as run:
+        for index in run.indices():
+            result = run.result(index)
+            aborted = result.get("aborted")
+            if aborted is None:
+                aborted = "[ABORT]" in run.text(index, "full")
+            rows.append(result_row(index, result, aborted))
+    if len(rows) == 0:
+        return np.zeros(0, dtype=DTYPE)
+    return np.concatenate(rows)
+
+
+def load_table(dir_path):
+    # the run's table, built (and saved, where possible) on first use
+    path = f"{dir_path}/{TABLE_FILE}"
+    table = read_table(path)
+    if table is None:
+        table = build_table(dir_path)
+        try:
+            write_table(path, table)
+        except OSError:
+            pass
+    return table
+
+
+def merge_tables(dir_paths, out_path):
+    tables = [read_table(f"{dir_path}/{TABLE_FILE}") for dir_path in dir_paths]
+    tables = [table for table in tables if table is not None]
+    if len(tables) == 0:
+        return
+    write_table(out_path, latest_rows(np.concatenate(tables)))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="build results tables for existing self-play runs"
+    )
+    parser.add_argument(
+        "-r", "--runs", type=str, nargs="+", help="Run directories (globs allowed)"
+    )
+    parser.add_argument(
+        "--rebuild", action="store_true", help="Rebuild tables that already exist"
+    )
+    args = parser.parse_args()
+
+    for pattern in args.runs:
+        for path in sorted(glob.glob(pattern)):
+            stored = os.path.exists(f"{path}/{STORE_FILE}")
+            if not (stored or os.path.exists(f"{path}/p0_scores")):
+                continue
+            if args.rebuild or read_table(f"{path}/{TABLE_FILE}") is None:
+                table = build_table(path)
+                write_table(f"{path}/{TABLE_FILE}", table)
+                print(f"{path}: {len(table)} games")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+import json
+import os
+import threading
+
+PENDING = "pending"
+RUNNING = "running"
+COMPLETE = "complete"
+FAILED = "failed"
+
+
+def tmp_path_for(path):
+    # a temporary file name of this process and thread, so processes writing
+    # the same file at once never rename each other's temporary files
+    return f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+
+def atomic_write_json(path, data):
+    # write to a temporary file and rename it over the target, so a crash never
+    # leaves a half-written file behind
+    tmp_path = tmp_path_for(path)
+    with open(tmp_path, "w") as tmp_file:
+        json.dump(data, tmp_file)
+        tmp_file.flush()
+        os.fsync(tmp_file.fileno())
+    os.replace(tmp_path, path)
+
+
+class RunManifest:
+    """Per-run record of every game's status, seed and context.
+
+    Status changes are appended to manifest.log rather than rewriting the whole
+    manifest per game; save() folds the log back into manifest.json.
+    """
+
+    def __init__(self, output_dir, config=None, games=None):
+        self.path = f"{output_dir}/manifest.json"
+        self.log_path = f"{output_dir}/manifest.log"
+        self.config = config if config is not None else {}
+        self.games = games if games is not None else {}
+        self.lock = threading.Lock()
+        self.log_file = None
+
+    @classmethod
+    def exists(cls, output_dir):
+        return os.path.exists(f"{output_dir}/manifest.json")
+
+    @classmethod
+    def load(cls, output_dir):
+        with open(f"{output_dir}/manifest.json", "r") as manifest_file:
+            manifest = json.load(manifest_file)
+        manifest = cls(output_dir, manifest["config"], manifest["games"])
+
+        # replay status changes made since the last save; a line torn by a crash
+        # can only be the last one
+        if os.path.exists(manifest.log_path):
+            with open(manifest.log_path, "r") as log_file:
+                for line in log_file:
+                    try:
+                        index, game = json.loads(line)
+                    except ValueError:
+                        break
+                    manifest.games[index] = game
+        return manifest
+
+    def save(self):
+        with self.lock:
+            atomic_write_json(self.path, {"config": self.config, "games": self.games})
+            if self.log_file is not None:
+                self.log_file.close()
+                self.log_file = None
+            if os.path.exists(self.log_path):
+                os.remove(self.log_path)
+
+    def add_game(self, index, context_index, seed):
+        with self.lock:
+            self.games[index] = {
+                "status": PENDING,
+                "context_index": int(context_index),
+                "seed": seed,
+                "attempts": 0,
+            }
+
+    def set_status(self, index, status, error=None):
+        with self.lock:
+            game = self.games[index]
+            game["status"] = status
+            if status == RUNNING:
+                game["attempts"] += 1
+            if error is not None:
+                game["error"] = error
+            else:
+                game.pop("error", None)
+
+            if self.log_file is None:
+                self.log_file = open(self.log_path, "a")
+            self.log_file.write(json.dumps([index, game]) + "\n")
+            self.log_file.flush()
+
+    def status(self, index):
+        with self.lock:
+            return self.games[index]["status"]
+
+    def count(self, status):
+        with self.lock:
+            return sum(game["status"] == status for game in self.games.values())
@@ -0,0 +1,369 @@
+import argparse
+import glob
+import json
+import os
+import threading
+import zlib
+
+from run_manifest import RunManifest
+
+STORE_FILE = "games.jsonl"
+INDEX_FILE = "games.idx"
+
+TEXT_LOGS = ["full", "p0", "p1"]
+
+
+def encode_record(record):
+    # one line per game: crc32 of the JSON, a tab, then the JSON itself
+    payload = json.dumps(record, separators=(",", ":")).encode("utf-8")
+    return b"%08x\t%s\n" % (zlib.crc32(payload), payload)
+
+
+def decode_record(line):
+    # returns None for a torn or corrupted line
+    if not line.endswith(b"\n") or line[8:9] != b"\t":
+        return None
+    payload = line[9:-1]
+    try:
+        if int(line[:8], 16) != zlib.crc32(payload):
+            return None
+        return json.loads(payload)
+    except ValueError:
+        return None
+
+
+def scan_records(path, offset=0):
+    # yields (offset, length, record) for every line from offset onwards, stopping
+    # at the first line that fails its checksum
+    with open(path, "rb") as store_file:
+        store_file.seek(offset)
+        for line in store_file:
+            record = decode_record(line)
+            if record is None:
+                return
+            yield offset, len(line), record
+            offset += len(line)
+
+
+def load_index(dir_path):
+    # game index -> (offset, length) of its latest record; the index file is
+    # only a cache, so records it is missing are recovered from the store itself
+    index = {}
+    end = 0
+    index_path = f"{dir_path}/{INDEX_FILE}"
+    if os.path.exists(index_path):
+        with open(index_path, "r") as index_file:
+            for line in index_file:
+                fields = line.split()
+                if len(fields) != 3:
+                    break
+                offset, length = int(fields[1]), int(fields[2])
+                index[fields[0]] = (offset, length)
+                end = max(end, offset + length)
+
+    missing = []
+    for offset, length, record in scan_records(f"{dir_path}/{STORE_FILE}", end):
+        index[record["index"]] = (offset, length)
+        missing.append((record["index"], offset, length))
+        end = offset + length
+    return index, end, missing
+
+
+class RunStore:
+    """Append-only, checksummed record of every game in a run (or shard).
+
+    Each completed game is one line of games.jsonl, holding its results, JSON logs
+    and text logs; games.idx maps game indices to byte offsets. A game that is
+    played again is appended again, and the latest record wins. A store has a
+    single writing process; threads share it through the lock.
+    """
+
+    def __init__(self, dir_path, fsync=False):
+        self.dir_path = dir_path
+        self.path = f"{dir_path}/{STORE_FILE}"
+        self.index_path = f"{dir_path}/{INDEX_FILE}"
+        self.fsync = fsync
+        self.lock = threading.Lock()
+        self.store_file = None
+        self.index_file = None
+        self.index = None
+        self.end = 0
+
+    def __getstate__(self):
+        return {"dir_path": self.dir_path, "fsync": self.fsync}
+
+    def __setstate__(self, state):
+        self.__init__(state["dir_path"], state["fsync"])
+
+    def open(self):
+        if self.store_file is not None:
+            return
+        os.makedirs(self.dir_path, exist_ok=True)
+        if not os.path.exists(self.path):
+            open(self.path, "wb").close()
+        self.index, self.end, missing = load_index(self.dir_path)
+
+        # drop a torn record left by a crash, so new records start on a clean line
+        self.store_file = open(self.path, "ab")
+        if self.store_file.tell() != self.end:
+            self.store_file.truncate(self.end)
+
+        self.index_file = open(self.index_path, "a")
+        self.write_index(missing)
+
+    def write_index(self, entries):
+        for index, offset, length in entries:
+            self.index_file.write(f"{index} {offset} {length}\n")
+        self.index_file.flush()
+
+    def append(self, record):
+        self.append_raw(record["index"], encode_record(record))
+
+    def append_raw(self, index, line):
+        # also used to copy already encoded records, e.g. when merging shards
+        with self.lock:
+            self.open()
+            self.store_file.write(line)
+            self.store_file.flush()
+            if self.fsync:
+                os.fsync(self.store_file.fileno())
+
+            self.index[index] = (self.end, len(line))
+            self.write_index([(index, self.end, len(line))])
+            self.end += len(line)
+
+    def close(self):
+        with self.lock:
+            if self.store_file is not None:
+                self.store_file.close()
+                self.index_file.close()
+                self.store_file = None
+                self.index_file = None
+
+
+class StoreReader:
+    """Reads a run kept in a RunStore."""
+
+    def __init__(self, dir_path):
+        self.dir_path = dir_path
+        self.index, _, _ = load_index(dir_path)
+        self.store_file = open(f"{dir_path}/{STORE_FILE}", "rb")
+        self.cached = (None, None)
+
+    def close(self):
+        self.store_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def indices(self):
+        return sorted(self.index, key=int)
+
+    def raw(self, index):
+        offset, length = self.index[index]
+        self.store_file.seek(offset)
+        return self.store_file.read(length)
+
+    def record(self, index):
+        # analysis reads several parts of the same game in a row
+        if self.cached[0] != index:
+            record = decode_record(self.raw(index))
+            if record is None:
+                raise Exception(f"game {index} in {self.dir_path} is corrupt")
+            self.cached = (index, record)
+        return self.cached[1]
+
+    def result(self, index):
+        return self.record(index)["result"]
+
+    def log(self, index, player):
+        return self.record(index)[f"p{player}_log"]
+
+    def text(self, index, name="full"):
+        return self.record(index)["text"][name]
+
+    def scores(self):
+        results = [self.result(index) for index in self.indices()]
+        return (
+            [result["p0_score"] for result in results],
+            [result["p1_score"] for result in results],
+        )
+
+
+class FilesReader:
+    """Reads a run in the legacy layout of per-game files and score files."""
+
+    def __init__(self, dir_path):
+        self.dir_path = dir_path
+
+    # files are opened per read, so there is nothing to release; the methods
+    # let callers close either reader the same way
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def indices(self):
+        # the score files are positional, so they define which games are complete
+        with open(f"{self.dir_path}/p0_scores", "r") as p0_scores:
+            num_games = sum(1 for line in p0_scores if line.strip())
+        return [f"{i:03d}" for i in range(num_games)]
+
+    def result(self, index):
+        with open(f"{self.dir_path}/results/{index}.json", "r") as results_file:
+            return json.load(results_file)
+
+    def log(self, index, player):
+        with open(f"{self.dir_path}/json_logs/{index}_p{player}.json", "r") as log_file:
+            return json.load(log_file)
+
+    def text(self, index, name="full"):
+        with open(f"{self.dir_path}/text_logs/{index}_{name}.txt", "r") as text_file:
+            return text_file.read()
+
+    def scores(self):
+        with open(f"{self.dir_path}/p0_scores", "r") as p0_scores, open(
+            f"{self.dir_path}/p1_scores", "r"
+        ) as p1_scores:
+            p0_array = [int(line.strip()) for line in p0_scores]
+            p1_array = [int(line.strip()) for line in p1_scores]
+        return p0_array, p1_array
+
+
+def find_runs(patterns):
+    # run directories matching a list of paths or globs, in the order given
+    dir_paths = []
+    for pattern in patterns:
+        for path in sorted(glob.glob(pattern)):
+            stored = os.path.exists(f"{path}/{STORE_FILE}")
+            if stored or os.path.exists(f"{path}/p0_scores"):
+                dir_paths.append(path)
+    return dir_paths
+
+
+def open_run(dir_path):
+    # picks the reader for however the run was stored
+    if os.path.exists(f"{dir_path}/{STORE_FILE}"):
+        return StoreReader(dir_path)
+    return FilesReader(dir_path)
+
+
+def game_record(index, result, p0_log, p1_log, text_logs):
+    return {
+        "index": index,
+        "result": result,
+        "p0_log": p0_log,
+        "p1_log": p1_log,
+        "text": text_logs,
+    }
+
+
+def export_legacy(dir_path, out_dir):
+    # writes a stored run out in the per-game file layout
+    with open_run(dir_path) as reader:
+        for subdir in ["json_logs", "text_logs", "results"]:
+            os.makedirs(f"{out_dir}/{subdir}", exist_ok=True)
+
+        p0_array, p1_array = reader.scores()
+        with open(f"{out_dir}/p0_scores", "w") as p0_scores, open(
+            f"{out_dir}/p1_scores", "w"
+        ) as p1_scores:
+            for p0_score, p1_score in zip(p0_array, p1_array):
+                p0_scores.write(f"{p0_score} \n")
+                p1_scores.write(f"{p1_score} \n")
+
+        indices = reader.indices()
+        for index in indices:
+            for name in TEXT_LOGS:
+                text_path = f"{out_dir}/text_logs/{index}_{name}.txt"
+                with open(text_path, "w") as text_file:
+                    text_file.write(reader.text(index, name))
+            for player in [0, 1]:
+                log_path = f"{out_dir}/json_logs/{index}_p{player}.json"
+                with open(log_path, "w") as log_file:
+                    json.dump(reader.log(index, player), log_file)
+            with open(f"{out_dir}/results/{index}.json", "w") as results_file:
+                json.dump(reader.result(index), results_file)
+
+    if RunManifest.exists(dir_path):
+        manifest = RunManifest.load(dir_path)
+        manifest.config["storage"] = "files"
+        RunManifest(out_dir, manifest.config, manifest.games).save()
+
+    print(f"exported {len(indices)} games to {out_dir}")
+
+
+def pack_legacy(dir_path, out_dir):
+    # the reverse of export_legacy: packs a per-game file run into a store
+    reader = FilesReader(dir_path)
+    store = RunStore(out_dir)
+    for index in reader.indices():
+        store.append(
+            game_record(
+                index,
+                reader.result(index),
+                reader.log(index, 0),
+                reader.log(index, 1),
+                {name: reader.text(index, name) for name in TEXT_LOGS},
+            )
+        )
+    store.close()
+
+    if RunManifest.exists(dir_path):
+        manifest = RunManifest.load(dir_path)
+        manifest.config["storage"] = "store"
+        RunManifest(out_dir, manifest.config, manifest.games).save()
+
+    print(f"packed {len(reader.indices())} games into {store.path}")
+
+
+def verify_store(dir_path):
+    # checks every record against its checksum and reports what a reader would see
+    path = f"{dir_path}/{STORE_FILE}"
+    num_records = 0
+    end = 0
+    games = set()
+    for offset, length, record in scan_records(path):
+        num_records += 1
+        games.add(record["index"])
+        end = offset + length
+
+    size = os.path.getsize(path)
+    print(f"{num_records} records for {len(games)} games in {path}")
+    if end != size:
+        print(f"{size - end} bytes after offset {end} are torn or corrupt")
+    return end == size
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect and convert run stores")
+
+    parser.add_argument("-p", "--path", type=str, help="Run directory")
+    parser.add_argument(
+        "--action",
+        type=str,
+        choices=["verify", "export", "pack"],
+        default="verify",
+        help="Verify a store, export it to per-game files, or pack files into one",
+    )
+    parser.add_argument("-d", "--output_dir", type=str, help="Output directory")
+
+    args = parser.parse_args()
+
+    if args.action == "verify":
+        verify_store(args.path)
+    elif args.action == "export":
+        export_legacy(args.path, args.output_dir)
+    else:
+        pack_legacy(args.path, args.output_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,291 @@
+import heapq
+import itertools
+import threading
+import time
+
+import numpy as np
+import openai
+
+# status codes worth retrying: timeouts, conflicts, rate limits and server errors
+RETRY_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    """Refilling budget of `rate` units per minute, holding at most `capacity`."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate / 60
+        self.capacity = capacity if capacity is not None else rate
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        # seconds until `amount` units are available (requests larger than the
+        # capacity only need a full bucket)
+        self.refill()
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.rate
+
+    def consume(self, amount):
+        # may go negative when actual usage exceeds the estimate
+        self.refill()
+        self.level -= amount
+
+
+class AIMDLimiter:
+    """Additive-increase/multiplicative-decrease limit on requests in flight."""
+
+    def __init__(
+        self,
+        initial=8,
+        minimum=1,
+        maximum=256,
+        target_latency=None,
+        increase=1.0,
+        decrease=0.5,
+    ):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_latency = target_latency
+        self.increase = increase
+        self.decrease = decrease
+
+    def on_success(self, latency):
+        if self.target_latency is not None and latency > self.target_latency:
+            # slow responses mean the provider is queueing us; back off gently
+            self.limit = max(self.minimum, self.limit * (1 + self.decrease) / 2)
+        else:
+            # grow by roughly `increase` per limit's worth of successful requests
+            self.limit = min(self.maximum, self.limit + self.increase / self.limit)
+
+    def on_rate_limit(self):
+        self.limit = max(self.minimum, self.limit * self.decrease)
+
+
+class RequestScheduler:
+    """Admits requests by priority under request/token budgets and an AIMD limit.
+
+    Lower priority values are served first; self-play uses the game number, so
+    games that are already being played finish before later games get requests in.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute=None,
+        tokens_per_minute=None,
+        initial_concurrency=8,
+        max_concurrency=256,
+        target_latency=None,
+    ):
+        self.config = {
+            "requests_per_minute": requests_per_minute,
+            "tokens_per_minute": tokens_per_minute,
+            "initial_concurrency": initial_concurrency,
+            "max_concurrency": max_concurrency,
+            "target_latency": target_latency,
+        }
+        self.request_bucket = (
+            TokenBucket(requests_per_minute) if requests_per_minute else None
+        )
+        self.token_bucket = (
+            TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        )
+        self.limiter = AIMDLimiter(
+            initial=initial_concurrency,
+            maximum=max_concurrency,
+            target_latency=target_latency,
+        )
+
+        self.condition = threading.Condition()
+        self.waiting = []
+        self.sequence = itertools.count()
+        self.in_flight = 0
+
+        self.stats_counters = {
+            "requests": 0,
+            "rate_limited": 0,
+            "retries": 0,
+            "queue_wait": 0.0,
+            "max_in_flight": 0,
+        }
+
+    def __getstate__(self):
+        # each process gets a fresh scheduler with the same settings
+        return self.config
+
+    def __setstate__(self, config):
+        self.__init__(**config)
+
+    def budget_wait(self, estimated_tokens):
+        wait = 0.0
+        if self.request_bucket is not None:
+            wait = max(wait, self.request_bucket.wait_time(1))
+        if self.token_bucket is not None:
+            wait = max(wait, self.token_bucket.wait_time(estimated_tokens))
+        return wait
+
+    def acquire(self, priority, estimated_tokens):
+        # blocks until this request is at the head of the queue, a concurrency
+        # slot is free and both budgets can pay for it
+        start_time = time.monotonic()
+        ticket = (priority, next(self.sequence))
+        with self.condition:
+            heapq.heappush(self.waiting, ticket)
+            while True:
+                timeout = None
+                slot_free = self.in_flight < int(self.limiter.limit)
+                if self.waiting[0] == ticket and slot_free:
+                    timeout = self.budget_wait(estimated_tokens)
+                    if timeout == 0:
+                        break
+                self.condition.wait(timeout)
+
+            heapq.heappop(self.waiting)
+            if self.request_bucket is not None:
+                self.request_bucket.consume(1)
+            if self.token_bucket is not None:
+                self.token_bucket.consume(estimated_tokens)
+            self.in_flight += 1
+
+            self.stats_counters["requests"] += 1
+            self.stats_counters["queue_wait"] += time.monotonic() - start_time
+            self.stats_counters["max_in_flight"] = max(
+                self.stats_counters["max_in_flight"], self.in_flight
+            )
+            self.condition.notify_all()
+
+        return time.monotonic() - start_time
+
+    def release(self, latency=None, rate_limited=False, token_correction=0):
+        with self.condition:
+            self.in_flight -= 1
+            if rate_limited:
+                self.stats_counters["rate_limited"] += 1
+                self.limiter.on_rate_limit()
+            elif latency is not None:
+                self.limiter.on_success(latency)
+
+            # reconcile the token budget with the usage the provider reported
+            if self.token_bucket is not None and token_correction:
+                self.token_bucket.consume(token_correction)
+            self.condition.notify_all()
+
+    def record_retry(self):
+        with self.condition:
+            self.stats_counters["retries"] += 1
+
+    def stats(self):
+        with self.condition:
+            return {
+                **self.stats_counters,
+                "concurrency_limit": self.limiter.limit,
+                "in_flight": self.in_flight,
+                "waiting": len(self.waiting),
+            }
+
+
+def is_retryable(error):
+    if isinstance(error, openai.APIConnectionError):
+        return True
+    return getattr(error, "status_code", None) in RETRY_STATUS_CODES
+
+
+def retry_after(error):
+    # seconds the provider asked us to wait, if it said
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+def estimate_tokens(messages, max_tokens):
+    # rough prompt size (about four characters per token) plus the completion budget
+    return sum(len(message["content"]) for message in messages) // 4 + max_tokens
+
+
+class ScheduledBackend:
+    """Wraps a backend with the request scheduler and jittered retries."""
+
+    def __init__(
+        self, backend, scheduler, max_attempts=8, base_delay=1.0, max_delay=60.0
+    ):
+        self.backend = backend
+        self.scheduler = scheduler
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.rng = np.random.default_rng()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["rng"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.rng = np.random.default_rng()
+
+    def complete(
+        self,
+        model,
+        messages,
+        temperature=1,
+        max_tokens=200,
+        seed=None,
+        priority=0,
+    ):
+        estimated_tokens = estimate_tokens(messages, max_tokens)
+
+        # time spent waiting in the queue, over every attempt
+        queue_wait = 0
+        for attempt in range(self.max_attempts):
+            queue_wait += self.scheduler.acquire(priority, estimated_tokens)
+
+            start_time = time.monotonic()
+            try:
+                response = self.backend.complete(
+                    model, messages, temperature, max_tokens, seed, priority
+                )
+            except Exception as error:
+                rate_limited = getattr(error, "status_code", None) == 429
+                self.scheduler.release(rate_limited=rate_limited)
+
+                if not is_retryable(error) or attempt == self.max_attempts - 1:
+                    raise
+
+                # full-jitter exponential backoff, unless the provider said otherwise
+                delay = retry_after(error)
+                if delay is None:
+                    delay = self.rng.uniform(
+                        0, min(self.max_delay, self.base_delay * 2**attempt)
+                    )
+                self.scheduler.record_retry()
+                time.sleep(delay)
+                continue
+
+            usage = response.get("usage")
+            token_correction = 0
+            if usage is not None:
+                token_correction = usage["total_tokens"] - estimated_tokens
+            self.scheduler.release(
+                latency=time.monotonic() - start_time,
+                token_correction=token_correction,
+            )
+            return {**response, "queue_wait": queue_wait, "api_attempts": attempt + 1}
+
+    def stats(self):
+        stats = self.scheduler.stats()
+        if hasattr(self.backend, "stats"):
+            stats["backend"] = self.backend.stats()
+        return stats
@@ -0,0 +1,205 @@
+import argparse
+import glob
+import json
+import os
+import threading
+from multiprocessing import Pool
+
+import results_table
+import run_store
+
+# the tokenizer is loaded on first use and then shared by the whole process
+_tokenizer = None
+_tokenizer_lock = threading.Lock()
+
+# cached_tokens is the part of prompt_tokens served from the provider's prompt
+# cache (reported under prompt_tokens_details)
+USAGE_FIELDS = ["prompt_tokens", "completion_tokens", "total_tokens", "cached_tokens"]
+
+
+def get_tokenizer():
+    global _tokenizer
+    with _tokenizer_lock:
+        if _tokenizer is None:
+            # imported here so that importing the game code stays cheap
+            from transformers import GPT2TokenizerFast
+
+            _tokenizer = GPT2TokenizerFast.from_pretrained("gpt2")
+    return _tokenizer
+
+
+def count_tokens(texts):
+    # GPT-2 token counts for a batch of strings, in a single tokenizer call
+    texts = list(texts)
+    if len(texts) == 0:
+        return []
+    return [len(ids) for ids in get_tokenizer()(texts)["input_ids"]]
+
+
+def total_tokens(texts):
+    return sum(count_tokens(texts))
+
+
+def usage_from_response(usage):
+    # normalize the provider's usage object (or dict) into a plain dict
+    if usage is None:
+        return None
+    if not isinstance(usage, dict):
+        usage = usage.model_dump() if hasattr(usage, "model_dump") else vars(usage)
+    normalized = {field: usage.get(field) or 0 for field in USAGE_FIELDS}
+    details = usage.get("prompt_tokens_details") or {}
+    if not isinstance(details, dict):
+        details = vars(details)
+    normalized["cached_tokens"] = (
+        usage.get("cached_tokens") or details.get("cached_tokens") or 0
+    )
+    return normalized
+
+
+def add_usage(total, usage):
+    # running sum of provider-reported usage; stays None if nothing was reported
+    if usage is None:
+        return total
+    if total is None:
+        total = {field: 0 for field in USAGE_FIELDS}
+    return {field: total[field] + usage.get(field, 0) for field in USAGE_FIELDS}
+
+
+def game_messages(p0_log, p1_log):
+    # the messages sent during a game are the assistant turns of both players
+    return [
+        message["content"]
+        for message in p0_log + p1_log
+        if message["role"] == "assistant"
+    ]
+
+
+def open_results(dir_path):
+    # a reader for the run, and the games it has results for
+    if os.path.exists(f"{dir_path}/{run_store.STORE_FILE}"):
+        reader = run_store.StoreReader(dir_path)
+        return reader, reader.indices()
+    reader = run_store.FilesReader(dir_path)
+    result_files = sorted(glob.glob(f"{dir_path}/results/*.json"))
+    return reader, [os.path.basename(path)[:-5] for path in result_files]
+
+
+def recount_run(dir_path):
+    # recompute token_count for every game in a run directory
+    reader, indices = open_results(dir_path)
+    stored = isinstance(reader, run_store.StoreReader)
+
+    with reader:
+        results, messages = [], []
+        for index in indices:
+            results.append(reader.result(index))
+            messages.append(game_messages(reader.log(index, 0), reader.log(index, 1)))
+
+        # tokenize the whole run in one batch, then split the counts back per game
+        counts = count_tokens([text for game in messages for text in game])
+
+        # a stored game is updated by appending a new record for it
+        store = run_store.RunStore(dir_path) if stored else None
+
+        num_changed = 0
+        offset = 0
+        for index, result, game in zip(indices, results, messages):
+            token_count = sum(counts[offset : offset + len(game)])
+            offset += len(game)
+
+            if result.get("token_count") != token_count:
+                num_changed += 1
+                result["token_count"] = token_count
+                if store is not None:
+                    record = reader.record(index)
+                    record["result"] = result
+                    store.append(record)
+                else:
+                    with open(f"{dir_path}/results/{index}.json", "w") as results_file:
+                        json.dump(result, results_file)
+
+    if store is not None:
+        store.close()
+
+    # the results table holds token counts too, and reports read them from it
+    if num_changed > 0:
+        results_table.write_table(
+            f"{dir_path}/{results_table.TABLE_FILE}",
+            results_table.build_table(dir_path),
+        )
+    return dir_path, len(indices), num_changed
+
+
+def usage_summary(dir_path):
+    # provider-reported usage summed over a run's games
+    reader, indices = open_results(dir_path)
+    total = None
+    num_reported = 0
+    with reader:
+        for index in indices:
+            usage = reader.result(index).get("usage")
+            if usage is not None:
+                num_reported += 1
+                total = add_usage(total, usage)
+    return dir_path, len(indices), num_reported, total
+
+
+def print_usage(dir_path, num_games, num_reported, total):
+    if total is None:
+        print(f"{dir_path}: {num_games} games, no usage reported")
+        return
+    prompt_tokens, cached_tokens = total["prompt_tokens"], total["cached_tokens"]
+    share = cached_tokens / prompt_tokens if prompt_tokens else 0
+    print(
+        f"{dir_path}: {num_reported} games with usage | "
+        f"prompt tokens: {prompt_tokens} ({prompt_tokens / num_reported:.0f}/game) | "
+        f"cached: {cached_tokens} ({share:.1%}) | "
+        f"uncached: {prompt_tokens - cached_tokens} | "
+        f"completion tokens: {total['completion_tokens']}"
+    )
+
+
+def recount_runs(dir_paths, workers=None):
+    # each worker process loads its own tokenizer once and recounts whole runs
+    with Pool(workers) as pool:
+        for dir_path, num_games, num_changed in pool.imap_unordered(
+            recount_run, dir_paths
+        ):
+            print(f"{dir_path}: {num_games} games, {num_changed} token counts updated")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="recompute token counts for existing self-play runs, or report usage"
+    )
+    parser.add_argument(
+        "-r", "--runs", type=str, nargs="+", help="Run directories (globs allowed)"
+    )
+    parser.add_argument(
+        "-w", "--workers", type=int, default=None, help="Number of worker processes"
+    )
+    parser.add_argument(
+        "--usage",
+        action="store_true",
+        help="Report provider-reported and prompt-cached tokens instead",
+    )
+    args = parser.parse_args()
+
+    dir_paths = []
+    for pattern in args.runs:
+        for path in sorted(glob.glob(pattern)):
+            stored = os.path.exists(f"{path}/{run_store.STORE_FILE}")
+            if stored or os.path.isdir(f"{path}/results"):
+                dir_paths.append(path)
+
+    if args.usage:
+        with Pool(args.workers) as pool:
+            for summary in pool.imap(usage_summary, dir_paths):
+                print_usage(*summary)
+        return
+
+    recount_runs(dir_paths, args.workers)
+
+
+if __name__ == "__main__":
+    main()
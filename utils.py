@@ -1,49 +1,54 @@
-from openai import OpenAI
-import json
 import numpy as np
 import re
 
-import os
-from dotenv import load_dotenv
+import backends
+import dataset
+import finetune_jobs
+import results_table
+import oracle
+import pareto
+from items import DEFAULT_SCHEMA
 
-def check_agreement_validity(game_text):
+def check_agreement_validity(game_text, schema=DEFAULT_SCHEMA):
     """
     Check if the proposals in the game text match the total item counts specified at the beginning.
 
     Args:
     game_text (str): The game text containing item counts and proposals.
+    schema (ItemSchema): The item types of the game (books, hats, and balls by default).
 
     Returns:
-    dict: A dictionary containing the results of compatibility check for books, hats, and balls, and overall compatibility.
+    bool: Whether the proposals add up to the item counts, for every item type.
     """
+    number = r"(\d+)"
 
     # Extract the item counts from the first line
     item_counts = re.search(
-        r"Item counts: there are (\d+) books, (\d+) hats, and (\d+) balls.", game_text
+        "Item counts: there are "
+        + schema.counts_text({name: number for name in schema.names})
+        + ".",
+        game_text,
     )
 
     # Extract the proposals
     proposals = re.findall(
-        r"\[propose\] \((\d+) books, (\d+) hats, (\d+) balls\)", game_text
+        r"\[propose\] \(" + schema.proposal_text([number] * len(schema)) + r"\)",
+        game_text,
     )
 
     if item_counts:
-        total_books, total_hats, total_balls = map(int, item_counts.groups())
+        totals = [int(count) for count in item_counts.groups()]
     else:
         return {"error": "Item counts not found in the provided text"}
 
-    # initialize sum counters for the proposals
-    sum_books, sum_hats, sum_balls = 0, 0, 0
-
     # sum the proposed amounts
+    sums = [0] * len(schema)
     for proposal in proposals:
-        sum_books += int(proposal[0])
-        sum_hats += int(proposal[1])
-        sum_balls += int(proposal[2])
+        if len(schema) == 1:
+            proposal = [proposal]
+        sums = [total + int(count) for total, count in zip(sums, proposal)]
 
-    is_valid_deal = (
-        sum_books == total_books and sum_hats == total_hats and sum_balls == total_balls
-    )
+    is_valid_deal = sums == totals
 
     return is_valid_deal
 
@@ -67,64 +72,36 @@ def calculateFinalScore(
 
 
 def isParetoOptimal(p0_score, p1_score, cnts, p0_values, p1_values, objective):
-    # checks for pareto optimality of proposal given the players' values
-    # iterate through all possible allocations
+    # checks for pareto optimality of proposal given the players' values: no
+    # allocation may leave both players as good and at least one player better.
+    # the game's frontier is built item type by item type instead of iterating
+    # through all possible allocations, so any number of item types works
     assert objective in ["self", "coop", "comp"]
-    
-    allocations = []
-    for i in range(cnts["book"] + 1):
-        for j in range(cnts["hat"] + 1):
-            for k in range(cnts["ball"] + 1):
-                allocations.append({"book": i, "hat": j, "ball": k})
-
-    for allocation in allocations:
-        isAsGood = False
-        isBetter = False
-
-        # decide player counts based on allocation
-        p0_cnts = allocation
-        p1_cnts = {k: cnts[k] - p0_cnts[k] for k in p0_cnts.keys()}
-
-        # calculate utilities based on allocation
-        p0_new_score = calculateFinalScore(
-            p0_values, p0_cnts, p1_values, p1_cnts, objective
-        )
-        p1_new_score = calculateFinalScore(
-            p1_values, p1_cnts, p0_values, p0_cnts, objective
-        )
-
-        # check if there is a configuration where both players do as good and at least one player does better
-        if p0_new_score >= p0_score and p1_new_score >= p1_score:
-            isAsGood = True
-        if p0_new_score > p0_score or p1_new_score > p1_score:
-            isBetter = True
 
-        if isAsGood and isBetter:
-            return False
+    items = list(cnts.keys())
+    margins = pareto.frontier_margins(
+        [[cnts[item] for item in items]],
+        [[p0_values[item] for item in items]],
+        [[p1_values[item] for item in items]],
+        [p0_score],
+        [p1_score],
+        pareto.objective_codes(objective, 1),
+    )
 
     # if we don't find a single better allocation
-    return True
+    return bool(margins[0] == 0)
 
 
 def calculate_maximum_collective_score(cnts, p0_values, p1_values, objective):
-    allocations = []
-    for i in range(cnts["books"] + 1):
-        for j in range(cnts["hats"] + 1):
-            for k in range(cnts["balls"] + 1):
-                allocations.append({"books": i, "hats": j, "balls": k})
-
-    best_combined_score = 0
-    for allocation in allocations:
-        # decide player counts based on allocation
-        p0_cnts = allocation
-        p1_cnts = {k: cnts[k] - p0_cnts[k] for k in p0_cnts.keys()}
-
-        # calculate utilities based on allocation
-        p0_new_score = calculateScore(p0_values, p0_cnts)
-        p1_new_score = calculateScore(p1_values, p1_cnts)
+    # the best combined score is reached on the frontier of the game
+    items = list(cnts.keys())
+    frontier = pareto.score_frontier(
+        [cnts[item] for item in items],
+        [p0_values[item] for item in items],
+        [p1_values[item] for item in items],
+    )
+    best_combined_score = int(frontier.sum(axis=1).max())
 
-        best_combined_score = max(best_combined_score, p0_new_score + p1_new_score)
-        
     # return best score we saw from any allocation
     if objective == "self":
         return best_combined_score / 2
@@ -135,25 +112,27 @@ def calculate_maximum_collective_score(cnts, p0_values, p1_values, objective):
 
 
 def calculate_dataset_ceiling_performance(dir_path, objective):
-
-    best_combined_scores = []
-    for filename in os.listdir(f"{dir_path}/results"):
-        filepath = os.path.join(f"{dir_path}/results", filename)
-
-        with open(filepath, "r") as results_file:
-            results_json = json.load(results_file)
-
-        # check maximum collective score
-        best_combined_score = calculate_maximum_collective_score(
-            results_json["counts"],
-            results_json["p0_values"],
-            results_json["p1_values"],
-            objective,
+    # the maximum collective score of every game is looked up in the context
+    # oracle instead of searching all allocations game by game
+    table = results_table.load_table(dir_path)
+    context_oracle = oracle.get_oracle()
+    if results_table.table_items(table) == context_oracle.num_items:
+        best_combined_scores = context_oracle.best_joint(
+            table["counts"], table["p0_values"], table["p1_values"]
+        )
+    else:
+        # games with other item types than the context file use their frontiers
+        best_combined_scores = pareto.max_joint_scores(
+            table["counts"], table["p0_values"], table["p1_values"]
         )
 
-        best_combined_scores.append(best_combined_score)
-
-    return np.mean(best_combined_scores)
+    # return the mean of the best scores we saw from any allocation
+    if objective == "self":
+        return np.mean(best_combined_scores / 2)
+    elif objective == "coop":
+        return np.mean(best_combined_scores)
+    else:
+        raise Exception()
 
 
 def extract_final_scores(game_text):
@@ -174,94 +153,15 @@ def calculate_avg_score(path):
     return np.mean(scores)
 
 def concatenate(dir_path, filter="above_avg", is_comp=False):
-    with open(f"{dir_path}/p0_scores", "r") as p0_scores, open(
-        f"{dir_path}/p1_scores", "r"
-    ) as p1_scores:
-        p0_array = [int(line.strip()) for line in p0_scores]
-        p1_array = [int(line.strip()) for line in p1_scores]
-
-    # determine the average score for cutoff
-    if filter == "above_avg":
-        cutoff = np.mean(p0_array + p1_array)
-    elif filter == "nonzero":
-        cutoff = 0
-    elif filter == "all":
-        cutoff = -100
-    else:
-        raise Exception("")
-
-    print("cutoff", cutoff)
-
-    # determine the games that satisfy the cutoff
-    p0_good_games, p1_good_games = [], []
-    for i in range(len(p0_array)):
-
-        include = False
-        if is_comp and p0_array[i] == 0 and p1_array[i] == 0:
-            # use results json
-            index = ("000" + str(i))[-3:]
-            file_name = f"{dir_path}/results/{index}.json"
-
-            with open(file_name, "r") as results_file:
-                results = json.load(results_file)
-
-            if results["is_valid_deal"]:
-                include = True
-
-        if p0_array[i] > cutoff or include:
-            p0_good_games.append(i)
-
-        if p1_array[i] > cutoff or include:
-            p1_good_games.append(i)
-
-    print(len(p0_good_games) + len(p1_good_games))
-
-    # create the fine-tuning JSON
-    with open(f"{dir_path}/game_data.jsonl", "a") as final_file:
-        for i in p0_good_games:
-            index = ("000" + str(i))[-3:]
-            file_name = f"{dir_path}/json_logs/{index}_p0.json"
-
-            # load the game log as a JSON
-            with open(file_name, "r") as game_file:
-                game_log = json.load(game_file)
-
-            # dump the json into the jsonl, and then append a new line
-            json.dump({"messages": game_log}, final_file)
-            final_file.write("\n")
-
-        for i in p1_good_games:
-            index = ("000" + str(i))[-3:]
-            file_name = f"{dir_path}/json_logs/{index}_p1.json"
-
-            # load the game log as a JSON
-            with open(file_name, "r") as game_file:
-                game_log = json.load(game_file)
-
-            # dump the json into the jsonl, and then append a new line
-            json.dump({"messages": game_log}, final_file)
-            final_file.write("\n")
-
-
-def create_finetuning_job(model_suffix, jsonl_path=None, model_name="turbo"):
-    
-    # load API keys
-    load_dotenv()
-    client = OpenAI(
-        api_key=os.getenv("OPENAI_API_KEY"),
-        organization=os.getenv("OPENAI_ORG_ID"),
+    # builds the run's fine-tuning file in one streaming pass; samples that are
+    # already in game_data.jsonl are not written again (see dataset.py)
+    return dataset.build_dataset(
+        [dir_path], f"{dir_path}/game_data.jsonl", filter, is_comp, workers=1
     )
 
-    # creating a file with the API to train on
-    file = open(jsonl_path, "rb")
-    training_file = client.files.create(file=file, purpose="fine-tune")
-    
-    model = model_name
 
-    # job response
-    job_response = client.fine_tuning.jobs.create(
-        model=model,
-        training_file=training_file.id,
-        hyperparameters={"n_epochs": 3, "batch_size": 1, "learning_rate_multiplier": 8},
-        suffix=model_suffix,
-    )
+def create_finetuning_job(model_suffix, jsonl_path=None, model_name="turbo"):
+    # uploads the file unless the same contents were uploaded before, and starts
+    # a job unless one is already running on it (see finetune_jobs.py)
+    manager = finetune_jobs.JobManager(backends.get_client())
+    return manager.submit(jsonl_path, model_name, model_suffix)
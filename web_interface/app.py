@@ -12,7 +12,9 @@ import json
 import string
 from games.web_negotiation import WebNegotiationGame
 from players import ClosedSourceChatPlayer
-import openai
+import backends
+import prompt_registry
+from contexts import ContextIndex
 import numpy as np
 import boto3
 import logging
@@ -30,6 +32,10 @@ if not org_id:
 
 current_model = ["original", "human", "after", ""]
 
+# prompts are loaded once at startup, and read again when their files change so
+# that edited prompts take effect without restarting the server
+prompt_registry.configure(reload=True)
+
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'secret!'
 socketio = SocketIO(app, cors_allowed_origins="*")
@@ -50,14 +56,8 @@ def mturk_params(req_params):
     keys = ("assignmentId", "hitId", "turkSubmitTo", "workerId")
     return {k: req_params.get(k) for k in keys}
 
-def parse_context(ctx):
-    ctx = ctx.split()
-    cnts = [int(n) for n in ctx[0::2]]
-    vals = [int(v) for v in ctx[1::2]]
-    return cnts, vals
-
-with open("data/selfplay.txt", "r") as file:
-    lines = [line.strip() for line in file]
+# compiled game contexts (built from data/selfplay.txt on first use)
+contexts = ContextIndex("data/selfplay.txt")
 
 # Check and set OpenAI API key
 api_key = os.environ.get('OPENAI_API_KEY')
@@ -67,10 +67,12 @@ if not api_key:
 # Optional: Check and set OpenAI Organization ID
 org_id = os.environ.get('OPENAI_ORG_ID')
 
-# Initialize OpenAI client
-openai.api_key = api_key
-if org_id:
-    openai.organization = org_id
+# Initialize the shared OpenAI client used by every assistant player; the pool
+# holds one keep-alive connection per concurrent game
+backends.configure_client(
+    pool_size=max(max_games, backends.client_config["pool_size"])
+)
+backends.get_client()
 
 # Maintain game objects:
 current_games = {}
@@ -94,9 +96,8 @@ def new_game(user_id, mturk_info):
     
     print("User: {} | Current model: {}".format(user_id, current_model))
 
-    random_index = np.random.randint(0, 4085)
-    cnts, p0_vals = parse_context(lines[random_index * 2])
-    _, p1_vals = parse_context(lines[random_index * 2 + 1])
+    random_index = contexts.sample("pairs")
+    cnts, p0_vals, p1_vals = contexts.context(random_index)
 
     if current_model[0] == "original":
         objective = "self"
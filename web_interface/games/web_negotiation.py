@@ -1,5 +1,7 @@
 import time
 import re
+import prompt_registry
+from items import DEFAULT_SCHEMA
 
 class WebNegotiationGame:
     """Tracks game state for the cooperative dialog game."""
@@ -32,6 +34,9 @@ class WebNegotiationGame:
             self.assistant_values = assistant_values
 
 
+        # the web game always plays the default books, hats and balls
+        self.schema = DEFAULT_SCHEMA
+
         self.proposals = [None, None]
         self.final_scores = [None, None]
 
@@ -39,30 +44,21 @@ class WebNegotiationGame:
         self.deal_proposed = False
         self.game_over = False
 
-        # system prompt
+        # system prompt, rendered from the registry's copy of the prompt file
         self.objective = objective
-        if self.objective == "self":
-            self.prompt_path = "prompts/dond.txt"
-        elif self.objective == "coop":
-            self.prompt_path = "prompts/coop_dond.txt"
-        elif self.objective == "comp":
-            self.prompt_path = "prompts/comp_dond.txt"
-        else:
-            raise Exception("invalid objective")
-        
-        # populate prompt with the prompt file
-        with open(self.prompt_path, "r") as prompt_file:
-            
-            prompt_message = prompt_file.read()
-            prompt_message = prompt_message.format(
-                book_cnt=self.item_counts["book"],
-                hat_cnt=self.item_counts["hat"],
-                ball_cnt=self.item_counts["ball"],
-                book_val=self.assistant_values["book"],
-                hat_val=self.assistant_values["hat"],
-                ball_val=self.assistant_values["ball"],
-            )
-        
+        self.prompt_path = prompt_registry.prompt_path(objective)
+        prompt_message = prompt_registry.get_registry().render(
+            self.prompt_path,
+            {
+                "book_cnt": self.item_counts["book"],
+                "hat_cnt": self.item_counts["hat"],
+                "ball_cnt": self.item_counts["ball"],
+                "book_val": self.assistant_values["book"],
+                "hat_val": self.assistant_values["hat"],
+                "ball_val": self.assistant_values["ball"],
+            },
+        )
+
         # for the web version
         self.assistant_system_prompt = prompt_message
             